@@ -8,6 +8,8 @@ from django.views.generic import TemplateView
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from pages.idempotency import new_idempotency_key
+from payments.forms import PaymentForm
 from products.services import get_product_from_cache
 from .services import get_cart_items, get_cart, save_cart
 
@@ -66,10 +68,13 @@ class CartView(TemplateView):
 
     def get(self, request, *args, **kwargs):
         cart_items, total_price = get_cart_items(request)
+        idempotency_key = new_idempotency_key()
 
         return render(request, self.template_name, {
             'cart_items': cart_items,
             'total_price': total_price,
+            'idempotency_key': idempotency_key,
+            'checkout_form': PaymentForm(initial={'idempotency_key': idempotency_key}),
         })
 
 
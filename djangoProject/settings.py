@@ -79,19 +79,27 @@ MIDDLEWARE = [
     'allauth.account.middleware.AccountMiddleware',
     'django.contrib.sites.middleware.CurrentSiteMiddleware',
     'django.contrib.flatpages.middleware.FlatpageFallbackMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Substitui o AuthenticationMiddleware do Django, resolvendo o usuário pelos caches local e compartilhado
+    'users.middlewares.cached_user.CachedAuthenticationMiddleware',
     "debug_toolbar.middleware.DebugToolbarMiddleware",
     # MEUS MIDDLEWARES
     'pages.middleware.GeneralRateLimitMiddleware',
     'users.middlewares.log_user_actions.LogUserActionsMiddleware',
-    'users.middlewares.cached_user.CachedAuthenticationMiddleware'
+    'pages.invalidation.CacheInvalidationMiddleware',
 ]
 
+# TEMPO QUE CADA PROCESSO MANTÉM O USUÁRIO AUTENTICADO EM MEMÓRIA ANTES DE CONSULTAR O CACHE COMPARTILHADO '30 SEGUNDOS'
+AUTH_LOCAL_CACHE_TIMEOUT = 30
+AUTH_LOCAL_CACHE_MAX_ENTRIES = 5000
+
 GENERAL_RATE_LIMIT_TIME = 5  # Authenticated users: 5 seconds between requests
 ANONYMOUS_RATE_LIMIT_TIME = 8  # Anonymous users: 8 seconds between requests
 
 STRICT_RATE_LIMIT_TIME = 20  # Strict actions: 20 seconds between sensitive updates
 
+# Paths authenticated by other means, like the signed payment webhooks, skip the general rate limit
+RATE_LIMIT_EXEMPT_PATHS = ['/pagamentos/webhooks/']
+
 ROOT_URLCONF = 'djangoProject.urls'
 
 TEMPLATES = [
@@ -259,8 +267,53 @@ REST_FRAMEWORK = {
 # TEMPO PADRÃO DE VIGÊNCIA DOS CACHES '1 SEMANA'
 CACHE_TIMEOUT = 60 * 60 * 24 * 7
 
+# QUANTIDADE DE PAGAMENTOS MAIS RECENTES MANTIDOS NO CACHE DE CADA USUÁRIO, OS MAIS ANTIGOS VÊM DO BANCO
+PAYMENTS_CACHE_WINDOW = 50
+
+# QUANTIDADE DE HISTÓRICOS MAIS RECENTES MANTIDOS NO CACHE DE CADA USUÁRIO, OS MAIS ANTIGOS VÊM DO BANCO
+USER_HISTORIES_CACHE_WINDOW = 50
+
 CART_ITEM_MAX_QUANTITY = 20
 
+# TEMPO ATÉ UM PEDIDO AGUARDANDO PAGAMENTO SER CANCELADO '2 DIAS'
+WAITING_ORDER_EXPIRATION_TIME = 60 * 60 * 24 * 2
+
+# TEMPO EM QUE UM PAGAMENTO PENDENTE MANTÉM O ESTOQUE RESERVADO '30 MINUTOS'
+PENDING_PAYMENT_EXPIRATION_TIME = 60 * 30
+
+# IDADE A PARTIR DA QUAL PEDIDOS FINALIZADOS OU CANCELADOS SÃO ARQUIVADOS '180 DIAS'
+ORDER_ARCHIVE_AGE = 60 * 60 * 24 * 180
+
+# SEGREDOS USADOS PARA VALIDAR A ASSINATURA DOS WEBHOOKS DE CADA PROVEDOR DE PAGAMENTO
+PAYMENT_WEBHOOK_SECRETS = {
+    'stub': os.getenv('STUB_WEBHOOK_SECRET'),
+}
+
+# DIFERENÇA MÁXIMA ENTRE O HORÁRIO DA ASSINATURA DO WEBHOOK E O DO SERVIDOR '5 MINUTOS'
+PAYMENT_WEBHOOK_TOLERANCE = 60 * 5
+
+# FILA DE WEBHOOKS SALVOS: EVENTOS POR LOTE E TENTATIVAS ANTES DE UM EVENTO SER MARCADO COMO FALHO
+PAYMENT_WEBHOOK_BATCH_SIZE = 200
+PAYMENT_WEBHOOK_MAX_ATTEMPTS = 5
+PAYMENT_WEBHOOK_WORKER = True
+
+# INTERVALO MÁXIMO EM SEGUNDOS ENTRE AS EXECUÇÕES DOS WORKERS DE WEBHOOKS E DE COBRANÇAS
+PAYMENT_WORKER_FLUSH_INTERVAL = 2
+
+# GATEWAYS DE PAGAMENTO POR TIPO, OS TIPOS SEM GATEWAY SÃO PAGOS APENAS COM O SALDO DO USUÁRIO
+# EXEMPLO: {'credit_card': {'BACKEND': 'payments.gateways.HTTPGateway',
+#                           'OPTIONS': {'name': 'cartao', 'base_url': 'https://...', 'api_key': '...'}}}
+PAYMENT_GATEWAYS = {}
+
+# TEMPO MÁXIMO DE UMA CHAMADA AO GATEWAY EM SEGUNDOS E CONEXÕES SIMULTÂNEAS POR GATEWAY
+PAYMENT_GATEWAY_TIMEOUT = 10
+PAYMENT_GATEWAY_POOL_SIZE = 10
+
+# COBRANÇAS: EXECUTADAS PELO WORKER, NOVA TENTATIVA APÓS FALHAS '1 MINUTO' ATÉ O LIMITE DE TENTATIVAS
+PAYMENT_CHARGE_WORKER = True
+PAYMENT_CHARGE_RETRY_DELAY = 60
+PAYMENT_CHARGE_MAX_ATTEMPTS = 5
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -1,8 +1,10 @@
 from django.contrib import admin
 from django.db.models import Prefetch
 
+from pages.exports import CSV, JSONL, streaming_export_response
 from products.models import Product
-from .models import Item, Order
+from .models import Item, Order, ArchivedOrder
+from .services import ORDER_EXPORT_FIELDS, ITEM_EXPORT_FIELDS
 
 
 class ItemInline(admin.TabularInline):
@@ -44,12 +46,47 @@ class ItemAdmin(admin.ModelAdmin):
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     autocomplete_fields  = ['customer']
-    list_display = ['id', 'customer', 'status', 'is_paid', 'modified']
+    list_display = ['id', 'customer', 'status', 'is_paid', 'total_amount', 'items_count', 'modified']
     list_filter = ['status', 'is_paid', 'modified']
     search_fields = ['customer__username', 'id']
-    readonly_fields = ['status', 'created', 'modified']
+    readonly_fields = ['status', 'total_amount', 'items_count', 'created', 'modified']
     inlines = [ItemInline]
+    actions = ['export_orders_csv', 'export_orders_jsonl', 'export_items_csv', 'export_items_jsonl']
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
         return queryset.select_related('customer')
+
+    @admin.action(description='Exportar pedidos selecionados (CSV)')
+    def export_orders_csv(self, request, queryset):
+        return streaming_export_response(queryset, ORDER_EXPORT_FIELDS, 'pedidos', CSV)
+
+    @admin.action(description='Exportar pedidos selecionados (JSONL)')
+    def export_orders_jsonl(self, request, queryset):
+        return streaming_export_response(queryset, ORDER_EXPORT_FIELDS, 'pedidos', JSONL)
+
+    @admin.action(description='Exportar itens dos pedidos selecionados (CSV)')
+    def export_items_csv(self, request, queryset):
+        items = Item.objects.filter(order__in=queryset.values('id'))
+        return streaming_export_response(items, ITEM_EXPORT_FIELDS, 'itens', CSV)
+
+    @admin.action(description='Exportar itens dos pedidos selecionados (JSONL)')
+    def export_items_jsonl(self, request, queryset):
+        items = Item.objects.filter(order__in=queryset.values('id'))
+        return streaming_export_response(items, ITEM_EXPORT_FIELDS, 'itens', JSONL)
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = ['id', 'customer', 'status', 'is_paid', 'total_amount', 'items_count', 'archived_at']
+    list_filter = ['status', 'is_paid']
+    search_fields = ['customer__username', 'id']
+    readonly_fields = ['id', 'customer', 'status', 'is_paid', 'total_amount', 'items_count', 'created', 'modified',
+                       'archived_at', 'data']
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return queryset.select_related('customer')
+
+    def has_add_permission(self, request):
+        return False
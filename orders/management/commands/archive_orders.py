@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from orders.services import archive_orders
+
+
+class Command(BaseCommand):
+    help = "Move pedidos finalizados ou cancelados antigos para o arquivo, mantendo as tabelas de pedidos pequenas."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=None,
+                            help="Idade, em dias, a partir da qual um pedido é arquivado. "
+                                 "Padrão: settings.ORDER_ARCHIVE_AGE.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Quantidade de pedidos arquivados por transação.")
+
+    def handle(self, *args, **options):
+        days = options['days']
+        report = archive_orders(
+            max_age=timedelta(days=days) if days is not None else None,
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['archived']} pedidos arquivados em {report['batches']} lotes ({report['duration']}s)."
+        ))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Order
+
+
+class Command(BaseCommand):
+    help = "Recalcula o valor total e a quantidade de itens persistidos em cada pedido."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Quantidade de pedidos atualizados por UPDATE.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        updated = 0
+
+        while True:
+            order_ids = list(
+                Order.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not order_ids:
+                break
+            updated += Order.objects.refresh_totals(order_ids)
+            customer_ids = Order.objects.filter(id__in=order_ids).values_list('customer_id', flat=True)
+            Order.objects.delete_cached_orders_for(customer_ids)
+            last_id = order_ids[-1]
+
+        self.stdout.write(self.style.SUCCESS(f"{updated} pedidos atualizados."))
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from orders.services import expire_waiting_orders
+
+
+class Command(BaseCommand):
+    help = "Cancela os pedidos que estão aguardando pagamento há mais tempo do que o permitido."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-hours', type=float, default=None,
+                            help="Idade máxima, em horas, de um pedido aguardando pagamento. "
+                                 "Padrão: settings.WAITING_ORDER_EXPIRATION_TIME.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Quantidade de pedidos cancelados por transação.")
+
+    def handle(self, *args, **options):
+        max_age = options['max_age_hours']
+        report = expire_waiting_orders(
+            max_age=timedelta(hours=max_age) if max_age is not None else None,
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['expired']} pedidos expirados em {report['batches']} lotes ({report['duration']}s)."
+        ))
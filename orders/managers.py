@@ -1,5 +1,10 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
+
+from pages.invalidation import is_dirty, mark_dirty
+from pages.search import query_terms
 from django.core.cache import cache
 from django.conf import settings
 
@@ -32,7 +37,9 @@ class OrderManager(models.Manager):
         """
         from .serializers import OrderSerializer
         cache_key = self.get_cache_key(customer.id)
-        cached_orders = cache.get(cache_key)
+        # A pending invalidation means uncommitted or not yet flushed changes, they are read but never cached
+        dirty = is_dirty(cache_key)
+        cached_orders = None if dirty else cache.get(cache_key)
 
         if cached_orders is None:
             orders = self._get_prefetched_queryset().filter(customer_id=customer.id).order_by('-id')
@@ -40,7 +47,8 @@ class OrderManager(models.Manager):
                 order.id: OrderSerializer(order).data
                 for order in orders
             }
-            cache.set(cache_key, cached_orders, timeout=self.CACHE_TIMEOUT)
+            if not dirty:
+                cache.set(cache_key, cached_orders, timeout=self.CACHE_TIMEOUT)
 
         return cached_orders
 
@@ -48,30 +56,36 @@ class OrderManager(models.Manager):
         """
         Retrieves a single cached order or fetches it from the database.
         """
-        cache_key = self.get_cache_key(customer.id)
-        cached_orders = cache.get(cache_key)
-
-        if not cached_orders:
-            cached_orders = self.get_cached_orders(customer)
-
-        order = cached_orders.get(order_id)
+        order = self.get_cached_orders(customer).get(order_id)
         if not order:
             # Fetch from DB and cache it
             order_instance = self._get_prefetched_queryset().filter(customer=customer, id=order_id).first()
             if order_instance:
                 order = self.cache_single_order(order_instance)
+            else:
+                order = self.get_archived_order(order_id, customer)
 
         return order
 
+    @staticmethod
+    def get_archived_order(order_id, customer):
+        """
+        Fallback for orders already moved out of the hot tables, returns the archived serialized order.
+        """
+        from .models import ArchivedOrder
+        return ArchivedOrder.objects.filter(id=order_id, customer=customer).values_list('data', flat=True).first()
+
     def cache_single_order(self, order_instance):
         """
         Caches a single order into the bulk cache.
         """
         from .serializers import OrderSerializer
-        cache_key = self.get_cache_key(order_instance.customer.id)
-        cached_orders = self.get_cached_orders(order_instance.customer)
-
+        cache_key = self.get_cache_key(order_instance.customer_id)
         order_data = OrderSerializer(order_instance).data
+        if is_dirty(cache_key):
+            return order_data
+
+        cached_orders = self.get_cached_orders(order_instance.customer)
         cached_orders[order_instance.id] = order_data
         cache.set(cache_key, cached_orders, timeout=self.CACHE_TIMEOUT)
 
@@ -79,17 +93,79 @@ class OrderManager(models.Manager):
 
     def update_cached_orders(self, order):
         """
-        Updates or adds an order to the cache.
+        Invalidates the orders cache of the customer once the change commits, the next read rebuilds it.
         """
-        self.cache_single_order(order)
+        mark_dirty(self.get_cache_key(order.customer_id))
 
     def delete_cached_order(self, order):
         """
-        Removes an order from the cache.
+        Invalidates the orders cache of the customer once the deletion commits.
         """
-        cache_key = self.get_cache_key(order.customer.id)
-        cached_orders = cache.get(cache_key) or {}
+        mark_dirty(self.get_cache_key(order.customer_id))
 
-        if order.id in cached_orders:
-            del cached_orders[order.id]
-            cache.set(cache_key, cached_orders, timeout=self.CACHE_TIMEOUT)
+    def delete_cached_orders_for(self, customer_ids):
+        """
+        Invalidates the cached orders dict of every given customer, with one delete once the transaction commits.
+        """
+        mark_dirty(*[self.get_cache_key(customer_id) for customer_id in set(customer_ids)])
+
+    def refresh_totals(self, order_ids):
+        """
+        Recomputes the persisted total_amount/items_count of the given orders with one UPDATE.
+        Items without a price fall back to the current product price, like Item.get_total_price.
+        """
+        from .models import Item
+        amount_field = DecimalField(max_digits=10, decimal_places=2)
+        items = Item.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        totals = items.annotate(
+            total=Sum(Coalesce(NullIf(F('price'), Value(0)), F('product__price')) * F('quantity'),
+                      output_field=amount_field)
+        ).values('total')
+        counts = items.annotate(count=Sum('quantity')).values('count')
+        return self.filter(id__in=order_ids).update(
+            total_amount=Coalesce(Subquery(totals), Value(0), output_field=amount_field),
+            items_count=Coalesce(Subquery(counts), Value(0)),
+        )
+
+    def search(self, query):
+        """
+        Staff search: exact id when the query is numeric, otherwise every word must prefix-match
+        an indexed token of the order (id, status, customer name, email and username).
+        """
+        from .models import OrderSearchToken
+        query = (query or '').strip()
+        if query.isdigit():
+            return self.filter(id=int(query))
+
+        orders = self.all()
+        for term in query_terms(query):
+            orders = orders.filter(
+                id__in=OrderSearchToken.objects.filter(token__startswith=term).values('order_id')
+            )
+        return orders
+
+    def update_search_tokens(self, orders):
+        """
+        Rewrites the search tokens of the given orders, their customers must be loaded.
+        """
+        from .models import OrderSearchToken
+        orders = list(orders)
+        OrderSearchToken.objects.filter(order__in=orders).delete()
+        OrderSearchToken.objects.bulk_create(
+            [OrderSearchToken(order=order, token=token) for order in orders for token in order.get_search_tokens()],
+            ignore_conflicts=True,
+        )
+
+    def reindex_customer(self, customer_id, chunk_size=500):
+        """
+        Rewrites the search tokens of every order of a customer, used when the customer data changes.
+        """
+        orders = self.filter(customer_id=customer_id).select_related('customer').order_by('id')
+        batch = []
+        for order in orders.iterator(chunk_size=chunk_size):
+            batch.append(order)
+            if len(batch) >= chunk_size:
+                self.update_search_tokens(batch)
+                batch = []
+        if batch:
+            self.update_search_tokens(batch)
@@ -8,6 +8,7 @@ from decimal import Decimal
 from model_utils.models import TimeStampedModel, StatusModel
 
 from orders.managers import OrderManager
+from pages.search import search_tokens, TOKEN_MAX_LENGTH
 from products.models import Product, PromotionCode
 from users.models import RoleType
 
@@ -25,10 +26,14 @@ class Order(TimeStampedModel):
         (Cancelled, "Pedido cancelado"),
     ]
 
-    customer = models.ForeignKey(User, related_name="pedidos", verbose_name="Cliente", on_delete=models.PROTECT)
+    # Indexed by the (customer, -id) composite below, which also serves the customer lookups
+    customer = models.ForeignKey(User, related_name="pedidos", verbose_name="Cliente", on_delete=models.PROTECT,
+                                 db_index=False)
     status = models.CharField(verbose_name='Estado do pedido', choices=status_choices, default=Waiting_payment,
                               max_length=50)
     is_paid = models.BooleanField(verbose_name="Foi pago?", default=False)
+    total_amount = models.DecimalField(verbose_name='Valor total', max_digits=10, decimal_places=2, default=0)
+    items_count = models.PositiveIntegerField(verbose_name='Quantidade de itens', default=0)
 
     objects = OrderManager()
 
@@ -38,7 +43,8 @@ class Order(TimeStampedModel):
         verbose_name_plural = "pedidos"
 
         indexes = [
-            models.Index(fields=['customer']),
+            # Per customer listings, newest first
+            models.Index(fields=['customer', '-id']),
             models.Index(fields=['status']),
             models.Index(fields=['modified']),
             models.Index(fields=['is_paid']),
@@ -48,7 +54,20 @@ class Order(TimeStampedModel):
         return f"Order #{self.id} - {self.get_status_display()}"
 
     def get_total_amount(self):
-        return Decimal(sum(item.get_total_price() for item in self.items.all()))  # Sum the total for all items
+        # Persisted total, kept in sync by create_order and the product price signals
+        return Decimal(self.total_amount)
+
+    def set_totals(self, items):
+        """
+        Sets the denormalized totals from the given items, without saving.
+        """
+        self.total_amount = Decimal(sum(item.get_total_price() for item in items))
+        self.items_count = sum(item.quantity for item in items)
+
+    def get_search_tokens(self):
+        customer = self.customer
+        return search_tokens(self.id, self.status, self.get_status_display(), customer.first_name,
+                             customer.last_name, customer.email, customer.username)
 
 
 class Item(models.Model):
@@ -81,3 +100,63 @@ class Item(models.Model):
         if self.price:
             return Decimal(self.price * self.quantity)
         return Decimal(self.product.price * self.quantity)
+
+
+class OrderSearchToken(models.Model):
+    """
+    Normalized words of an order and its customer, kept on save for the staff search.
+    """
+    order = models.ForeignKey(Order, verbose_name="Pedido", related_name="search_tokens", on_delete=models.CASCADE)
+    token = models.CharField(verbose_name="Termo", max_length=TOKEN_MAX_LENGTH, db_index=True)
+
+    class Meta:
+        verbose_name = "termo de busca de pedido"
+        verbose_name_plural = "termos de busca de pedidos"
+
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'token'], name='unique_order_search_token')
+        ]
+
+
+class ArchivedOrder(models.Model):
+    """
+    Cold copy of an old finalized or cancelled order, kept after its Order and Item rows leave the hot tables.
+    It keeps the original id so links to the order keep working.
+    """
+    id = models.BigIntegerField(verbose_name="ID do pedido", primary_key=True)
+    customer = models.ForeignKey(User, related_name="archived_orders", verbose_name="Cliente",
+                                 on_delete=models.PROTECT)
+    status = models.CharField(verbose_name='Estado do pedido', choices=Order.status_choices, max_length=50)
+    is_paid = models.BooleanField(verbose_name="Foi pago?", default=False)
+    total_amount = models.DecimalField(verbose_name='Valor total', max_digits=10, decimal_places=2, default=0)
+    items_count = models.PositiveIntegerField(verbose_name='Quantidade de itens', default=0)
+    created = models.DateTimeField(verbose_name="Criado em")
+    modified = models.DateTimeField(verbose_name="Modificado em")
+    archived_at = models.DateTimeField(verbose_name="Arquivado em", auto_now_add=True)
+    data = models.JSONField(verbose_name="Pedido serializado")
+
+    class Meta:
+        ordering = ["-id"]
+        verbose_name = "pedido arquivado"
+        verbose_name_plural = "pedidos arquivados"
+
+    def __str__(self):
+        return f"Archived order #{self.id} - {self.get_status_display()}"
+
+    @classmethod
+    def from_order(cls, order):
+        """
+        Builds the archive row of an order, its customer and items should be loaded.
+        """
+        from .serializers import OrderSerializer
+        return cls(
+            id=order.id,
+            customer_id=order.customer_id,
+            status=order.status,
+            is_paid=order.is_paid,
+            total_amount=order.total_amount,
+            items_count=order.items_count,
+            created=order.created,
+            modified=order.modified,
+            data=OrderSerializer(order).data,
+        )
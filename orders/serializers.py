@@ -14,10 +14,10 @@ class ItemSerializer(serializers.ModelSerializer):
 
 class OrderSerializer(serializers.ModelSerializer):
     status = serializers.CharField(source='get_status_display', read_only=True)
-    total_amount = serializers.DecimalField(source='get_total_amount', max_digits=10, decimal_places=2, read_only=True)
+    total_amount = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
     customer = serializers.CharField(source='customer.get_full_name', read_only=True)
     products = ItemSerializer(source='items', many=True, read_only=True)
 
     class Meta:
         model = Order
-        fields = ['id', 'status', 'customer', 'total_amount', 'products']
+        fields = ['id', 'status', 'customer', 'total_amount', 'items_count', 'products']
@@ -1,13 +1,24 @@
+from django.conf import settings
 from django.db import transaction
+from django.db.models import F
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from datetime import timedelta
+from decimal import Decimal
 
 from products.services import get_stock_from_cache, get_product_from_cache
-from .models import Order, Item
+from .models import Order, Item, ArchivedOrder
 
 import logging
+import time
 
 logger = logging.getLogger('celery')
 
+ORDER_EXPORT_FIELDS = ['id', 'customer_id', 'customer__username', 'status', 'is_paid', 'total_amount', 'items_count',
+                       'created', 'modified']
+ITEM_EXPORT_FIELDS = ['id', 'order_id', 'product_id', 'name', 'slug', 'price', 'quantity']
+
 
 def create_order(user, items_data) -> Order | ValidationError | Exception:
     try:
@@ -29,12 +40,14 @@ def create_order(user, items_data) -> Order | ValidationError | Exception:
                     Item(order=order,
                          product_id=product['id'],
                          name=product['name'],
-                         price=product['price'],
+                         price=Decimal(product['price']),
                          slug=product['slug'],
                          quantity=quantity)
                 )
             Item.objects.bulk_create(items_to_create)
-            order.save()
+            # Persist the totals so lists, caches and payments read a column instead of summing items
+            order.set_totals(items_to_create)
+            order.save(update_fields=['total_amount', 'items_count', 'modified'])
         return order
     except ValidationError as e:
         raise e
@@ -43,5 +56,92 @@ def create_order(user, items_data) -> Order | ValidationError | Exception:
         raise
 
 
+def expire_waiting_orders(max_age: timedelta = None, batch_size: int = 500) -> dict:
+    """
+    Cancels orders waiting for payment longer than max_age, in batches that skip rows locked by a checkout.
+    Orders with a pending payment are left to the payment flow, since they still hold stock.
+
+    :param max_age: Age after which a waiting order expires, defaults to settings.WAITING_ORDER_EXPIRATION_TIME.
+    :param batch_size: Orders locked and cancelled per transaction.
+    :return: Report with the expired orders, processed batches and the duration in seconds.
+    """
+    from payments.models import PaymentStatus
+
+    started_at = time.monotonic()
+    if max_age is None:
+        max_age = timedelta(seconds=getattr(settings, 'WAITING_ORDER_EXPIRATION_TIME', 60 * 60 * 24 * 2))
+    cutoff = timezone.now() - max_age
+    expired, batches = 0, 0
+
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Order.objects.select_for_update(skip_locked=True)
+                .filter(status=Order.Waiting_payment, created__lt=cutoff)
+                .exclude(payments__status=PaymentStatus.PENDING)
+                .order_by('id')
+                .values_list('id', 'customer_id')[:batch_size]
+            )
+            if not rows:
+                break
+            order_ids = [order_id for order_id, _ in rows]
+            Order.objects.filter(id__in=order_ids).update(status=Order.Cancelled, modified=timezone.now())
+
+        Order.objects.update_search_tokens(Order.objects.filter(id__in=order_ids).select_related('customer'))
+        Order.objects.delete_cached_orders_for(customer_id for _, customer_id in rows)
+        expired += len(order_ids)
+        batches += 1
+
+    report = {'expired': expired, 'batches': batches, 'duration': round(time.monotonic() - started_at, 3)}
+    logger.info(f"Expired {expired} waiting orders in {batches} batches ({report['duration']}s).")
+    return report
+
+
+def archive_orders(max_age: timedelta = None, batch_size: int = 500) -> dict:
+    """
+    Moves finalized and cancelled orders not modified for longer than max_age into ArchivedOrder,
+    deleting their Order, Item and search token rows, one batch per transaction.
+    Payments of the archived orders keep the order id in Payment.archived_order_id.
+
+    :param max_age: Age after which an order is archived, defaults to settings.ORDER_ARCHIVE_AGE.
+    :param batch_size: Orders moved per transaction.
+    :return: Report with the archived orders, processed batches and the duration in seconds.
+    """
+    from payments.models import Payment
+
+    started_at = time.monotonic()
+    if max_age is None:
+        max_age = timedelta(seconds=getattr(settings, 'ORDER_ARCHIVE_AGE', 60 * 60 * 24 * 180))
+    cutoff = timezone.now() - max_age
+    archived, batches = 0, 0
+
+    while True:
+        with transaction.atomic():
+            orders = list(
+                Order.objects.select_for_update(skip_locked=True, of=('self',))
+                .filter(status__in=[Order.Finalized, Order.Cancelled], modified__lt=cutoff)
+                .select_related('customer')
+                .prefetch_related('items')
+                .order_by('id')[:batch_size]
+            )
+            if not orders:
+                break
+            order_ids = [order.id for order in orders]
+            customer_ids = {order.customer_id for order in orders}
+
+            ArchivedOrder.objects.bulk_create([ArchivedOrder.from_order(order) for order in orders],
+                                              ignore_conflicts=True)
+            Payment.objects.filter(order_id__in=order_ids).update(archived_order_id=F('order_id'))
+            Order.objects.filter(id__in=order_ids).delete()
+            Order.objects.delete_cached_orders_for(customer_ids)
+
+        archived += len(order_ids)
+        batches += 1
+
+    report = {'archived': archived, 'batches': batches, 'duration': round(time.monotonic() - started_at, 3)}
+    logger.info(f"Archived {archived} orders in {batches} batches ({report['duration']}s).")
+    return report
+
+
 def orders_cache_key_builder(user_id):
     return f'orders_{user_id}_dict'
@@ -1,12 +1,27 @@
+from django.contrib.auth import get_user_model
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
+from pages.search import touches_fields
 from .models import Order
 
+User = get_user_model()
+
+SEARCH_FIELDS = ('status', 'customer')
+CUSTOMER_SEARCH_FIELDS = ('first_name', 'last_name', 'email', 'username')
+
 
 @receiver(post_save, sender=Order)
-def order_post_change(sender, instance, **kwargs):
+def order_post_change(sender, instance, created=False, update_fields=None, **kwargs):
     sender.objects.update_cached_orders(instance)
+    if touches_fields(created, update_fields, SEARCH_FIELDS):
+        sender.objects.update_search_tokens([instance])
+
+
+@receiver(post_save, sender=User)
+def customer_post_change(sender, instance, created=False, update_fields=None, **kwargs):
+    if not created and touches_fields(created, update_fields, CUSTOMER_SEARCH_FIELDS):
+        Order.objects.reindex_customer(instance.pk)
 
 
 @receiver(post_delete, sender=Order)
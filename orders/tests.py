@@ -1,7 +1,22 @@
+import json
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
+
+from pages import idempotency
+from pages.query_plans import QueryPlanAssertionsMixin, get_index_name
+from pages.testing import CacheClearingTestCase, SalesTestCase
+from payments.models import PaymentStatus
+from products.models import Category, Product
 from users.models import User
-from django.core.cache import cache
+from .models import Order, Item, ArchivedOrder
+from .services import create_order, expire_waiting_orders, archive_orders
 
 
 class RateLimitMiddlewareTests(TestCase):
@@ -58,4 +73,152 @@ class RateLimitMiddlewareTests(TestCase):
 
         # Now, try again
         response = self.client.get(self.order_list)
-        self.assertEqual(response.status_code, 200)  # Should now be able to make a valid request again
\ No newline at end of file
+        self.assertEqual(response.status_code, 200)  # Should now be able to make a valid request again
+
+
+class OrderTotalsTests(SalesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = Product.objects.create(name='Outro', category=self.category, price=Decimal('2.50'))
+
+    def test_create_order_persists_totals(self):
+        order = create_order(self.user, [{'slug': self.product.slug, 'quantity': 2},
+                                         {'slug': self.other.slug, 'quantity': 4}])
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal('30.00'))
+        self.assertEqual(order.items_count, 6)
+
+    def test_product_price_change_updates_waiting_orders(self):
+        order = create_order(self.user, self.items(3))
+        self.product.price = Decimal('12.00')
+        self.product.save()
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal('36.00'))
+
+    def test_backfill_command(self):
+        order = create_order(self.user, self.items())
+        Order.objects.filter(id=order.id).update(total_amount=0, items_count=0)
+        call_command('backfill_order_totals', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal('10.00'))
+        self.assertEqual(order.items_count, 1)
+
+
+class StaffOrderSearchTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='joana', password='testpass', first_name='Joana',
+                                             email='joana@exemplo.com')
+        self.other = User.objects.create_user(username='carlos', password='testpass')
+        category = Category.objects.create(name='Categoria')
+        product = Product.objects.create(name='Produto', category=category, price=Decimal('10.00'))
+        self.order = create_order(self.user, [{'slug': product.slug, 'quantity': 1}])
+        self.other_order = create_order(self.other, [{'slug': product.slug, 'quantity': 1}])
+
+    def test_search_by_customer_prefix(self):
+        self.assertEqual(list(Order.objects.search('JOAN')), [self.order])
+        self.assertEqual(list(Order.objects.search('exemplo.com')), [self.order])
+
+    def test_numeric_query_is_an_exact_id_match(self):
+        self.assertEqual(list(Order.objects.search(str(self.other_order.id))), [self.other_order])
+
+    def test_tokens_follow_status_and_customer_changes(self):
+        self.order.status = Order.Cancelled
+        self.order.save(update_fields=['status'])
+        self.assertEqual(list(Order.objects.search('cancelado')), [self.order])
+
+        self.other.first_name = 'Ângela'
+        self.other.save()
+        self.assertEqual(list(Order.objects.search('angela')), [self.other_order])
+
+
+class ExpireWaitingOrdersTests(SalesTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.old_order = create_order(self.user, self.items())
+            self.new_order = create_order(self.user, self.items())
+        Order.objects.filter(id=self.old_order.id).update(created=timezone.now() - timedelta(days=10))
+
+    def test_only_stale_orders_are_cancelled(self):
+        Order.objects.get_cached_orders(self.user)
+        self.assertIsNotNone(cache.get(Order.objects.get_cache_key(self.user.id)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            report = expire_waiting_orders(max_age=timedelta(days=2), batch_size=1)
+
+        self.assertEqual(report['expired'], 1)
+        self.assertEqual(Order.objects.get(id=self.old_order.id).status, Order.Cancelled)
+        self.assertEqual(Order.objects.get(id=self.new_order.id).status, Order.Waiting_payment)
+        self.assertIsNone(cache.get(Order.objects.get_cache_key(self.user.id)))
+
+
+class ArchiveOrdersTests(SalesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.old_order = create_order(self.user, self.items(2))
+        self.recent_order = create_order(self.user, self.items())
+        Order.objects.filter(id__in=[self.old_order.id, self.recent_order.id]).update(status=Order.Finalized)
+        Order.objects.filter(id=self.old_order.id).update(modified=timezone.now() - timedelta(days=365))
+
+    def test_old_orders_leave_the_hot_tables(self):
+        report = archive_orders(max_age=timedelta(days=180), batch_size=1)
+
+        self.assertEqual(report['archived'], 1)
+        self.assertFalse(Order.objects.filter(id=self.old_order.id).exists())
+        self.assertFalse(Item.objects.filter(order_id=self.old_order.id).exists())
+        self.assertTrue(Order.objects.filter(id=self.recent_order.id).exists())
+        archived = ArchivedOrder.objects.get(id=self.old_order.id)
+        self.assertEqual(archived.total_amount, Decimal('20.00'))
+        self.assertEqual(len(archived.data['products']), 1)
+
+    def test_detail_view_falls_back_to_the_archive(self):
+        archive_orders(max_age=timedelta(days=180))
+        self.client.login(username='buyer', password='testpass')
+
+        response = self.client.get(reverse('orders:order_detail', kwargs={'order_id': self.old_order.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['order']['id'], self.old_order.id)
+
+
+class CreateOrderIdempotencyTests(SalesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='buyer', password='testpass')
+
+    def test_repeated_submission_returns_the_first_order(self):
+        key = idempotency.new_idempotency_key()
+        url = reverse('orders:create_order')
+
+        self.client.cookies['cart'] = json.dumps({self.product.slug: {'quantity': 1}})
+        first = self.client.post(url, {'idempotency_key': key})
+        self.client.cookies['cart'] = json.dumps({self.product.slug: {'quantity': 1}})
+        second = self.client.post(url, {'idempotency_key': key})
+
+        self.assertEqual(Order.objects.filter(customer=self.user).count(), 1)
+        order = Order.objects.get(customer=self.user)
+        expected = reverse('orders:order_detail', kwargs={'order_id': order.id})
+        self.assertRedirects(first, expected, fetch_redirect_response=False)
+        self.assertRedirects(second, expected, fetch_redirect_response=False)
+
+
+class OrderQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='testpass')
+
+    def test_customer_orders_are_listed_through_the_composite_index(self):
+        orders = Order.objects.filter(customer_id=self.user.id)
+        index_name = get_index_name(Order, ['customer', '-id'])
+        for queryset in (orders.order_by('-id'), orders.filter(id__lt=100).order_by('-id')[:11]):
+            self.assertUsesIndex(queryset, index_name)
+            self.assertNoSort(queryset)
+
+    def test_batch_jobs_select_orders_through_indexes(self):
+        cutoff = timezone.now()
+        self.assertNoFullScan(Order.objects.filter(status=Order.Waiting_payment, created__lt=cutoff)
+                              .exclude(payments__status=PaymentStatus.PENDING).order_by('id')[:500])
+        self.assertNoFullScan(Order.objects.filter(status__in=[Order.Finalized, Order.Cancelled],
+                                                   modified__lt=cutoff).order_by('id')[:500])
+
+    def test_order_items_are_read_through_the_order_index(self):
+        self.assertUsesIndex(Item.objects.filter(order_id__in=[1, 2]), get_index_name(Item, ['order']))
@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import CreateOrderView, PaymentCreateView, UserOrderListView, UserOrderDetailView
+from .views import CreateOrderView, CheckoutView, PaymentCreateView, UserOrderListView, UserOrderDetailView
 
 app_name = "orders"
 
@@ -7,6 +7,7 @@ app_name = "orders"
 urlpatterns = [
     path('', UserOrderListView.as_view(), name='order_list'),
     path('criar-pedido/', CreateOrderView.as_view(), name='create_order'),
+    path('finalizar-compra/', CheckoutView.as_view(), name='checkout'),
     path('<int:order_id>/', UserOrderDetailView.as_view(), name='order_detail'),
     path('<int:order_id>/criar-pagamento/', PaymentCreateView.as_view(), name='create_payment'),
 ]
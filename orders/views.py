@@ -1,4 +1,4 @@
-from django.db.models import Q, Prefetch
+from django.db.models import Prefetch
 from django.http import Http404
 from django.shortcuts import redirect
 from django.urls import reverse_lazy, reverse
@@ -6,33 +6,46 @@ from django.utils.decorators import method_decorator
 from django.views import View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ValidationError
-from django.core.paginator import Paginator
 from django.contrib import messages
 from django.views.generic import TemplateView, FormView
 from django.views.decorators.http import require_POST
 
 from payments.forms import PaymentForm
 from payments.models import Payment
-from payments.services import PaymentService
+from payments.services import PaymentService, checkout
 from products.models import Promotion
 from .models import Order, Item
 from cart.services import get_cart_items, save_cart
+from pages import idempotency
 from pages.decorators import strict_rate_limit
+from pages.paginators import KeysetPaginator
 from .services import create_order
 
 import logging
 
 logger = logging.getLogger('celery')
 
+ORDER_IDEMPOTENCY_SCOPE = 'create_order'
+PAYMENT_IDEMPOTENCY_SCOPE = 'create_payment'
+CHECKOUT_IDEMPOTENCY_SCOPE = 'checkout'
+
 
 @method_decorator(strict_rate_limit(url_names=['orders:create_order']), name='dispatch')
 class CreateOrderView(LoginRequiredMixin, View):
     @method_decorator(require_POST)
     def post(self, request, *args, **kwargs):
+        # A repeated submission of the same cart form returns the order created by the first one
+        idempotency_key = request.POST.get('idempotency_key')
+        if not idempotency.is_valid_key(idempotency_key):
+            idempotency_key = None
+        elif not idempotency.claim(ORDER_IDEMPOTENCY_SCOPE, request.user.id, idempotency_key):
+            return self.replay_order(request, idempotency_key)
+
         # Get the cart items
         cart_items, total_price = get_cart_items(request)
 
         if not cart_items:
+            self.release_key(request, idempotency_key)
             messages.error(request, "Seu carrinho está vázio!")
             return redirect('cart:detail')
 
@@ -42,18 +55,38 @@ class CreateOrderView(LoginRequiredMixin, View):
         try:
             # Call the create_order function
             order = create_order(user=request.user, items_data=items_data)
+            if idempotency_key:
+                idempotency.save_result(ORDER_IDEMPOTENCY_SCOPE, request.user.id, idempotency_key,
+                                        {'order_id': order.id})
             response = redirect(reverse('orders:order_detail', kwargs={'order_id': order.id}))
             save_cart(response, {})  # Clear the cart
             messages.success(request, "Pedido criado com sucesso!")
             return response
         except ValidationError as e:
+            self.release_key(request, idempotency_key)
             messages.error(request, f'Ocorreu um erro durante a criação do pedido: {e}')
             return redirect(reverse('cart:detail'))
         except Exception as e:
+            self.release_key(request, idempotency_key)
             logger.error(f"Order creation failed for user {request.user.id}: {e}")
             messages.error(request, 'Ocorreu um problema técnico. Por favor, tente novamente mais tarde.')
             return redirect(reverse('cart:detail'))
 
+    @staticmethod
+    def replay_order(request, idempotency_key):
+        result = idempotency.get_result(ORDER_IDEMPOTENCY_SCOPE, request.user.id, idempotency_key)
+        if not isinstance(result, dict):
+            messages.info(request, "Seu pedido já está sendo processado.")
+            return redirect('orders:order_list')
+        response = redirect(reverse('orders:order_detail', kwargs={'order_id': result['order_id']}))
+        save_cart(response, {})  # The first submission already emptied the cart
+        return response
+
+    @staticmethod
+    def release_key(request, idempotency_key):
+        if idempotency_key:
+            idempotency.release(ORDER_IDEMPOTENCY_SCOPE, request.user.id, idempotency_key)
+
     @staticmethod
     def update_promotions(products):
         for product in products:
@@ -62,6 +95,72 @@ class CreateOrderView(LoginRequiredMixin, View):
                 promotion.save()
 
 
+@method_decorator(strict_rate_limit(url_names=['orders:checkout']), name='dispatch')
+class CheckoutView(LoginRequiredMixin, View):
+    """
+    Single step checkout, the cart becomes an order and its payment in one transaction.
+    """
+    @method_decorator(require_POST)
+    def post(self, request, *args, **kwargs):
+        form = PaymentForm(request.POST)
+        if not form.is_valid():
+            messages.error(request, "Método de pagamento inválido.")
+            return redirect('cart:detail')
+
+        user = request.user
+        # A repeated submission of the same cart form returns the payment created by the first one
+        idempotency_key = form.cleaned_data.get('idempotency_key')
+        if not idempotency.is_valid_key(idempotency_key):
+            idempotency_key = None
+        elif not idempotency.claim(CHECKOUT_IDEMPOTENCY_SCOPE, user.id, idempotency_key):
+            return self.replay_payment(request, idempotency_key)
+
+        cart_items, total_price = get_cart_items(request)
+        if not cart_items:
+            self.release_key(request, idempotency_key)
+            messages.error(request, "Seu carrinho está vázio!")
+            return redirect('cart:detail')
+
+        items_data = [{'slug': item['product']['slug'], 'quantity': item['quantity']} for item in cart_items]
+
+        try:
+            payment = checkout(user=user, items_data=items_data,
+                               payment_type=form.cleaned_data['payment_method'],
+                               promo_codes=form.cleaned_data['promo_codes'])
+        except ValidationError as e:
+            self.release_key(request, idempotency_key)
+            messages.error(request, f'Ocorreu um erro durante a finalização da compra: {e}')
+            return redirect('cart:detail')
+        except Exception as e:
+            self.release_key(request, idempotency_key)
+            logger.error(f"Checkout failed for user {user.id}: {e}")
+            messages.error(request, 'Ocorreu um problema técnico. Por favor, tente novamente mais tarde.')
+            return redirect('cart:detail')
+
+        if idempotency_key:
+            idempotency.save_result(CHECKOUT_IDEMPOTENCY_SCOPE, user.id, idempotency_key,
+                                    {'payment_id': payment.id})
+        response = redirect(reverse('payments:payment_detail', kwargs={'payment_id': payment.id}))
+        save_cart(response, {})  # Clear the cart
+        messages.success(request, "Compra finalizada com sucesso!")
+        return response
+
+    @staticmethod
+    def replay_payment(request, idempotency_key):
+        result = idempotency.get_result(CHECKOUT_IDEMPOTENCY_SCOPE, request.user.id, idempotency_key)
+        if not isinstance(result, dict):
+            messages.info(request, "Sua compra já está sendo processada.")
+            return redirect('payments:payment_list')
+        response = redirect(reverse('payments:payment_detail', kwargs={'payment_id': result['payment_id']}))
+        save_cart(response, {})  # The first submission already emptied the cart
+        return response
+
+    @staticmethod
+    def release_key(request, idempotency_key):
+        if idempotency_key:
+            idempotency.release(CHECKOUT_IDEMPOTENCY_SCOPE, request.user.id, idempotency_key)
+
+
 @method_decorator(strict_rate_limit(url_names=['orders:order_list']), name='dispatch')
 class UserOrderListView(LoginRequiredMixin, TemplateView):
     template_name = 'orders/order_list.html'
@@ -81,20 +180,11 @@ class UserOrderListView(LoginRequiredMixin, TemplateView):
 
     @staticmethod
     def get_staff_orders(search_query):
-        orders = Order.objects.select_related('customer').prefetch_related('items').order_by('-id')
-        if search_query:
-            orders = orders.filter(
-                Q(id__icontains=search_query) |
-                Q(status__icontains=search_query) |
-                Q(customer__first_name__icontains=search_query) |
-                Q(customer__last_name__icontains=search_query) |
-                Q(customer__email__icontains=search_query) |
-                Q(customer__username__icontains=search_query)
-            )
-        return orders
+        orders = Order.objects.search(search_query) if search_query else Order.objects.all()
+        return orders.select_related('customer').order_by('-id')
 
     def get_user_orders(self, search_query):
-        orders_dict = Order.objects.get_cached_payments(customer=self.request.user)
+        orders_dict = Order.objects.get_cached_orders(customer=self.request.user)
         orders = [value for _, value in sorted(orders_dict.items(), reverse=True)]
         if search_query:
             orders = [order for order in orders
@@ -102,10 +192,9 @@ class UserOrderListView(LoginRequiredMixin, TemplateView):
         return orders
 
     def paginate_orders(self, orders):
-        paginator = Paginator(orders, 10)
-        paginator._count = len(list(orders))
-        page_number = self.request.GET.get('page')
-        return paginator.get_page(page_number)
+        # Keyset pagination on '-id': every page costs one LIMIT query, without counting the table
+        paginator = KeysetPaginator(per_page=10)
+        return paginator.get_page(orders, self.request.GET.get('cursor'))
 
 
 @method_decorator(strict_rate_limit(url_names=['orders:order_detail']), name='dispatch')
@@ -121,9 +210,9 @@ class UserOrderDetailView(LoginRequiredMixin, TemplateView):
         if not order_id:
             raise Http404('Página não encontrada')
 
-        # Fetch the cached order
+        # Fetch the cached order, already scoped to the user and falling back to the archive
         order = Order.objects.get_cached_order(order_id=order_id, customer=user)
-        if (not user.is_staff and order.customer.pk != user.pk) or not order:
+        if not order:
             raise Http404('Página não encontrada')
 
         # Add order to the context
@@ -137,9 +226,27 @@ class PaymentCreateView(LoginRequiredMixin, FormView):
     form_class = PaymentForm
     success_url = reverse_lazy('payments:payment_list')
 
+    def get_initial(self):
+        initial = super().get_initial()
+        initial['idempotency_key'] = idempotency.new_idempotency_key()
+        return initial
+
     def form_valid(self, form):
         user = self.request.user
         order_id = self.kwargs.get('order_id')
+
+        # A repeated submission of the same form returns the payment created by the first one
+        idempotency_key = form.cleaned_data.get('idempotency_key')
+        if not idempotency.is_valid_key(idempotency_key):
+            idempotency_key = None
+        elif not idempotency.claim(PAYMENT_IDEMPOTENCY_SCOPE, user.id, idempotency_key):
+            result = idempotency.get_result(PAYMENT_IDEMPOTENCY_SCOPE, user.id, idempotency_key)
+            if isinstance(result, dict):
+                self.kwargs['payment_id'] = result['payment_id']
+            else:
+                messages.info(self.request, "Seu pagamento já está sendo processado.")
+            return super().form_valid(form)
+
         order = Order.objects.select_related('customer').prefetch_related(Prefetch(
             'items',queryset=Item.objects.select_related('product__role_type',
                                                                 'product__stock'))
@@ -159,6 +266,9 @@ class PaymentCreateView(LoginRequiredMixin, FormView):
             if isinstance(payment, Payment):
                 payment_id = payment.id
                 payment_service.bulk_create_histories()
+                if idempotency_key:
+                    idempotency.save_result(PAYMENT_IDEMPOTENCY_SCOPE, user.id, idempotency_key,
+                                            {'payment_id': payment_id})
 
                 self.kwargs['payment_id'] = payment_id
                 messages.success(self.request, "Pagamento criado com sucesso!")
@@ -166,10 +276,14 @@ class PaymentCreateView(LoginRequiredMixin, FormView):
                 raise Exception('Um erro ocorreu criando o pagamento.')
 
         except ValidationError as e:
+            if idempotency_key:
+                idempotency.release(PAYMENT_IDEMPOTENCY_SCOPE, user.id, idempotency_key)
             messages.error(self.request, f"Criação do pagamento falhou, motivo: {e}")
             return self.form_invalid(form)
 
         except Exception:
+            if idempotency_key:
+                idempotency.release(PAYMENT_IDEMPOTENCY_SCOPE, user.id, idempotency_key)
             messages.error(self.request, "Ocorreu um erro ao criar o pagamento!")
 
         return super().form_valid(form)
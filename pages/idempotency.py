@@ -0,0 +1,49 @@
+import re
+import uuid
+
+from django.core.cache import cache
+
+IDEMPOTENCY_TIMEOUT = 60 * 10  # 10 minutes
+IN_PROGRESS = 'in_progress'
+
+_KEY_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def new_idempotency_key():
+    """
+    Token rendered into the forms, one per form render.
+    """
+    return uuid.uuid4().hex
+
+
+def is_valid_key(key):
+    return bool(key) and bool(_KEY_RE.match(key))
+
+
+def get_cache_key(scope, user_id, key):
+    return f"idempotency_{scope}_{user_id}_{key}"
+
+
+def claim(scope, user_id, key):
+    """
+    Atomically marks the key as in progress, returns False if it was already submitted.
+    """
+    return cache.add(get_cache_key(scope, user_id, key), IN_PROGRESS, IDEMPOTENCY_TIMEOUT)
+
+
+def get_result(scope, user_id, key):
+    """
+    Returns the stored result of a submission, IN_PROGRESS while it runs, or None.
+    """
+    return cache.get(get_cache_key(scope, user_id, key))
+
+
+def save_result(scope, user_id, key, result):
+    cache.set(get_cache_key(scope, user_id, key), result, IDEMPOTENCY_TIMEOUT)
+
+
+def release(scope, user_id, key):
+    """
+    Forgets a failed submission, so the user can retry with the same form.
+    """
+    cache.delete(get_cache_key(scope, user_id, key))
@@ -0,0 +1,93 @@
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+
+_local = threading.local()
+
+
+def _get_state():
+    if not hasattr(_local, 'pending'):
+        _local.pending = set()  # Dirtied inside transactions, deleted on commit
+        _local.deferred = set()  # Dirtied outside transactions inside a scope, deleted when it ends
+        _local.scopes = 0
+    return _local
+
+
+def _flush_registered(connection):
+    # Django drops the callbacks of rolled back savepoints and transactions, without one the pending keys are stale
+    return any(entry[1] is flush for entry in connection.run_on_commit)
+
+
+def mark_dirty(*keys):
+    """
+    Buffers cache keys whose data changed, they are deleted together once the current transaction commits.
+    Outside a transaction they are deleted at the end of the invalidation scope, or right away without one.
+    The keys of a rolled back transaction are never rewritten with its data.
+    """
+    state = _get_state()
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        if not _flush_registered(connection):
+            state.pending.clear()
+        state.pending.update(keys)
+        # Registered on every call, a rolled back savepoint only drops its own callbacks.
+        # The first callback empties the buffer and the others find nothing, a commit costs one delete_many
+        transaction.on_commit(flush)
+    else:
+        state.deferred.update(keys)
+        if not state.scopes:
+            flush()
+
+
+def is_dirty(key):
+    """
+    Tells if the key has a pending invalidation, its readers must go to the database and not cache the result.
+    """
+    state = _get_state()
+    if key in state.deferred:
+        return True
+    if key in state.pending:
+        connection = transaction.get_connection()
+        return connection.in_atomic_block and _flush_registered(connection)
+    return False
+
+
+def flush():
+    state = _get_state()
+    keys = state.pending | state.deferred
+    state.pending.clear()
+    state.deferred.clear()
+    if keys:
+        cache.delete_many(list(keys))
+
+
+class invalidation_scope:
+    """
+    Defers the invalidations made outside transactions until the scope ends, nested scopes flush with the outermost.
+    """
+
+    def __enter__(self):
+        _get_state().scopes += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        state = _get_state()
+        state.scopes -= 1
+        if not state.scopes and state.deferred:
+            keys = list(state.deferred)
+            state.deferred.clear()
+            cache.delete_many(keys)
+
+
+class CacheInvalidationMiddleware:
+    """
+    One invalidation scope per request, the keys dirtied by the request outside transactions are deleted once.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with invalidation_scope():
+            return self.get_response(request)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Order, Item
+from orders.services import ORDER_EXPORT_FIELDS, ITEM_EXPORT_FIELDS
+from pages.exports import EXPORT_FORMATS, EXPORT_CHUNK_SIZE, iter_export_lines
+from payments.models import Payment
+from payments.services import PAYMENT_EXPORT_FIELDS
+
+EXPORTS = {
+    'orders': (Order.objects, ORDER_EXPORT_FIELDS),
+    'items': (Item.objects, ITEM_EXPORT_FIELDS),
+    'payments': (Payment.objects, PAYMENT_EXPORT_FIELDS),
+}
+
+
+class Command(BaseCommand):
+    help = "Exporta pedidos, itens ou pagamentos em CSV ou JSONL, lendo o banco em blocos."
+
+    def add_arguments(self, parser):
+        parser.add_argument('data', choices=EXPORTS.keys(), help="Dados que serão exportados.")
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv', help="Formato da exportação.")
+        parser.add_argument('--output', default='-', help="Arquivo de saída, '-' para a saída padrão.")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help="Quantidade de linhas lidas do banco por vez.")
+
+    def handle(self, *args, **options):
+        manager, fields = EXPORTS[options['data']]
+        lines = iter_export_lines(manager.all(), fields, options['format'], options['chunk_size'])
+
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            output.writelines(lines)
+        self.stderr.write(self.style.SUCCESS(f"Exportação salva em {options['output']}."))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Order
+from payments.models import Payment
+
+
+class Command(BaseCommand):
+    help = "Reconstrói os termos de busca dos pedidos e pagamentos usados na pesquisa da staff."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Quantidade de registros reindexados por vez.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        orders = Order.objects.select_related('customer')
+        payments = Payment.objects.select_related('customer', 'payment_method')
+
+        total_orders = self._rebuild(Order.objects, orders, batch_size)
+        total_payments = self._rebuild(Payment.objects, payments, batch_size)
+        self.stdout.write(self.style.SUCCESS(
+            f"{total_orders} pedidos e {total_payments} pagamentos reindexados."
+        ))
+
+    @staticmethod
+    def _rebuild(manager, queryset, batch_size):
+        last_id, total = 0, 0
+        while True:
+            batch = list(queryset.filter(id__gt=last_id).order_by('id')[:batch_size])
+            if not batch:
+                return total
+            manager.update_search_tokens(batch)
+            total += len(batch)
+            last_id = batch[-1].id
@@ -94,6 +94,9 @@ class GeneralRateLimitMiddleware(RateLimitMiddlewareBase):
             response = self.get_response(request)
             return response
 
+        if request.path.startswith(tuple(getattr(settings, 'RATE_LIMIT_EXEMPT_PATHS', ()))):
+            return self.get_response(request)
+
         ip = request.META.get('REMOTE_ADDR', 'unknown')
         hashed_ip = hash_ip(ip)
 
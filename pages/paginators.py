@@ -0,0 +1,125 @@
+from collections.abc import Sequence
+
+from django.core import signing
+from django.db.models import QuerySet
+
+CURSOR_SALT = 'pages.paginators.cursor'
+NEXT, PREVIOUS = 'n', 'p'
+
+
+def encode_cursor(direction, pivot):
+    """
+    Builds an opaque, signed token pointing before/after the given id.
+    """
+    return signing.dumps({'d': direction, 'id': pivot}, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(token):
+    """
+    Returns (direction, pivot) from a token, or (None, None) for missing or tampered tokens.
+    """
+    if not token:
+        return None, None
+    try:
+        data = signing.loads(token, salt=CURSOR_SALT)
+        direction, pivot = data['d'], int(data['id'])
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        return None, None
+    if direction not in (NEXT, PREVIOUS):
+        return None, None
+    return direction, pivot
+
+
+def window_covers(item_ids, token, per_page):
+    """
+    Tells if a cached window of the most recent ids holds the whole keyset page asked by the token.
+    """
+    direction, pivot = decode_cursor(token)
+    if direction == NEXT:
+        # The page plus the row telling if there is a next one must be older than the pivot and cached
+        return sum(1 for item_id in item_ids if item_id < pivot) > per_page
+    if direction == PREVIOUS:
+        # Everything newer than the oldest cached item is in the window
+        return bool(item_ids) and pivot >= min(item_ids)
+    return len(item_ids) > per_page
+
+
+def get_item_id(item):
+    return item['id'] if isinstance(item, dict) else item.id
+
+
+class KeysetPage(Sequence):
+    """
+    A page of results plus the tokens for its neighbour pages, without any total count.
+    """
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Cursor based pagination over '-id' ordering.
+    Works with querysets (one LIMIT query per page, no COUNT) and with lists already sorted by '-id',
+    like the cached dicts of orders, payments and histories.
+    """
+
+    def __init__(self, per_page=10):
+        self.per_page = per_page
+
+    def get_page(self, object_list, token=None):
+        direction, pivot = decode_cursor(token)
+        if isinstance(object_list, QuerySet):
+            rows = self._slice_queryset(object_list, direction, pivot)
+        else:
+            rows = self._slice_list(object_list, direction, pivot)
+
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == PREVIOUS:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, direction == NEXT
+
+        if not rows:
+            return KeysetPage([])
+        return KeysetPage(
+            rows,
+            next_cursor=encode_cursor(NEXT, get_item_id(rows[-1])) if has_next else None,
+            previous_cursor=encode_cursor(PREVIOUS, get_item_id(rows[0])) if has_previous else None,
+        )
+
+    def _slice_queryset(self, queryset, direction, pivot):
+        if direction == PREVIOUS:
+            queryset = queryset.filter(id__gt=pivot).order_by('id')
+        elif direction == NEXT:
+            queryset = queryset.filter(id__lt=pivot).order_by('-id')
+        else:
+            queryset = queryset.order_by('-id')
+        return list(queryset[:self.per_page + 1])
+
+    def _slice_list(self, items, direction, pivot):
+        if direction == PREVIOUS:
+            newer = [item for item in items if get_item_id(item) > pivot]
+            return newer[::-1][:self.per_page + 1]
+        if direction == NEXT:
+            items = [item for item in items if get_item_id(item) < pivot]
+        return list(items[:self.per_page + 1])
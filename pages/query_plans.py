@@ -0,0 +1,63 @@
+import re
+
+from django.db import connections, transaction
+
+# Plan lines of a table read without any index, and of a sort made after reading the rows
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'\bSCAN (\w+)$', re.MULTILINE),
+    'postgresql': re.compile(r'\bSeq Scan on (\w+)'),
+}
+SORT_PATTERNS = {
+    'sqlite': re.compile(r'USE TEMP B-TREE FOR (?:ORDER BY|RIGHT PART OF ORDER BY)'),
+    'postgresql': re.compile(r'^\s*(?:->\s*)?(?:Incremental )?Sort\b', re.MULTILINE),
+}
+
+
+def explain(queryset) -> str:
+    """
+    Execution plan of the queryset on its database.
+    PostgreSQL plans the small test tables with sequential scans, so they are disabled while explaining,
+    the plan then shows the index the query would use on a large table.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.explain()
+    with transaction.atomic(using=queryset.db):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+
+def get_index_name(model, fields):
+    """
+    Name of the Meta index of the model on the given fields, auto generated names included.
+    """
+    for index in model._meta.indexes:
+        if list(index.fields) == list(fields):
+            return index.name
+    raise LookupError(f"{model.__name__} has no index on {fields}.")
+
+
+class QueryPlanAssertionsMixin:
+    """
+    TestCase assertions on the plan of the hot queries, so a change that drops their index fails the suite.
+    """
+
+    def _plan(self, queryset):
+        vendor = connections[queryset.db].vendor
+        if vendor not in FULL_SCAN_PATTERNS:
+            self.skipTest(f"No query plan assertions for {vendor}.")
+        return vendor, explain(queryset)
+
+    def assertUsesIndex(self, queryset, index_name):
+        vendor, plan = self._plan(queryset)
+        self.assertIn(index_name, plan, f"The query doesn't use {index_name}:\n{plan}")
+        self.assertFalse(FULL_SCAN_PATTERNS[vendor].findall(plan), f"The query scans a whole table:\n{plan}")
+
+    def assertNoFullScan(self, queryset):
+        vendor, plan = self._plan(queryset)
+        self.assertFalse(FULL_SCAN_PATTERNS[vendor].findall(plan), f"The query scans a whole table:\n{plan}")
+
+    def assertNoSort(self, queryset):
+        vendor, plan = self._plan(queryset)
+        self.assertFalse(SORT_PATTERNS[vendor].search(plan), f"The rows are sorted after being read:\n{plan}")
@@ -0,0 +1,40 @@
+import re
+import unicodedata
+
+TOKEN_MAX_LENGTH = 64
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def normalize(text):
+    """
+    Lowercases and strips accents, so 'Pedido Cancelado' and 'pedido cancelado' match.
+    """
+    text = unicodedata.normalize('NFKD', str(text))
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def search_tokens(*values):
+    """
+    Splits the given values into the set of normalized words stored in the search side tables.
+    """
+    tokens = set()
+    for value in values:
+        if value is None or value == '':
+            continue
+        tokens.update(word[:TOKEN_MAX_LENGTH] for word in _WORD_RE.findall(normalize(value)))
+    return tokens
+
+
+def query_terms(query):
+    """
+    Normalized words of a search query, every one of them must prefix-match a stored token.
+    """
+    return [word[:TOKEN_MAX_LENGTH] for word in _WORD_RE.findall(normalize(query or ''))]
+
+
+def touches_fields(created, update_fields, fields):
+    """
+    Tells if a post_save changed any of the given fields, used to skip needless reindexing.
+    """
+    return created or update_fields is None or bool(set(update_fields) & set(fields))
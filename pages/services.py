@@ -3,10 +3,10 @@ from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.conf import settings
 
 from products.models import Promotion
-from users.models import User, Role
+from users.models import User
 from .models import About
 from .serializers import AboutSerializer
-from users.serializers import UserSerializer
+from users.serializers import serialize_user
 
 
 def get_user_data(current_user, target_user_id):
@@ -22,13 +22,10 @@ def get_user_data(current_user, target_user_id):
     user_data = cache.get(cache_key)
 
     if user_data is None:
-        target_user = User.objects.Prefetch(
-                'roles',
-                queryset=Role.objects.select_related('role_type'),
-            ).get(id=target_user_id)
+        # The roles come from User.active_roles, and the manager get would refuse the inactive users staff may see
+        target_user = User.objects.filter(pk=target_user_id).get()
         # If data is not in the cache, serialize and cache it
-        serializer = UserSerializer(target_user, context={'request': current_user})
-        user_data = serializer.data
+        user_data = serialize_user(target_user, current_user)
         cache.set(cache_key, user_data, timeout=getattr(settings, 'CACHE_TIMEOUT', (60 * 60 * 24 * 7)))
 
     if not user_data['is_active'] and not current_user.is_staff:
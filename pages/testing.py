@@ -0,0 +1,51 @@
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from products.models import Category, Product, Stock
+from users.models import User
+
+
+class CacheClearingTestCase(TestCase):
+    """
+    Clears the cache after every test, the database rolls back but the entries written by a test would stay.
+    """
+
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
+
+
+class BuyerTestCase(CacheClearingTestCase):
+    """
+    Creates a buyer before every test, logged in with 'buyer' / 'testpass'.
+    Fixtures are not built in setUpTestData, the on_commit callbacks captured there stay registered for the whole class
+    and the keys dirtied by the tests would never be flushed.
+    """
+
+    def setUp(self):
+        super().setUp()
+        # The keys dirtied by the creation are deleted now, otherwise the test would start with the user cache bypassed
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user(username='buyer', password='testpass')
+
+
+class SalesTestCase(BuyerTestCase):
+    """
+    Buyer, category and a product at 10.00 shared by the sales tests, stock_units adds a stock row to the product.
+    """
+    stock_units = None
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='Categoria')
+        self.product = Product.objects.create(name='Produto', category=self.category, price=Decimal('10.00'))
+        if self.stock_units is not None:
+            self.stock = Stock.objects.create(product=self.product, units=self.stock_units)
+
+    def items(self, quantity=1, product=None):
+        """
+        Cart of a single product, in the format of create_order and checkout.
+        """
+        return [{'slug': (product or self.product).slug, 'quantity': quantity}]
@@ -1 +1,66 @@
+import json
+from io import StringIO
+from urllib.parse import parse_qs
 
+from django.core.management import call_command
+from django.template.loader import render_to_string
+from django.test import RequestFactory, SimpleTestCase
+
+from orders.services import ORDER_EXPORT_FIELDS, create_order
+from .paginators import KeysetPaginator
+from .testing import SalesTestCase
+
+
+class KeysetPaginatorTests(SimpleTestCase):
+    def setUp(self):
+        self.items = [{'id': item_id} for item_id in range(25, 0, -1)]
+        self.paginator = KeysetPaginator(per_page=10)
+
+    def ids(self, page):
+        return [item['id'] for item in page]
+
+    def test_walks_forward_and_back(self):
+        first = self.paginator.get_page(self.items)
+        self.assertEqual(self.ids(first), list(range(25, 15, -1)))
+        self.assertFalse(first.has_previous())
+
+        second = self.paginator.get_page(self.items, first.next_cursor)
+        self.assertEqual(self.ids(second), list(range(15, 5, -1)))
+
+        last = self.paginator.get_page(self.items, second.next_cursor)
+        self.assertEqual(self.ids(last), list(range(5, 0, -1)))
+        self.assertFalse(last.has_next())
+
+        back = self.paginator.get_page(self.items, last.previous_cursor)
+        self.assertEqual(self.ids(back), self.ids(second))
+        self.assertTrue(back.has_previous())
+
+    def test_tampered_cursor_falls_back_to_first_page(self):
+        page = self.paginator.get_page(self.items, 'not-a-cursor')
+        self.assertEqual(self.ids(page), list(range(25, 15, -1)))
+
+    def test_links_keep_the_query_string_encoded(self):
+        request = RequestFactory().get('/', {'search': 'a&b #1+c=d', 'cursor': 'old'})
+        page = self.paginator.get_page(self.items)
+        html = render_to_string('cursor_pagination.html', {'page': page, 'request': request})
+        href = html.split('href="?', 1)[1].split('"', 1)[0].replace('&amp;', '&')
+        self.assertEqual(parse_qs(href), {'search': ['a&b #1+c=d'], 'cursor': [page.next_cursor]})
+
+
+class ExportSalesTests(SalesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.order = create_order(self.user, self.items(3))
+
+    def test_orders_csv(self):
+        out = StringIO()
+        call_command('export_sales', 'orders', stdout=out)
+        header, row = out.getvalue().splitlines()
+        self.assertEqual(header.split(','), ORDER_EXPORT_FIELDS)
+        self.assertTrue(row.startswith(f'{self.order.id},{self.user.id},buyer,aguardando,False,30.00,3,'))
+
+    def test_items_jsonl(self):
+        out = StringIO()
+        call_command('export_sales', 'items', '--format', 'jsonl', stdout=out)
+        item = json.loads(out.getvalue())
+        self.assertEqual((item['order_id'], item['quantity'], item['price']), (self.order.id, 3, '10.00'))
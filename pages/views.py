@@ -1,6 +1,6 @@
 from django.http import Http404
 from django.views.generic import TemplateView
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 
 from legaldocs.models import TermOfService, PrivacyPolicy, ReturnPolicy
 from .services import get_user_data, get_abouts, get_promotions
@@ -42,9 +42,14 @@ class ProfilePageView(TemplateView):
         # Ensure the user is authenticated
         if not user.is_authenticated:
             raise PermissionDenied("You must be logged in to view this profile.")
-        user_data = get_user_data(user, target_user_id)
-        # Allow only the profile owner or staff members to view the profile
-        if (user.id != target_user_id and not user.is_staff) or not user_data:
+        # Allow only the profile owner or staff members to view the profile, checked before loading it
+        if user.id != target_user_id and not user.is_staff:
+            raise PermissionDenied("You do not have permission to view this profile.")
+        try:
+            user_data = get_user_data(user, target_user_id)
+        except ObjectDoesNotExist:
+            raise Http404('Não foi possível encontrar esta página')
+        if not user_data:
             raise PermissionDenied("You do not have permission to view this profile.")
 
         # Fetch the profile data using the helper function (from cache or database)
@@ -1,5 +1,10 @@
-from django.contrib import admin
-from .models import ExternalApiResponse, PaymentMethod, Payment, PaymentPromotionCode
+from django.contrib import admin, messages
+
+from pages.exports import CSV, JSONL, streaming_export_response
+from .models import (ExternalApiResponse, GatewayCharge, PaymentMethod, Payment, PaymentPromotionCode, PaymentStatus,
+                     WebhookEvent)
+from .services import PAYMENT_EXPORT_FIELDS
+from .transitions import bulk_transition
 
 
 @admin.register(ExternalApiResponse)
@@ -10,6 +15,26 @@ class ExternalApiResponseAdmin(admin.ModelAdmin):
     ordering = ['-created']
 
 
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ['transaction_id', 'provider', 'payment_id', 'status', 'processed', 'failed', 'attempts',
+                    'created', 'modified']
+    list_filter = ['provider', 'processed', 'failed']
+    search_fields = ['transaction_id', 'payment_id']
+    readonly_fields = ['created', 'modified']  # Keep timestamps read-only
+    ordering = ['-created']
+
+
+@admin.register(GatewayCharge)
+class GatewayChargeAdmin(admin.ModelAdmin):
+    list_display = ['payment', 'processed', 'attempts', 'available_at', 'created', 'modified']
+    list_filter = ['processed']
+    search_fields = ['payment__id']
+    raw_id_fields = ['payment']
+    readonly_fields = ['created', 'modified']  # Keep timestamps read-only
+    ordering = ['-created']
+
+
 @admin.register(PaymentMethod)
 class PaymentMethodAdmin(admin.ModelAdmin):
     list_display = ['name', 'payment_type', 'created', 'modified']
@@ -18,6 +43,11 @@ class PaymentMethodAdmin(admin.ModelAdmin):
     autocomplete_fields = ['response']  # Improve response field search
     ordering = ['name']
 
+    def has_change_permission(self, request, obj=None):
+        # Payments without an external response share one row per payment type,
+        # editing it would change every payment pointing to it
+        return False
+
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
@@ -27,12 +57,37 @@ class PaymentAdmin(admin.ModelAdmin):
     autocomplete_fields = ['customer', 'order', 'payment_method']
     readonly_fields = ['created', 'modified']  # Keep timestamps read-only
     ordering = ['-created']
+    actions = ['refund_payments', 'cancel_payments', 'export_payments_csv', 'export_payments_jsonl']
 
     def get_queryset(self, request):
         # Optimize queryset for performance by using select_related and prefetch_related
         queryset = super().get_queryset(request)
         return queryset.select_related('customer', 'order', 'payment_method')
 
+    @admin.action(description='Reembolsar pagamentos completos selecionados')
+    def refund_payments(self, request, queryset):
+        report = bulk_transition(queryset.values_list('id', flat=True), PaymentStatus.REFUNDED)
+        self.report_transition(request, report, 'reembolsados')
+
+    @admin.action(description='Cancelar pagamentos pendentes selecionados')
+    def cancel_payments(self, request, queryset):
+        report = bulk_transition(queryset.values_list('id', flat=True), PaymentStatus.CANCELLED)
+        self.report_transition(request, report, 'cancelados')
+
+    def report_transition(self, request, report, verb):
+        self.message_user(request, f"{report['transitioned']} pagamentos {verb}.", messages.SUCCESS)
+        if report['skipped']:
+            self.message_user(request, f"{report['skipped']} pagamentos ignorados, o estado atual não permite a ação.",
+                              messages.WARNING)
+
+    @admin.action(description='Exportar pagamentos selecionados (CSV)')
+    def export_payments_csv(self, request, queryset):
+        return streaming_export_response(queryset, PAYMENT_EXPORT_FIELDS, 'pagamentos', CSV)
+
+    @admin.action(description='Exportar pagamentos selecionados (JSONL)')
+    def export_payments_jsonl(self, request, queryset):
+        return streaming_export_response(queryset, PAYMENT_EXPORT_FIELDS, 'pagamentos', JSONL)
+
 
 @admin.register(PaymentPromotionCode)
 class PaymentPromotionCodeAdmin(admin.ModelAdmin):
@@ -14,6 +14,7 @@ class PaymentForm(forms.Form):
         required=False,
         widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Cupons (Separados por Vírgula)'})
     )
+    idempotency_key = forms.CharField(required=False, widget=forms.HiddenInput)
 
     def clean_promo_codes(self):
         codes = self.cleaned_data.get('promo_codes')
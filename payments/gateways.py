@@ -0,0 +1,276 @@
+import abc
+import asyncio
+import http.client
+import json
+import logging
+import queue
+import threading
+import uuid
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import GatewayCharge, PaymentStatus
+from .workers import BatchWorker
+
+logger = logging.getLogger('celery')
+
+APPROVED, PENDING, DECLINED = 'approved', 'pending', 'declined'
+
+
+class GatewayError(Exception):
+    """
+    The gateway could not be reached or answered with an error, the payment stays pending.
+    """
+
+
+class GatewayResult:
+    def __init__(self, transaction_id, status, data=None):
+        self.transaction_id = transaction_id
+        self.status = status
+        self.data = data or {}
+
+    def as_event(self, provider, payment_id):
+        """
+        Same shape as a webhook event, so the result goes through the webhook batch processing.
+        """
+        return {'provider': provider, 'transaction_id': self.transaction_id, 'payment_id': payment_id,
+                'status': self.status, 'data': {**self.data, 'transaction_id': self.transaction_id,
+                                                'status': self.status}}
+
+
+class PooledHTTPClient:
+    """
+    Keep-alive HTTP(S) connections to one host, at most pool_size at a time, every call bounded by timeout.
+    Thread safe, so it is shared by the whole process.
+    """
+
+    def __init__(self, base_url, timeout=10, pool_size=10, headers=None):
+        parsed = urlsplit(base_url)
+        self.secure = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/json', 'Accept': 'application/json', **(headers or {})}
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _new_connection(self):
+        connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise GatewayError(f"No free connection to {self.host} after {self.timeout}s.")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+
+    def _release(self, connection, reusable):
+        if reusable:
+            try:
+                self._idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        else:
+            connection.close()
+        self._slots.release()
+
+    def request_json(self, method, path, payload=None, headers=None):
+        """
+        :return: The response status and its decoded JSON body.
+        :raise GatewayError: On network errors, timeouts, server errors or invalid JSON.
+        """
+        connection = self._acquire()
+        reusable = False
+        try:
+            body = json.dumps(payload).encode() if payload is not None else None
+            connection.request(method, self.base_path + path, body=body, headers={**self.headers, **(headers or {})})
+            response = connection.getresponse()
+            content = response.read()
+            reusable = not response.will_close
+            if response.status >= 500:
+                raise GatewayError(f"{self.host} answered {response.status}.")
+            return response.status, json.loads(content or b'{}')
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            raise GatewayError(f"Request to {self.host} failed: {e}") from e
+        finally:
+            self._release(connection, reusable)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class BaseGateway(abc.ABC):
+    """
+    Adapter interface of a payment provider.
+    """
+    name = None
+
+    @abc.abstractmethod
+    def charge(self, payment) -> GatewayResult:
+        """
+        Blocking call to the provider, run by the charge worker.
+
+        :raise GatewayError: When the provider can't be reached or refuses the charge.
+        """
+
+    async def acharge(self, payment) -> GatewayResult:
+        # The pooled client is blocking, async callers run it in a worker thread
+        return await asyncio.to_thread(self.charge, payment)
+
+
+class HTTPGateway(BaseGateway):
+    """
+    Generic JSON gateway: POST <base_url>/charges, answering {'transaction_id', 'status'}.
+    """
+
+    def __init__(self, name, base_url, api_key='', timeout=None, pool_size=None):
+        self.name = name
+        self.client = PooledHTTPClient(
+            base_url,
+            timeout=timeout or getattr(settings, 'PAYMENT_GATEWAY_TIMEOUT', 10),
+            pool_size=pool_size or getattr(settings, 'PAYMENT_GATEWAY_POOL_SIZE', 10),
+            headers={'Authorization': f'Bearer {api_key}'} if api_key else None,
+        )
+
+    def charge(self, payment):
+        status, data = self.client.request_json('POST', '/charges', {
+            'payment_id': payment.id,
+            'amount': str(payment.amount),
+            'payment_type': payment.payment_method.payment_type,
+        }, headers={'Idempotency-Key': f'payment-{payment.id}'})  # Retries never charge twice
+        if status >= 400 or not data.get('transaction_id'):
+            raise GatewayError(f"{self.name} refused payment #{payment.id}: {status} {data}")
+        return GatewayResult(str(data['transaction_id']), str(data.get('status', PENDING)).lower(), data)
+
+
+class FakeGateway(BaseGateway):
+    """
+    In-process gateway for tests and development, answers with a fixed outcome and records the charges.
+    """
+
+    def __init__(self, name='fake', outcome=APPROVED, error=None):
+        self.name = name
+        self.outcome = outcome
+        self.error = error
+        self.charges = []
+
+    def charge(self, payment):
+        self.charges.append(payment.id)
+        if self.error:
+            raise GatewayError(self.error)
+        return GatewayResult(f'{self.name}-{uuid.uuid4().hex}', self.outcome, {'amount': str(payment.amount)})
+
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+
+def get_gateway(payment_type):
+    """
+    Gateway configured for a payment type in settings.PAYMENT_GATEWAYS, or None for balance only types.
+    Instances are kept per process, so their connection pools are reused.
+    """
+    config = getattr(settings, 'PAYMENT_GATEWAYS', {}).get(payment_type)
+    if not config:
+        return None
+    with _gateways_lock:
+        if payment_type not in _gateways:
+            _gateways[payment_type] = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+        return _gateways[payment_type]
+
+
+def get_provider_payment_types(provider):
+    """
+    Payment types charged through the gateways named provider, the only payments its callbacks may change.
+    """
+    return {payment_type for payment_type in getattr(settings, 'PAYMENT_GATEWAYS', {})
+            if get_gateway(payment_type).name == provider}
+
+
+@receiver(setting_changed)
+def reset_gateways(setting, **kwargs):
+    if setting == 'PAYMENT_GATEWAYS':
+        with _gateways_lock:
+            _gateways.clear()
+
+
+def schedule_charge(payment):
+    """
+    Saves the charge with the payment, the charge worker calls the gateway once the transaction commits,
+    so neither the request nor a row lock waits for the network.
+    """
+    if get_gateway(payment.payment_method.payment_type) is not None:
+        GatewayCharge.objects.get_or_create(payment=payment)
+        transaction.on_commit(charge_worker.notify)
+
+
+def charge_payment(gateway, payment):
+    """
+    :return: The answer of the gateway, None when it failed and the charge is retried later.
+    """
+    try:
+        return gateway.charge(payment)
+    except GatewayError as e:
+        logger.error(f"Gateway {gateway.name} failed to charge payment {payment.id}: {e}")
+        return None
+
+
+def charge_pending_payments(batch_size=None) -> dict:
+    """
+    Claims the due charges batch by batch, pushing their next attempt forward, then calls the gateways
+    outside any transaction. The answers are saved as webhook events and applied by the webhook worker,
+    failed charges are retried up to PAYMENT_CHARGE_MAX_ATTEMPTS while their payment stays pending.
+
+    :return: Report with the charged and the failed payments.
+    """
+    from .webhooks import store_event, webhook_worker
+
+    batch_size = batch_size or getattr(settings, 'PAYMENT_WEBHOOK_BATCH_SIZE', 200)
+    retry_delay = timedelta(seconds=getattr(settings, 'PAYMENT_CHARGE_RETRY_DELAY', 60))
+    max_attempts = getattr(settings, 'PAYMENT_CHARGE_MAX_ATTEMPTS', 5)
+    charged, failed = 0, 0
+    while True:
+        with transaction.atomic():
+            charges = list(GatewayCharge.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+                processed=False, available_at__lte=timezone.now(), attempts__lt=max_attempts
+            ).select_related('payment__payment_method').order_by('available_at')[:batch_size])
+            if not charges:
+                break
+            GatewayCharge.objects.filter(id__in=[charge.id for charge in charges]).update(
+                available_at=timezone.now() + retry_delay, attempts=F('attempts') + 1)
+
+        for charge in charges:
+            payment = charge.payment
+            gateway = get_gateway(payment.payment_method.payment_type)
+            if payment.status != PaymentStatus.PENDING or gateway is None:
+                GatewayCharge.objects.filter(id=charge.id).update(processed=True)
+                continue
+            result = charge_payment(gateway, payment)
+            if result is None:
+                failed += 1
+                continue
+            with transaction.atomic():
+                store_event(result.as_event(gateway.name, payment.id))
+                GatewayCharge.objects.filter(id=charge.id).update(processed=True)
+            charged += 1
+    if charged:
+        webhook_worker.notify()
+    return {'charged': charged, 'failed': failed}
+
+
+charge_worker = BatchWorker('payment-charges', lambda: charge_pending_payments(), 'PAYMENT_CHARGE_WORKER')
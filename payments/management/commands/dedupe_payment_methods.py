@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from payments.services import dedupe_payment_methods
+
+
+class Command(BaseCommand):
+    help = ("Une os métodos de pagamento duplicados no registro canônico de cada tipo, "
+            "mantendo os que possuem resposta de API externa.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Quantidade de métodos duplicados unidos por transação.")
+
+    def handle(self, *args, **options):
+        report = dedupe_payment_methods(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['merged']} métodos de pagamento duplicados removidos ({report['duration']}s)."
+        ))
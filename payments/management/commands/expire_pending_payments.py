@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from payments.services import expire_pending_payments
+
+
+class Command(BaseCommand):
+    help = "Cancela os pagamentos pendentes com a reserva de estoque expirada, liberando as unidades reservadas."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help="Quantidade de pagamentos cancelados por transação.")
+
+    def handle(self, *args, **options):
+        report = expire_pending_payments(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['cancelled']} pagamentos cancelados em {report['batches']} lotes "
+            f"({report['failed']} falharam, {report['duration']}s)."
+        ))
@@ -1,13 +1,68 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models import Q
 from django.core.cache import cache
 from django.conf import settings
 
+from pages.invalidation import is_dirty, mark_dirty
+from pages.paginators import KeysetPaginator, window_covers
+from pages.search import query_terms
+
 User = get_user_model()
 
 
+class PaymentMethodManager(models.Manager):
+    CACHE_TIMEOUT = getattr(settings, 'HIGH_TIME_CACHE_TIMEOUT', 60 * 60 * 24 * 100)
+
+    @staticmethod
+    def get_cache_key(payment_type):
+        return f"payment_method_{payment_type}"
+
+    def canonical_queryset(self, payment_type):
+        """
+        Shared rows of a payment type: no customer name and no external API response.
+        """
+        # SQL IN never matches NULL, the empty and the NULL names are tested separately
+        return self.filter(Q(name='') | Q(name__isnull=True), payment_type=payment_type,
+                           response__isnull=True).order_by('id')
+
+    def get_canonical(self, payment_type):
+        """
+        Returns the shared row of a payment type from the cache, creating it once when missing.
+        """
+        cache_key = self.get_cache_key(payment_type)
+        payment_method = cache.get(cache_key)
+        if payment_method is None:
+            payment_method = (self.canonical_queryset(payment_type).first()
+                              or self.create(name='', payment_type=payment_type))
+            cache.set(cache_key, payment_method, timeout=self.CACHE_TIMEOUT)
+        return payment_method
+
+    def for_payment(self, payment_type, response=None):
+        """
+        Payments with an external API response keep their own row, the others share the canonical one.
+        """
+        if response is not None:
+            return self.create(name='', payment_type=payment_type, response=response)
+        return self.get_canonical(payment_type)
+
+    def clear_canonical_cache(self, payment_type=None, payment_method_id=None):
+        """
+        Drops the cached canonical rows, of every type by default.
+        With payment_method_id, only when that row is the cached one.
+        """
+        from .models import PaymentMethod
+        if payment_type and payment_method_id:
+            cached = cache.get(self.get_cache_key(payment_type))
+            if cached is not None and cached.pk != payment_method_id:
+                return
+        payment_types = [payment_type] if payment_type else [choice for choice, _ in PaymentMethod.PAYMENT_TYPE_CHOICES]
+        cache.delete_many([self.get_cache_key(choice) for choice in payment_types])
+
+
 class PaymentManager(models.Manager):
     CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+    CACHE_WINDOW = getattr(settings, 'PAYMENTS_CACHE_WINDOW', 50)
 
     def _get_prefetched_queryset(self):
         """
@@ -31,68 +86,120 @@ class PaymentManager(models.Manager):
 
     def get_cached_payments(self, customer):
         """
-        Retrieves cached payments or queries and caches them in bulk.
+        Retrieves the cached window of the customer's most recent payments, or queries and caches it.
+        Older payments are only read from the database, see get_payments_page and get_cached_payment.
         """
         from .serializers import PaymentSerializer
         cache_key = self.get_cache_key(customer.id)
-        cached_payments = cache.get(cache_key)
+        # A pending invalidation means uncommitted or not yet flushed changes, they are read but never cached
+        dirty = is_dirty(cache_key)
+        cached_payments = None if dirty else cache.get(cache_key)
 
         if cached_payments is None:
-            payments = self._get_prefetched_queryset().filter(customer=customer).order_by('-id')
+            payments = self._get_prefetched_queryset().filter(customer=customer).order_by('-id')[:self.CACHE_WINDOW]
             cached_payments = {
                 payment.id: PaymentSerializer(payment).data
                 for payment in payments
             }
-            cache.set(cache_key, cached_payments, timeout=self.CACHE_TIMEOUT)
+            if not dirty:
+                cache.set(cache_key, cached_payments, timeout=self.CACHE_TIMEOUT)
 
         return cached_payments
 
     def get_cached_payment(self, payment_id, customer):
         """
-        Retrieves a single cached payment or fetches it from the database.
+        Retrieves a single payment from the cached window, or from the database when it is older.
         """
-        cache_key = self.get_cache_key(customer.id)
-        cached_payments = cache.get(cache_key)
-
-        if not cached_payments:
-            cached_payments = self.get_cached_payments(customer)
-
-        payment = cached_payments.get(payment_id)
+        from .serializers import PaymentSerializer
+        payment = self.get_cached_payments(customer).get(payment_id)
         if not payment:
-            # Fetch from DB and cache it
             payment_instance = self._get_prefetched_queryset().filter(customer=customer, id=payment_id).first()
             if payment_instance:
-                payment = self._cache_single_payment(payment_instance)
+                payment = PaymentSerializer(payment_instance).data
 
         return payment
 
-    def _cache_single_payment(self, payment_instance):
+    def get_payments_page(self, customer, token=None, per_page=10, search_query=''):
         """
-        Caches a single payment into the bulk cache.
+        Keyset page of the customer's payments, sliced from the cached window while it holds the whole page
+        and read from the database past it, so page 1 never queries and the cache size stays bounded.
+        Searches always go through the database.
         """
         from .serializers import PaymentSerializer
-        cache_key = self.get_cache_key(payment_instance.customer.id)
-        cached_payments = self.get_cached_payments(payment_instance.customer)
-
-        payment_data = PaymentSerializer(payment_instance).data
-        cached_payments[payment_instance.id] = payment_data
-        cache.set(cache_key, cached_payments, timeout=self.CACHE_TIMEOUT)
-
-        return payment_data
+        paginator = KeysetPaginator(per_page=per_page)
+        if search_query:
+            # Searches always run the indexed search, so a query matches the same payments whatever the window holds
+            queryset = self.search(search_query).filter(customer=customer)
+        else:
+            window = self.get_cached_payments(customer)
+            complete = len(window) < self.CACHE_WINDOW  # The customer has no payments beyond the window
+            if complete or window_covers(window, token, per_page):
+                return paginator.get_page([value for _, value in sorted(window.items(), reverse=True)], token)
+            queryset = self.filter(customer=customer)
+
+        page = paginator.get_page(queryset.select_related('customer', 'order', 'payment_method')
+                                  .prefetch_related('used_coupons'), token)
+        page.object_list = PaymentSerializer(page.object_list, many=True).data
+        return page
 
     def update_cached_payment(self, payment):
         """
-        Updates or adds a payment to the cache.
+        Invalidates the payments cache of the customer once the change commits, the next read rebuilds it.
         """
-        self._cache_single_payment(payment)
+        mark_dirty(self.get_cache_key(payment.customer_id))
 
     def delete_cached_payment(self, payment):
         """
-        Removes a payment from the cache.
+        Invalidates the payments cache of the customer once the deletion commits.
+        """
+        mark_dirty(self.get_cache_key(payment.customer_id))
+
+    def delete_cached_payments_for(self, customer_ids):
+        """
+        Invalidates the payments cache of many customers at once, used after set-based updates that skip the signals.
         """
-        cache_key = self.get_cache_key(payment.customer.id)
-        cached_payments = cache.get(cache_key) or {}
+        mark_dirty(*[self.get_cache_key(customer_id) for customer_id in set(customer_ids)])
 
-        if payment.id in cached_payments:
-            del cached_payments[payment.id]
-            cache.set(cache_key, cached_payments, timeout=self.CACHE_TIMEOUT)
+    def search(self, query):
+        """
+        Staff search: exact id when the query is numeric, otherwise every word must prefix-match
+        an indexed token of the payment (id, status, method, customer name, email and username).
+        """
+        from .models import PaymentSearchToken
+        query = (query or '').strip()
+        if query.isdigit():
+            return self.filter(id=int(query))
+
+        payments = self.all()
+        for term in query_terms(query):
+            payments = payments.filter(
+                id__in=PaymentSearchToken.objects.filter(token__startswith=term).values('payment_id')
+            )
+        return payments
+
+    def update_search_tokens(self, payments):
+        """
+        Rewrites the search tokens of the given payments, their customers and methods must be loaded.
+        """
+        from .models import PaymentSearchToken
+        payments = list(payments)
+        PaymentSearchToken.objects.filter(payment__in=payments).delete()
+        PaymentSearchToken.objects.bulk_create(
+            [PaymentSearchToken(payment=payment, token=token)
+             for payment in payments for token in payment.get_search_tokens()],
+            ignore_conflicts=True,
+        )
+
+    def reindex_customer(self, customer_id, chunk_size=500):
+        """
+        Rewrites the search tokens of every payment of a customer, used when the customer data changes.
+        """
+        payments = self.filter(customer_id=customer_id).select_related('customer', 'payment_method').order_by('id')
+        batch = []
+        for payment in payments.iterator(chunk_size=chunk_size):
+            batch.append(payment)
+            if len(batch) >= chunk_size:
+                self.update_search_tokens(batch)
+                batch = []
+        if batch:
+            self.update_search_tokens(batch)
@@ -2,15 +2,18 @@ from operator import attrgetter
 
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 from decimal import Decimal
 
+from model_utils import FieldTracker
 from model_utils.models import TimeStampedModel, SoftDeletableModel
 
 from orders.models import Order
-from payments.managers import PaymentManager
+from pages.search import search_tokens, TOKEN_MAX_LENGTH
+from payments.managers import PaymentManager, PaymentMethodManager
 from products.models import PromotionCode
 
 User = get_user_model()
@@ -23,7 +26,7 @@ class ExternalApiResponse(TimeStampedModel):
         null=True,
         blank=True,
         verbose_name="Transaction ID",
-        db_index=True
+        unique=True
     )
     response_data = models.JSONField(null=True, blank=True)
 
@@ -35,6 +38,35 @@ class ExternalApiResponse(TimeStampedModel):
         verbose_name_plural = "External API Responses"
 
 
+class WebhookEvent(TimeStampedModel):
+    """
+    Provider callback saved before it is acknowledged, one row per transaction, applied later by the webhook worker.
+    """
+    provider = models.CharField(max_length=50, verbose_name="Provedor")
+    transaction_id = models.CharField(max_length=100, unique=True, verbose_name="Transaction ID")
+    payment_id = models.BigIntegerField(verbose_name="Pagamento")
+    status = models.CharField(max_length=50, verbose_name="Status")
+    data = models.JSONField(verbose_name="Dados")
+    processed = models.BooleanField(default=False, verbose_name="Processado")
+    failed = models.BooleanField(default=False, verbose_name="Falhou")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="Tentativas")
+
+    def __str__(self):
+        return f"Webhook {self.provider} of Transaction {self.transaction_id}"
+
+    class Meta:
+        verbose_name = "Webhook Event"
+        verbose_name_plural = "Webhook Events"
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(processed=False, failed=False),
+                         name='webhook_event_pending'),
+        ]
+
+    def as_event(self):
+        return {'provider': self.provider, 'transaction_id': self.transaction_id, 'payment_id': self.payment_id,
+                'status': self.status, 'data': self.data}
+
+
 class PaymentMethod(TimeStampedModel):
     """Model representing a method of payment."""
     PAYMENT_TYPE_CHOICES = [
@@ -64,6 +96,8 @@ class PaymentMethod(TimeStampedModel):
         related_name="payment_methods"
     )
 
+    objects = PaymentMethodManager()
+
     class Meta:
         verbose_name = "Método de pagamento"
         verbose_name_plural = "Métodos de pagamento"
@@ -91,7 +125,8 @@ class Payment(TimeStampedModel, SoftDeletableModel):
         related_name="payments",
         verbose_name="Cliente",
         on_delete=models.SET_NULL,
-        null=True
+        null=True,
+        db_index=False  # Indexed by the (customer, -id) composite
     )
     order = models.ForeignKey(
         Order,
@@ -100,6 +135,12 @@ class Payment(TimeStampedModel, SoftDeletableModel):
         on_delete=models.SET_NULL,
         null=True
     )
+    archived_order_id = models.BigIntegerField(
+        verbose_name="Pedido arquivado",
+        null=True,
+        blank=True,
+        help_text="ID do pedido quando ele foi movido para o arquivo."
+    )
     payment_method = models.ForeignKey(
         PaymentMethod,
         verbose_name="Método de pagamento",
@@ -118,6 +159,12 @@ class Payment(TimeStampedModel, SoftDeletableModel):
         default=PaymentStatus.PENDING,
         verbose_name="Estado do pagamento"
     )
+    reserved_until = models.DateTimeField(
+        verbose_name="Reserva do estoque até",
+        null=True,
+        blank=True,
+        help_text="Enquanto pendente, o estoque do pedido fica reservado até esta data."
+    )
     used_coupons = models.ManyToManyField(
         PromotionCode,
         through='PaymentPromotionCode',
@@ -127,20 +174,33 @@ class Payment(TimeStampedModel, SoftDeletableModel):
     )
 
     objects = PaymentManager()
+    # Status loaded from the database, so transitions are detected without reading the row again
+    tracker = FieldTracker(fields=['status'])
 
     class Meta:
         verbose_name = "Pagamento"
         verbose_name_plural = "Pagamentos"
         indexes = [
             models.Index(fields=['status']),
-            models.Index(fields=['customer']),
+            # Per customer listings, newest first
+            models.Index(fields=['customer', '-id']),
             models.Index(fields=['order']),
             models.Index(fields=['modified']),
+            models.Index(fields=['status', 'reserved_until']),
         ]
 
     def __str__(self):
         return f'Pagamento #{self.id}'
 
+    def get_search_tokens(self):
+        customer = self.customer
+        payment_method = self.payment_method
+        return search_tokens(
+            self.id, self.status, self.get_status_display(),
+            payment_method.name, payment_method.payment_type, payment_method.get_payment_type_display(),
+            *((customer.first_name, customer.last_name, customer.email, customer.username) if customer else ())
+        )
+
     def clean(self):
         super().clean()
         if self.amount <= 0:
@@ -149,45 +209,70 @@ class Payment(TimeStampedModel, SoftDeletableModel):
 
     def verify(self):
         if self.pk:
-            previous_status = Payment.objects.get(pk=self.pk).status
-            if self.status == PaymentStatus.PENDING and previous_status == PaymentStatus.COMPLETED:
-                raise ValidationError('You cannot change a "COMPLETED" payment to "PENDING".')
-            if self.status != previous_status and previous_status in {PaymentStatus.FAILED, PaymentStatus.REFUNDED}:
-                raise ValidationError('You cannot change a "FAILED" or "REFUNDED" payment status.')
+            from payments.transitions import get_transition
+            previous_status = self.tracker.previous('status')
+            if self.status != previous_status:
+                get_transition(previous_status, self.status)
 
     def save(self, *args, **kwargs):
-        # Standard save with default_service or new changes
-        if kwargs.pop('default_service', False):
+        # Standard save with default_service, new payments or unchanged status
+        if kwargs.pop('default_service', False) or not self.pk or not self.tracker.has_changed('status'):
             super().save(*args, **kwargs)
             return
 
-        # If it was saved by another service, like django admin, it will update based in the
-        # previous_status and new_status
-        previous_status = None
-        if self.pk:
-            previous_status = Payment.objects.get(pk=self.pk).status
+        # If it was saved by another service, like django admin, it will run the transition from the
+        # previous_status to the new status, the locked row is the only read of the transition
+        from payments.services import PaymentService
+        from payments.transitions import get_transition
+        with transaction.atomic():
+            payment = Payment.objects.select_for_update().select_related('customer', 'order').get(id=self.id)
+            previous_status = self.tracker.previous('status')
+            if payment.status != previous_status:
+                raise ValidationError('O estado do pagamento foi alterado por outro processo, recarregue a página.')
 
-        # Handle status transitions if status has changed
-        if previous_status != self.status:
-            from payments.services import PaymentService
-            payment = Payment.objects.select_for_update().get(id=self.id)
+            transition = get_transition(previous_status, self.status)
             payment_service = PaymentService(payment)
-            try:
-                if previous_status == PaymentStatus.PENDING and self.status == PaymentStatus.COMPLETED:
-                    payment_service.finish_successful_payment()
-                elif previous_status == PaymentStatus.COMPLETED and self.status == PaymentStatus.REFUNDED:
-                    payment_service.process_payment_status()
-                elif previous_status == PaymentStatus.PENDING and (self.status == PaymentStatus.CANCELLED
-                                                                   or self.status == PaymentStatus.FAILED):
-                    payment_service.process_payment_status(new_status=self.status)
-            except Exception as e:
-                raise e
-            finally:
-                payment_service.bulk_create_histories()
-                return
-
-        # Execute the standard save if no service transition occurred
-        super().save(*args, **kwargs)
+            # Errors propagate and roll back the transition, histories included
+            transition.run(payment_service)
+            payment_service.bulk_create_histories()
+
+
+class GatewayCharge(TimeStampedModel):
+    """
+    Charge of a payment saved with it, made by the charge worker outside the request and its transaction.
+    """
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, related_name='gateway_charge',
+                                   verbose_name="Pagamento")
+    processed = models.BooleanField(default=False, verbose_name="Processado")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="Tentativas")
+    available_at = models.DateTimeField(default=timezone.now, verbose_name="Disponível em")
+
+    def __str__(self):
+        return f"Charge of Payment {self.payment_id}"
+
+    class Meta:
+        verbose_name = "Gateway Charge"
+        verbose_name_plural = "Gateway Charges"
+        indexes = [
+            models.Index(fields=['available_at'], condition=models.Q(processed=False), name='gateway_charge_pending'),
+        ]
+
+
+class PaymentSearchToken(models.Model):
+    """
+    Normalized words of a payment, its method and its customer, kept on save for the staff search.
+    """
+    payment = models.ForeignKey(Payment, verbose_name="Pagamento", related_name="search_tokens",
+                                on_delete=models.CASCADE)
+    token = models.CharField(verbose_name="Termo", max_length=TOKEN_MAX_LENGTH, db_index=True)
+
+    class Meta:
+        verbose_name = "termo de busca de pagamento"
+        verbose_name_plural = "termos de busca de pagamentos"
+
+        constraints = [
+            models.UniqueConstraint(fields=['payment', 'token'], name='unique_payment_search_token')
+        ]
 
 
 class PaymentPromotionCode(models.Model):
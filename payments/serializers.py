@@ -35,4 +35,5 @@ class PaymentSerializer(serializers.ModelSerializer):
         return coupons_dict
 
     def get_order(self, obj):
-        return obj.order.id
+        # Archived orders leave the order FK null, the id is kept in archived_order_id
+        return obj.order_id or obj.archived_order_id
@@ -1,21 +1,51 @@
 import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import transaction
+from django.db.models import Q, Prefetch, prefetch_related_objects
 from django.core.exceptions import ValidationError
 from decimal import Decimal
 
 from django.urls import reverse
 from django.utils import timezone
 
+from .gateways import schedule_charge
 from .models import Payment, PaymentPromotionCode, PaymentStatus, PaymentMethod
-from products.models import PromotionCode
-from orders.models import Order
+from products.models import PromotionCode, Stock
+from orders.models import Order, Item
 from users.models import Role, UserHistory
 
 User = get_user_model()
 logger = logging.getLogger('celery')
 
+PAYMENT_EXPORT_FIELDS = ['id', 'customer_id', 'customer__username', 'order_id', 'payment_method__payment_type',
+                         'amount', 'status', 'created', 'modified']
+
+
+_role_grants = threading.local()
+
+
+class batched_role_grants:
+    """
+    Collects the roles bought by the payments completed inside it, granted with one Role.objects.grant on exit.
+    Must run inside the transaction of those payments, so they never commit without their roles.
+    """
+
+    def __enter__(self):
+        self.previous = getattr(_role_grants, 'batch', None)
+        self.grants = _role_grants.batch = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _role_grants.batch = self.previous
+        if exc_type is None:
+            Role.objects.grant(self.grants)
+
 
 class PaymentService:
     """
@@ -63,6 +93,9 @@ class PaymentService:
                 self._update_stock()
 
             self._finalize_payment(final_total_price)
+            if self.payment.status == PaymentStatus.PENDING:
+                # What the balance didn't cover goes to the gateway of the payment type, after the commit
+                schedule_charge(self.payment)
 
             return self.payment
         except ValidationError as e:
@@ -99,20 +132,20 @@ class PaymentService:
             raise ValidationError("Pedido cancelado.")
 
     def _get_order_info(self):
+        # The order keeps its total persisted, the items are only needed for stock and discounts
         order_items = self.order.items.all()
-        total_price = sum(item.get_total_price() for item in order_items)
-        return Decimal(total_price), order_items
+        return Decimal(self.order.total_amount), order_items
 
     def _create_payment(self):
-        payment_method = PaymentMethod.objects.create(
-            name='', payment_type=self.payment_type
-        )
+        # Shared row per payment type, cached, instead of one INSERT per payment
+        payment_method = PaymentMethod.objects.for_payment(self.payment_type)
         payment = Payment(
             status=PaymentStatus.PENDING,
             customer=self.user,
             order=self.order,
             amount=self.total_price,
             payment_method=payment_method,
+            reserved_until=timezone.now() + get_reservation_ttl(),
         )
         # Para não causar problemas é criado um objeto primeiro depois salva o objeto com o default_service
         payment.save(default_service=True)
@@ -151,21 +184,36 @@ class PaymentService:
         return discount
 
     def _update_stock(self):
+        # Reserves the units of every item at once, instead of locking and saving one stock per item
+        quantities = Counter()
         for item in self.order_items:
             stock = getattr(item.product, 'stock', None)
             if stock:
-                if not stock.can_sell(item.quantity):
-                    self._cancel_payment_order()
-                    raise ValidationError(f"O produto {item.product.name}, não está disponível no momento.")
-                stock.sell(product=item.product, quantity=item.quantity)
+                quantities[stock.id] += item.quantity
+        try:
+            Stock.hold_units(quantities)
+        except ValidationError:
+            self._cancel_payment_order()
+            raise
 
     def _finalize_payment(self, final_total_price):
         user_balance_check = self.user.pay_with_balance(self.payment)
         if user_balance_check[0]:
             self.history_to_create.append(user_balance_check[1])
             self.finish_successful_payment()
-        elif Decimal(self.payment.amount) != Decimal(final_total_price - user_balance_check[1]):
-            self.payment.amount = Decimal(final_total_price - user_balance_check[1])
+            return
+
+        balance = Decimal(user_balance_check[1])
+        if balance <= 0:
+            return
+        # The balance part is debited with the reduced amount, the gateway only charges the rest
+        with transaction.atomic():
+            history = self.user.pay_part_with_balance(self.payment, balance)
+            if history is None:
+                # Spent meanwhile by another payment, the gateway charges the whole amount
+                return
+            self.history_to_create.append(history)
+            self.payment.amount = Decimal(final_total_price - balance)
             self.payment.save(update_fields=['amount'], default_service=True)
 
     def _append_user_history(self, user_history_type, user=None):
@@ -190,19 +238,18 @@ class PaymentService:
         order.save(update_fields=['status'])
 
     @staticmethod
-    def _process_role_product(user, product):
+    def grant_roles(grants):
         """
-        Handles assigning or extending roles for role products.
+        Assigns or extends the roles bought, set-wise, each user cache is invalidated once.
+
+        :param grants: Iterable of (user_id, role_type), one per role item bought.
+        :return: The created and the extended roles, nothing inside batched_role_grants where they are deferred.
         """
-        existing_role = Role.objects.filter(user=user, role_type=product.role_type).first()
-        if existing_role:
-            if existing_role.is_expired():
-                existing_role.expires_at = timezone.now() + product.role_type.effective_days
-            else:
-                existing_role.expires_at += product.role_type.effective_days
-            existing_role.save(update_fields=['expires_at'])
-        else:
-            Role.objects.create(user=user, role_type=product.role_type)
+        batch = getattr(_role_grants, 'batch', None)
+        if batch is not None:
+            batch.extend(grants)
+            return [], []
+        return Role.objects.grant(grants)
 
     def _finish_successful_payment(self):
         """
@@ -219,17 +266,19 @@ class PaymentService:
                 order_items = self.order_items or order.items.select_related(
                     'product', 'product__stock', 'product__role_type').all()
 
+                role_grants = []
                 for item in order_items:
                     product = item.product
 
                     if product.is_role:
                         if not product.is_role_product():
                             raise Exception(f'The {product.slug} is marked as a role, but its not')
-                        self._process_role_product(user, product)
+                        role_grants.append((user.id, product.role_type))
 
                     stock = getattr(product, 'stock', None)
                     if stock:
                         stock.successful_sell(product=product, quantity=item.quantity)
+                self.grant_roles(role_grants)
         except Exception as e:
             logger.error(f"Error finalizing payment {self.payment.id}: {e}")
             self.process_payment_status(items=order_items, new_status=PaymentStatus.REFUNDED)
@@ -249,25 +298,23 @@ class PaymentService:
         self._append_user_history(UserHistory.payment_success, user=order.customer)
 
 
-    def _process_payment_status(self, items=None, new_status=None, _save=True):
+    def _process_payment_status(self, items=None, new_status=None, _save=True, restore_stock=True):
         from orders.models import Order
+        from .transitions import DEFAULT_TARGETS, return_partial_balances
 
         def determine_new_status(payment):
-            if payment.status == PaymentStatus.COMPLETED:
-                return PaymentStatus.REFUNDED
-            elif payment.status == PaymentStatus.PENDING:
-                return PaymentStatus.CANCELLED
+            if payment.status in DEFAULT_TARGETS:
+                return DEFAULT_TARGETS[payment.status]
             raise Exception(f"Wrong payment status: {payment.status}. It's only possible to update "
-                                  f"{PaymentStatus.PENDING} -> {PaymentStatus.CANCELLED} or "
-                                  f"{PaymentStatus.COMPLETED} -> {PaymentStatus.REFUNDED}.")
+                            f"{', '.join(f'{source} -> {target}' for source, target in DEFAULT_TARGETS.items())}.")
 
         new_status = new_status or determine_new_status(self.payment)
         try:
             with transaction.atomic():
-                # Refund or restore items in order
+                # Refund or restore items in order, callers that release stock in bulk skip it
                 order_items = items or self.payment.order.items.select_related('product', 'product__stock',
                                                                                'product__role_type').all()
-                for item in order_items:
+                for item in (order_items if restore_stock else []):
                     stock = getattr(item.product, 'stock', None)
                     if stock:
                         stock.restore(
@@ -281,14 +328,17 @@ class PaymentService:
                 self.payment.order.save(update_fields=['status', 'is_paid'])
 
                 # Handle coupon restoration
-                for payment_code in self.payment.used_coupons.all():
-                    payment_code.promotion_code.restore_usage(user=self.payment.customer)
+                for promotion_code in self.payment.used_coupons.all():
+                    promotion_code.restore_usage(user=self.payment.customer)
 
                 if _save:
                     # Update payment status
                     self.payment.status = new_status
                     self.payment.save(update_fields=['status'], default_service=True)
 
+                # The balance part of a partly paid payment goes back whatever the new status
+                return_partial_balances([self.payment], self.history_to_create)
+
                 # If payment was refunded, refund to user's balance
                 if new_status == PaymentStatus.REFUNDED:
                     refund_history = self.payment.customer.refund_to_balance(self.payment)
@@ -303,9 +353,132 @@ class PaymentService:
             raise ValidationError("An error occurred while processing the payment refund.")
 
     def bulk_create_histories(self):
-        UserHistory.objects.bulk_create(self.history_to_create)
+        UserHistory.objects.bulk_append(self.history_to_create)
         self.history_to_create = []
 
 
+def checkout(user: User, items_data: list, payment_type, promo_codes: list = None) -> Payment:
+    """
+    Creates the order from the cart items and its payment in a single transaction, reusing create_order and
+    PaymentService. The order items are loaded once with their products, stocks and roles,
+    so the number of queries does not grow with the number of items.
+
+    :param user: User checking out.
+    :param items_data: List of {'slug', 'quantity'} built from the cart.
+    :param payment_type: Payment method type.
+    :param promo_codes: List of promotion codes (optional).
+    :return: The created Payment object, nothing is kept if any step fails.
+    """
+    from orders.services import create_order
+
+    # The signals only mark the order and payment caches dirty, they are deleted once on commit
+    # and a rolled back checkout leaves them untouched
+    with transaction.atomic():
+        order = create_order(user=user, items_data=items_data)
+        prefetch_related_objects([order], Prefetch(
+            'items', queryset=Item.objects.select_related('product__stock', 'product__role_type')))
+
+        payment_service = PaymentService()
+        payment = payment_service.create_payment(user=user, order=order, payment_type=payment_type,
+                                                 promo_codes=promo_codes)
+        payment_service.bulk_create_histories()
+    return payment
+
+
+def get_reservation_ttl() -> timedelta:
+    return timedelta(seconds=getattr(settings, 'PENDING_PAYMENT_EXPIRATION_TIME', 60 * 30))
+
+
+def expire_pending_payments(batch_size: int = 200) -> dict:
+    """
+    Cancels pending payments whose stock reservation expired, releasing the held units.
+    Each batch locks its payments with skip_locked, runs them through PaymentService._process_payment_status
+    and releases the holds of the whole batch with a single stock UPDATE.
+
+    :param batch_size: Payments locked and cancelled per transaction.
+    :return: Report with the cancelled and failed payments, processed batches and the duration in seconds.
+    """
+    started_at = time.monotonic()
+    now = timezone.now()
+    expired = (Q(reserved_until__lte=now) |
+               Q(reserved_until__isnull=True, created__lte=now - get_reservation_ttl()))
+    cancelled, failed_ids, batches = 0, [], 0
+
+    while True:
+        with transaction.atomic():
+            payments = list(
+                Payment.objects.select_for_update(skip_locked=True, of=('self',))
+                .filter(expired, status=PaymentStatus.PENDING, order__isnull=False)
+                .exclude(id__in=failed_ids)
+                .select_related('customer', 'order')
+                .order_by('id')[:batch_size]
+            )
+            if not payments:
+                break
+
+            items_by_order = defaultdict(list)
+            for item in Item.objects.filter(order_id__in=[payment.order_id for payment in payments]
+                                            ).select_related('product', 'product__stock', 'product__role_type'):
+                items_by_order[item.order_id].append(item)
+
+            held = Counter()
+            histories = []
+            for payment in payments:
+                payment_service = PaymentService(payment)
+                items = items_by_order[payment.order_id]
+                try:
+                    payment_service._process_payment_status(items=items, new_status=PaymentStatus.CANCELLED,
+                                                            restore_stock=False)
+                except ValidationError:
+                    failed_ids.append(payment.id)
+                    continue
+                for item in items:
+                    stock = getattr(item.product, 'stock', None)
+                    if stock:
+                        held[stock.id] += item.quantity
+                histories.extend(payment_service.history_to_create)
+                cancelled += 1
+
+            Stock.release_holds(held)
+            UserHistory.objects.bulk_append(histories)
+        batches += 1
+
+    report = {'cancelled': cancelled, 'failed': len(failed_ids), 'batches': batches,
+              'duration': round(time.monotonic() - started_at, 3)}
+    logger.info(f"Cancelled {cancelled} expired pending payments in {batches} batches "
+                f"({report['failed']} failed, {report['duration']}s).")
+    return report
+
+
+def dedupe_payment_methods(batch_size: int = 1000) -> dict:
+    """
+    Points payments to the canonical PaymentMethod of their type and deletes the duplicated rows,
+    left by the old flow that created one row per payment. Rows with an external API response are kept.
+
+    :param batch_size: Duplicated rows merged per transaction.
+    :return: Report with the merged rows and the duration in seconds.
+    """
+    started_at = time.monotonic()
+    merged = 0
+    for payment_type, _ in PaymentMethod.PAYMENT_TYPE_CHOICES:
+        canonical = PaymentMethod.objects.canonical_queryset(payment_type).first()
+        if canonical is None:
+            continue
+        while True:
+            with transaction.atomic():
+                duplicate_ids = list(PaymentMethod.objects.canonical_queryset(payment_type).exclude(
+                    id=canonical.id).values_list('id', flat=True)[:batch_size])
+                if not duplicate_ids:
+                    break
+                Payment._base_manager.filter(payment_method_id__in=duplicate_ids).update(payment_method=canonical)
+                PaymentMethod.objects.filter(id__in=duplicate_ids).delete()
+            merged += len(duplicate_ids)
+
+    PaymentMethod.objects.clear_canonical_cache()
+    report = {'merged': merged, 'duration': round(time.monotonic() - started_at, 3)}
+    logger.info(f"Merged {merged} duplicated payment methods ({report['duration']}s).")
+    return report
+
+
 def payments_cache_key_builder(user_id):
     return f'payments_{user_id}_dict'
@@ -1,24 +1,42 @@
+from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 
-from .models import Payment, PaymentStatus
+from pages.search import touches_fields
+from .models import Payment, PaymentStatus, PaymentMethod
 from .services import PaymentService
 
+User = get_user_model()
+
+SEARCH_FIELDS = ('status', 'customer', 'payment_method')
+CUSTOMER_SEARCH_FIELDS = ('first_name', 'last_name', 'email', 'username')
+
 
 @receiver(post_save, sender=Payment)
-def update_payment_cache(sender, instance, **kwargs):
+def update_payment_cache(sender, instance, created=False, update_fields=None, **kwargs):
     """
-    Update the cache when a Payment is created or updated.
+    Invalidate the cached payments of the customer when a Payment is created or updated.
     """
     Payment.objects.update_cached_payment(instance)
+    if touches_fields(created, update_fields, SEARCH_FIELDS):
+        Payment.objects.update_search_tokens([instance])
+
+
+@receiver(post_save, sender=User)
+def customer_post_change(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    Keep the payments search tokens in line with the customer name, email and username.
+    """
+    if not created and touches_fields(created, update_fields, CUSTOMER_SEARCH_FIELDS):
+        Payment.objects.reindex_customer(instance.pk)
 
 
 @receiver(post_delete, sender=Payment)
 def delete_payment_cache(sender, instance, **kwargs):
     """
-    Remove the Payment from cache when deleted.
+    Invalidate the cached payments of the customer when a Payment is deleted.
     """
     Payment.objects.delete_cached_payment(instance)
 
@@ -32,3 +50,12 @@ def payment_pre_delete(sender, instance, **kwargs):
             payment_service.bulk_create_histories()
     except ValidationError:
         pass
+
+
+@receiver(post_save, sender=PaymentMethod)
+@receiver(post_delete, sender=PaymentMethod)
+def payment_method_changed(sender, instance, **kwargs):
+    """
+    Forget the cached canonical row when it changes, it is looked up again on the next payment.
+    """
+    PaymentMethod.objects.clear_canonical_cache(instance.payment_type, payment_method_id=instance.pk)
@@ -1,3 +1,590 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from orders.models import Order
+from orders.services import create_order
+from pages.query_plans import QueryPlanAssertionsMixin, get_index_name
+from pages.testing import BuyerTestCase, SalesTestCase
+from products.models import Category, Product, Stock
+from users.models import Role, RoleType, User, UserHistory
+from .managers import PaymentManager
+from .models import ExternalApiResponse, GatewayCharge, Payment, PaymentMethod, PaymentStatus, WebhookEvent
+from .services import PaymentService, checkout, expire_pending_payments
+from .transitions import bulk_transition
+from .gateways import BaseGateway, PooledHTTPClient, charge_pending_payments, get_gateway
+from .webhooks import StubProvider, flush_webhook_events, process_webhook_events
+
+
+class ExpirePendingPaymentsTests(SalesTestCase):
+    stock_units = 5
+
+    def create_pending_payment(self, quantity=2):
+        order = create_order(self.user, self.items(quantity))
+        order = Order.objects.prefetch_related('items__product__stock').get(id=order.id)
+        payment = PaymentService().create_payment(user=self.user, order=order, payment_type='user_balance')
+        self.assertEqual(payment.status, PaymentStatus.PENDING)
+        return payment
+
+    def test_expired_reservations_are_cancelled_and_released(self):
+        expired = self.create_pending_payment(quantity=2)
+        active = self.create_pending_payment(quantity=1)
+        Payment.objects.filter(id=expired.id).update(reserved_until=timezone.now() - timedelta(minutes=1))
+
+        report = expire_pending_payments(batch_size=1)
+
+        self.assertEqual(report['cancelled'], 1)
+        self.assertEqual(Payment.objects.get(id=expired.id).status, PaymentStatus.CANCELLED)
+        self.assertEqual(Payment.objects.get(id=active.id).status, PaymentStatus.PENDING)
+        self.assertEqual(Order.objects.get(id=expired.order_id).status, Order.Cancelled)
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.units, self.stock.units_hold), (4, 1))
+
+
+class PaymentStatusTransitionTests(SalesTestCase):
+    stock_units = 5
+
+    def setUp(self):
+        super().setUp()
+        self.payment = checkout(self.user, self.items(2), payment_type='user_balance')
+
+    def test_status_change_costs_one_locked_read(self):
+        payment = Payment.objects.get(id=self.payment.id)
+        payment.status = PaymentStatus.CANCELLED
+        with CaptureQueriesContext(connection) as queries:
+            payment.full_clean()
+            payment.save()
+
+        payment_reads = [query['sql'] for query in queries.captured_queries
+                         if query['sql'].startswith('SELECT') and 'FROM "payments_payment"' in query['sql']]
+        self.assertEqual(len(payment_reads), 1)
+        self.assertEqual(Payment.objects.get(id=self.payment.id).status, PaymentStatus.CANCELLED)
+        self.assertEqual(Stock.objects.get(product=self.product).units, 5)
+
+    def test_completed_payment_cannot_go_back_to_pending(self):
+        Payment.objects.filter(id=self.payment.id).update(status=PaymentStatus.COMPLETED)
+        payment = Payment.objects.get(id=self.payment.id)
+        payment.status = PaymentStatus.PENDING
+        with self.assertRaises(ValidationError):
+            payment.full_clean()
+
+    def test_stale_instance_does_not_transition(self):
+        payment = Payment.objects.get(id=self.payment.id)
+        Payment.objects.filter(id=self.payment.id).update(status=PaymentStatus.FAILED)
+        payment.status = PaymentStatus.CANCELLED
+        with self.assertRaises(ValidationError):
+            payment.save()
+
+    def test_transition_errors_propagate(self):
+        payment = Payment.objects.get(id=self.payment.id)
+        payment.status = PaymentStatus.CANCELLED
+        with mock.patch.object(PaymentService, 'process_payment_status', side_effect=ValidationError('falhou')):
+            with self.assertRaises(ValidationError):
+                payment.save()
+        self.assertEqual(Payment.objects.get(id=self.payment.id).status, PaymentStatus.PENDING)
+
+
+class BulkTransitionTests(SalesTestCase):
+    stock_units = 10
+
+    def buy(self, quantity):
+        return checkout(self.user, self.items(quantity), payment_type='user_balance')
+
+    def test_mass_cancel_releases_held_stock(self):
+        payments = [self.buy(2), self.buy(3)]
+        self.assertEqual(Stock.objects.get(product=self.product).units_hold, 5)
+
+        report = bulk_transition([payment.id for payment in payments], PaymentStatus.CANCELLED)
+
+        self.assertEqual(report, {'transitioned': 2, 'skipped': 0})
+        stock = Stock.objects.get(product=self.product)
+        self.assertEqual((stock.units, stock.units_hold), (10, 0))
+        self.assertFalse(Order.objects.exclude(status=Order.Cancelled).exists())
+        self.assertEqual(set(Payment.objects.values_list('status', flat=True)), {PaymentStatus.CANCELLED})
+
+    def test_mass_refund_credits_balance_and_skips_pending(self):
+        User.objects.filter(id=self.user.id).update(balance=Decimal('20.00'))
+        self.user.refresh_from_db()
+        completed = self.buy(2)
+        self.assertEqual(completed.status, PaymentStatus.COMPLETED)
+        pending = self.buy(1)
+
+        report = bulk_transition([completed.id, pending.id], PaymentStatus.REFUNDED)
+
+        self.assertEqual(report, {'transitioned': 1, 'skipped': 1})
+        self.assertEqual(self.user.get_balance(), Decimal('20.00'))
+        stock = Stock.objects.get(product=self.product)
+        self.assertEqual((stock.units, stock.units_sold, stock.units_hold), (9, 0, 1))
+        self.assertEqual(Payment.objects.get(id=pending.id).status, PaymentStatus.PENDING)
+
+    def test_unknown_target_is_rejected(self):
+        with self.assertRaises(ValueError):
+            bulk_transition([], PaymentStatus.COMPLETED)
+
+
+class RoleGrantTests(BuyerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vip = RoleType.objects.create(name='VIP', price=Decimal('10.00'), icon='star')
+        self.gold = RoleType.objects.create(name='Gold', price=Decimal('10.00'), icon='crown')
+
+    def test_roles_are_granted_and_extended_set_wise(self):
+        active = Role.objects.create(user=self.user, role_type=self.vip)
+        other = User.objects.create_user(username='other', password='testpass')
+        expired = Role.objects.create(user=other, role_type=self.vip)
+        Role.objects.filter(pk=expired.pk).update(expires_at=timezone.now() - timedelta(days=3),
+                                                  status=Role.expired)
+
+        # Savepoint, locked read, UPDATE, INSERT, active roles read, snapshots UPDATE, release
+        with self.assertNumQueries(7):
+            created, extended = PaymentService.grant_roles([
+                (self.user.id, self.vip), (self.user.id, self.vip), (self.user.id, self.gold), (other.id, self.vip)])
+
+        self.assertEqual(len(created), 1)
+        self.assertEqual(len(extended), 2)
+        active_after = Role.objects.get(pk=active.pk)
+        self.assertEqual(active_after.expires_at, active.expires_at + 2 * self.vip.effective_days)
+        expired_after = Role.objects.get(pk=expired.pk)
+        self.assertEqual(expired_after.status, Role.active)
+        self.assertAlmostEqual(expired_after.expires_at, timezone.now() + self.vip.effective_days,
+                               delta=timedelta(seconds=5))
+        self.assertEqual(Role.objects.get(user=self.user, role_type=self.gold).status, Role.active)
+        self.assertEqual(User.objects.get(pk=self.user.pk).get_role_icon(),
+                         {self.vip.pk: 'star', self.gold.pk: 'crown'})
+
+    def test_completed_role_purchase_grants_the_role(self):
+        User.objects.filter(pk=self.user.pk).update(balance=Decimal('20.00'))
+        self.user.refresh_from_db()
+        product = Product.objects.create(role_type=self.vip, is_role=True)
+
+        for _ in range(2):
+            payment = checkout(self.user, [{'slug': product.slug, 'quantity': 1}], payment_type='user_balance')
+            self.assertEqual(payment.status, PaymentStatus.COMPLETED)
+
+        role = Role.objects.get(user=self.user, role_type=self.vip)
+        self.assertAlmostEqual(role.expires_at, timezone.now() + 2 * self.vip.effective_days,
+                               delta=timedelta(seconds=5))
+
+
+class PaymentCacheWindowTests(SalesTestCase):
+    stock_units = 20
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.payment_ids = [
+                checkout(self.user, self.items(), payment_type='user_balance').id
+                for _ in range(8)
+            ][::-1]
+        window = mock.patch.object(PaymentManager, 'CACHE_WINDOW', 5)
+        window.start()
+        self.addCleanup(window.stop)
+
+    def test_only_the_most_recent_payments_are_cached(self):
+        Payment.objects.get_cached_payments(self.user)
+        cached = cache.get(Payment.objects.get_cache_key(self.user.id))
+        self.assertEqual(sorted(cached, reverse=True), self.payment_ids[:5])
+
+    def test_pages_walk_past_the_window(self):
+        Payment.objects.get_cached_payments(self.user)
+        with self.assertNumQueries(0):
+            page = Payment.objects.get_payments_page(self.user, per_page=3)
+
+        seen = [payment['id'] for payment in page]
+        while page.has_next():
+            page = Payment.objects.get_payments_page(self.user, page.next_cursor, per_page=3)
+            seen += [payment['id'] for payment in page]
+        self.assertEqual(seen, self.payment_ids)
+
+        back = Payment.objects.get_payments_page(self.user, page.previous_cursor, per_page=3)
+        self.assertEqual([payment['id'] for payment in back], self.payment_ids[3:6])
+
+    def test_search_matches_the_same_payments_whatever_the_window_holds(self):
+        results = []
+        for window_size in (5, 50):
+            with mock.patch.object(PaymentManager, 'CACHE_WINDOW', window_size):
+                cache.clear()
+                results.append([[payment['id'] for payment in Payment.objects.get_payments_page(
+                    self.user, search_query=query)] for query in (str(self.payment_ids[1]), 'pend', 'ending')])
+        self.assertEqual(results, [[[self.payment_ids[1]], self.payment_ids[:10], []]] * 2)
+
+    def test_older_payment_detail_falls_back_to_the_database(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('payments:payment_detail', kwargs={'payment_id': self.payment_ids[-1]}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['payment']['id'], self.payment_ids[-1])
+
+        other = User.objects.create_user(username='other', password='testpass')
+        self.client.force_login(other)
+        response = self.client.get(reverse('payments:payment_detail', kwargs={'payment_id': self.payment_ids[0]}))
+        self.assertEqual(response.status_code, 404)
+
+
+class PaymentMethodInterningTests(SalesTestCase):
+    def test_payments_share_the_canonical_row(self):
+        first = checkout(self.user, self.items(), payment_type='paypal')
+        second = checkout(self.user, self.items(), payment_type='paypal')
+
+        self.assertEqual(first.payment_method_id, second.payment_method_id)
+        self.assertEqual(PaymentMethod.objects.filter(payment_type='paypal').count(), 1)
+
+    def test_external_responses_keep_their_own_row(self):
+        response = ExternalApiResponse.objects.create(transaction_id='tx-1')
+        canonical = PaymentMethod.objects.for_payment('credit_card')
+        own = PaymentMethod.objects.for_payment('credit_card', response=response)
+        self.assertNotEqual(canonical.id, own.id)
+        self.assertEqual(PaymentMethod.objects.for_payment('credit_card').id, canonical.id)
+
+    def test_rows_with_a_null_name_are_canonical(self):
+        legacy = PaymentMethod.objects.create(name=None, payment_type='bank_transfer')
+        self.assertEqual(PaymentMethod.objects.for_payment('bank_transfer').id, legacy.id)
+
+    def test_dedupe_command_merges_duplicates(self):
+        payment = checkout(self.user, self.items(), payment_type='paypal')
+        duplicate = PaymentMethod.objects.create(name='', payment_type='paypal')
+        Payment.objects.filter(id=payment.id).update(payment_method=duplicate)
+
+        call_command('dedupe_payment_methods', stdout=StringIO())
+
+        self.assertFalse(PaymentMethod.objects.filter(id=duplicate.id).exists())
+        self.assertEqual(Payment.objects.get(id=payment.id).payment_method_id,
+                         PaymentMethod.objects.get(payment_type='paypal').id)
+
+
+@override_settings(PAYMENT_WEBHOOK_SECRETS={'stub': 'segredo'}, PAYMENT_WEBHOOK_WORKER=False,
+                   PAYMENT_GATEWAYS={'credit_card': {'BACKEND': 'payments.gateways.FakeGateway',
+                                                     'OPTIONS': {'name': 'stub'}}},
+                   PAYMENT_CHARGE_WORKER=False)
+class PaymentWebhookTests(SalesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.payment = checkout(self.user, self.items(), payment_type='credit_card')
+        self.provider = StubProvider()
+        self.url = reverse('payments:webhook', kwargs={'provider': 'stub'})
+
+    def send(self, status, transaction_id, payment_id=None, **extra):
+        body, headers = self.provider.build_callback(payment_id or self.payment.id, status, transaction_id, **extra)
+        return self.client.post(self.url, body, content_type='application/json', **headers)
+
+    def test_callbacks_are_saved_then_applied_in_batch(self):
+        self.assertEqual(self.send('approved', 'tx-1').status_code, 202)
+        self.assertEqual(self.send('approved', 'tx-1').status_code, 202)
+        self.assertEqual(Payment.objects.get(id=self.payment.id).status, PaymentStatus.PENDING)
+        self.assertEqual(WebhookEvent.objects.filter(transaction_id='tx-1', processed=False).count(), 1)
+
+        report = flush_webhook_events()
+
+        self.assertEqual(report, {'processed': 1, 'failed': 0, 'batches': 1})
+        self.assertFalse(WebhookEvent.objects.filter(processed=False).exists())
+        self.assertEqual(ExternalApiResponse.objects.filter(transaction_id='tx-1').count(), 1)
+        payment = Payment.objects.select_related('payment_method__response').get(id=self.payment.id)
+        self.assertEqual(payment.status, PaymentStatus.COMPLETED)
+        self.assertEqual(payment.payment_method.response.transaction_id, 'tx-1')
+
+    def test_failed_callbacks_use_the_bulk_transition(self):
+        other = checkout(self.user, self.items(), payment_type='credit_card')
+        self.send('declined', 'tx-2')
+        self.send('declined', 'tx-3', payment_id=other.id)
+        flush_webhook_events()
+
+        self.assertEqual(set(Payment.objects.values_list('status', flat=True)), {PaymentStatus.FAILED})
+
+    @override_settings(PAYMENT_WEBHOOK_MAX_ATTEMPTS=2)
+    def test_a_broken_event_does_not_block_the_batch(self):
+        self.send('approved', 'tx-5')
+        self.send('approved', 'tx-6')
+
+        def process(events):
+            if any(event['transaction_id'] == 'tx-5' for event in events):
+                raise ValueError('broken')
+            process_webhook_events(events)
+
+        with mock.patch('payments.webhooks.process_webhook_events', side_effect=process):
+            self.assertEqual(flush_webhook_events(), {'processed': 1, 'failed': 1, 'batches': 1})
+            broken = WebhookEvent.objects.get(transaction_id='tx-5')
+            self.assertEqual((broken.processed, broken.failed, broken.attempts), (False, False, 1))
+
+            self.assertEqual(flush_webhook_events(), {'processed': 0, 'failed': 1, 'batches': 1})
+            broken.refresh_from_db()
+            self.assertEqual((broken.processed, broken.failed, broken.attempts), (False, True, 2))
+            self.assertEqual(flush_webhook_events(), {'processed': 0, 'failed': 0, 'batches': 0})
+
+        self.assertEqual(Payment.objects.get(id=self.payment.id).status, PaymentStatus.COMPLETED)
+
+    def test_completed_batch_grants_its_roles_at_once(self):
+        vip = RoleType.objects.create(name='VIP', price=Decimal('10.00'), icon='star')
+        product = Product.objects.create(role_type=vip, is_role=True)
+        other = User.objects.create_user(username='other', password='testpass')
+        payments = [checkout(user, [{'slug': product.slug, 'quantity': 1}], payment_type='credit_card')
+                    for user in (self.user, other)]
+        for index, payment in enumerate(payments):
+            self.send('approved', f'tx-role-{index}', payment_id=payment.id)
+
+        with mock.patch.object(Role.objects, 'grant', wraps=Role.objects.grant) as grant:
+            flush_webhook_events()
+
+        grant.assert_called_once()
+        self.assertEqual(Role.objects.filter(role_type=vip, status=Role.active).count(), 2)
+
+    def test_callbacks_for_payments_of_other_providers_are_dropped(self):
+        balance_payment = checkout(self.user, self.items(), payment_type='user_balance')
+        self.send('cancelled', 'tx-7', payment_id=balance_payment.id)
+        self.send('approved', 'tx-8', amount='0.01')
+
+        self.assertEqual(flush_webhook_events(), {'processed': 2, 'failed': 0, 'batches': 1})
+
+        self.assertEqual(Payment.objects.get(id=balance_payment.id).status, PaymentStatus.PENDING)
+        self.assertEqual(Payment.objects.get(id=self.payment.id).status, PaymentStatus.PENDING)
+        self.assertFalse(ExternalApiResponse.objects.exists())
+
+    def test_callbacks_with_the_charged_amount_are_applied(self):
+        self.send('approved', 'tx-9', amount='10.00')
+        flush_webhook_events()
+
+        self.assertEqual(Payment.objects.get(id=self.payment.id).status, PaymentStatus.COMPLETED)
+
+    def test_invalid_signatures_are_refused(self):
+        body, headers = StubProvider(secret='outro').build_callback(self.payment.id, 'approved', 'tx-4')
+        response = self.client.post(self.url, body, content_type='application/json', **headers)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_unknown_provider_is_not_found(self):
+        url = reverse('payments:webhook', kwargs={'provider': 'desconhecido'})
+        self.assertEqual(self.client.post(url, b'{}', content_type='application/json').status_code, 404)
+
+
+@override_settings(PAYMENT_GATEWAYS={'credit_card': {'BACKEND': 'payments.gateways.FakeGateway'}},
+                   PAYMENT_CHARGE_WORKER=False, PAYMENT_WEBHOOK_WORKER=False)
+class PaymentGatewayTests(SalesTestCase):
+    stock_units = 5
+
+    def setUp(self):
+        super().setUp()
+        self.gateway = get_gateway('credit_card')
+        # The instance is shared by the process, like a real gateway and its pool
+        self.gateway.charges, self.gateway.outcome, self.gateway.error = [], 'approved', None
+
+    def buy(self):
+        return checkout(self.user, self.items(), payment_type='credit_card')
+
+    def run_workers(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            report = charge_pending_payments()
+            flush_webhook_events()
+        return report
+
+    def test_gateway_is_charged_by_the_worker_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            payment = self.buy()
+        self.assertEqual(self.gateway.charges, [])
+        self.assertFalse(GatewayCharge.objects.get(payment=payment).processed)
+
+        self.assertEqual(self.run_workers(), {'charged': 1, 'failed': 0})
+
+        self.assertEqual(self.gateway.charges, [payment.id])
+        payment = Payment.objects.select_related('payment_method__response').get(id=payment.id)
+        self.assertEqual(payment.status, PaymentStatus.COMPLETED)
+        self.assertTrue(payment.payment_method.response.transaction_id.startswith('fake-'))
+        self.assertEqual(self.run_workers(), {'charged': 0, 'failed': 0})
+
+    def test_declined_charge_fails_the_payment_and_releases_stock(self):
+        self.gateway.outcome = 'declined'
+        with self.captureOnCommitCallbacks(execute=True):
+            payment = self.buy()
+        self.run_workers()
+
+        self.assertEqual(Payment.objects.get(id=payment.id).status, PaymentStatus.FAILED)
+        self.assertEqual(Stock.objects.get(product=self.product).units_hold, 0)
+
+    def test_partial_balance_is_debited_and_the_rest_charged(self):
+        User.objects.filter(pk=self.user.pk).update(balance=Decimal('4.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            payment = self.buy()
+
+        self.assertEqual(Payment.objects.get(id=payment.id).amount, Decimal('6.00'))
+        self.assertEqual(self.user.get_balance(), Decimal('0.00'))
+
+    def test_declined_charge_gives_the_partial_balance_back(self):
+        User.objects.filter(pk=self.user.pk).update(balance=Decimal('4.00'))
+        self.gateway.outcome = 'declined'
+        with self.captureOnCommitCallbacks(execute=True):
+            payment = self.buy()
+        self.run_workers()
+
+        self.assertEqual(Payment.objects.get(id=payment.id).status, PaymentStatus.FAILED)
+        self.assertEqual(self.user.get_balance(), Decimal('4.00'))
+
+    def test_gateway_errors_keep_the_payment_pending_and_retry_later(self):
+        self.gateway.error = 'timeout'
+        with self.captureOnCommitCallbacks(execute=True):
+            payment = self.buy()
+
+        self.assertEqual(self.run_workers(), {'charged': 0, 'failed': 1})
+        self.assertEqual(Payment.objects.get(id=payment.id).status, PaymentStatus.PENDING)
+        charge = GatewayCharge.objects.get(payment=payment)
+        self.assertEqual(charge.attempts, 1)
+        self.assertGreater(charge.available_at, timezone.now())
+
+        self.gateway.error = None
+        GatewayCharge.objects.filter(id=charge.id).update(available_at=timezone.now())
+        self.run_workers()
+        self.assertEqual(Payment.objects.get(id=payment.id).status, PaymentStatus.COMPLETED)
+
+    def test_gateways_must_implement_charge(self):
+        class IncompleteGateway(BaseGateway):
+            name = 'incompleto'
+
+        with self.assertRaises(TypeError):
+            IncompleteGateway()
+
+    def test_pooled_client_reuses_connections(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        import threading
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                body = json.dumps({'transaction_id': 'tx', 'status': 'approved'}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = PooledHTTPClient(f'http://127.0.0.1:{server.server_port}', timeout=2, pool_size=2)
+        try:
+            for _ in range(3):
+                self.assertEqual(client.request_json('POST', '/charges', {})[0], 200)
+            self.assertEqual(client._idle.qsize(), 1)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+
+class CheckoutTests(BuyerTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name='Categoria')
+        self.products = []
+        for index in range(3):
+            product = Product.objects.create(name=f'Produto {index}', category=category, price=Decimal('10.00'))
+            Stock.objects.create(product=product, units=5)
+            self.products.append(product)
+
+    def run_checkout(self, products):
+        with CaptureQueriesContext(connection) as queries:
+            payment = checkout(self.user, [{'slug': product.slug, 'quantity': 1} for product in products],
+                               payment_type='user_balance')
+        return payment, len(queries)
+
+    def test_order_and_payment_are_created_holding_stock(self):
+        payment, _ = self.run_checkout(self.products[:2])
+
+        self.assertEqual(payment.status, PaymentStatus.PENDING)
+        self.assertEqual(payment.amount, Decimal('20.00'))
+        self.assertEqual(payment.order.items.count(), 2)
+        self.assertEqual(Stock.objects.get(product=self.products[0]).units_hold, 1)
+
+    def test_query_budget_does_not_grow_with_items(self):
+        self.run_checkout(self.products[:1])  # Warms the product cache
+        _, one_item = self.run_checkout(self.products[:1])
+        _, three_items = self.run_checkout(self.products)
+        self.assertEqual(one_item, three_items)
+
+    def test_missing_stock_rolls_back_everything(self):
+        Stock.objects.filter(product=self.products[1]).update(units=0)
+        with self.assertRaises(ValidationError):
+            checkout(self.user, [{'slug': self.products[0].slug, 'quantity': 1},
+                                 {'slug': self.products[1].slug, 'quantity': 1}], payment_type='user_balance')
+
+        self.assertFalse(Order.objects.filter(customer=self.user).exists())
+        self.assertFalse(Payment.objects.filter(customer=self.user).exists())
+        self.assertEqual(Stock.objects.get(product=self.products[0]).units, 5)
+
+    def test_caches_are_invalidated_once_after_commit(self):
+        Order.objects.get_cached_orders(self.user)
+        Payment.objects.get_cached_payments(self.user)
+        keys = {Order.objects.get_cache_key(self.user.id), Payment.objects.get_cache_key(self.user.id)}
+
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set, \
+                mock.patch.object(cache, 'delete_many', wraps=cache.delete_many) as delete_many:
+            with self.captureOnCommitCallbacks(execute=True):
+                payment, _ = self.run_checkout(self.products)
+                # Uncommitted data is read from the database, nothing is written or dropped before the commit
+                self.assertIn(payment.id, Payment.objects.get_cached_payments(self.user))
+
+        self.assertFalse({call.args[0] for call in cache_set.call_args_list} & keys)
+        invalidations = [set(call.args[0]) for call in delete_many.call_args_list if keys & set(call.args[0])]
+        self.assertEqual(invalidations, [keys])
+        self.assertIn(payment.order_id, Order.objects.get_cached_orders(self.user))
+
+    def test_checkout_appends_its_histories_with_one_cache_write(self):
+        histories_key = UserHistory.objects.get_history_cache_key(self.user.id)
+        UserHistory.objects.get_cached_histories(self.user.id)
+
+        with mock.patch.object(cache, 'set_many', wraps=cache.set_many) as set_many:
+            with self.captureOnCommitCallbacks(execute=True):
+                payment, _ = self.run_checkout(self.products)
+                self.assertFalse(set_many.called)
+
+        self.assertEqual([call.args[0].keys() for call in set_many.call_args_list if histories_key in call.args[0]],
+                         [{histories_key}])
+        window = cache.get(histories_key)
+        self.assertEqual([item['id'] for item in window['items']],
+                         list(UserHistory.objects.filter(user=self.user).order_by('-id').values_list('id', flat=True)))
+        self.assertIn(f'#{payment.id}', window['items'][0]['info'])
+
+    def test_rolled_back_checkout_is_never_cached(self):
+        cached_orders = Order.objects.get_cached_orders(self.user)
+        Stock.objects.filter(product=self.products[1]).update(units=0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValidationError):
+                checkout(self.user, [{'slug': self.products[0].slug, 'quantity': 1},
+                                     {'slug': self.products[1].slug, 'quantity': 1}], payment_type='user_balance')
+
+        self.assertEqual(cache.get(Order.objects.get_cache_key(self.user.id)), cached_orders)
+
+
+class PaymentQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='testpass')
+
+    def test_customer_payments_are_listed_through_the_composite_index(self):
+        payments = Payment.objects.filter(customer=self.user)
+        index_name = get_index_name(Payment, ['customer', '-id'])
+        for queryset in (payments.order_by('-id')[:PaymentManager.CACHE_WINDOW],
+                         payments.filter(id__lt=100).order_by('-id')[:11],
+                         payments.filter(id__gt=100).order_by('id')[:11]):
+            self.assertUsesIndex(queryset, index_name)
+            self.assertNoSort(queryset)
+
+    def test_expired_reservations_are_found_through_indexes(self):
+        now = timezone.now()
+        self.assertNoFullScan(Payment.objects.filter(
+            Q(reserved_until__lte=now) | Q(reserved_until__isnull=True, created__lte=now - timedelta(minutes=30)),
+            status=PaymentStatus.PENDING, order__isnull=False).order_by('id')[:200])
+
+    def test_payments_of_orders_are_read_through_the_order_index(self):
+        self.assertUsesIndex(Payment.objects.filter(order_id__in=[1, 2]), get_index_name(Payment, ['order']))
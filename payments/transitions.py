@@ -0,0 +1,244 @@
+import logging
+from collections import Counter, defaultdict
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import F, Q, Case, When, Value, Sum
+from django.db.models.functions import Greatest
+from django.urls import reverse
+from django.utils import timezone
+
+from orders.models import Order, Item
+from products.models import PromotionCode, PromotionCodeUsage, Stock
+from users.models import BalanceEntry, UserHistory
+from .models import Payment, PaymentPromotionCode, PaymentStatus
+
+logger = logging.getLogger('celery')
+
+
+# Guards, they receive the payment and tell if the transition may run
+def has_order(payment):
+    # Payments of archived orders have nothing left to restore
+    return payment.order_id is not None
+
+
+# Single payment effects, run through the PaymentService of the locked payment
+def finish_payment(payment_service, target):
+    payment_service.finish_successful_payment()
+
+
+def revert_payment(payment_service, target):
+    payment_service.process_payment_status(new_status=target)
+
+
+# Bulk effects, applied set-wise to the whole selection, they may append UserHistory rows to histories
+def restore_stock(payments, histories):
+    """
+    Releases the held units of pending payments and restores the sold units of completed ones.
+    """
+    held, sold = Counter(), Counter()
+    waiting_orders = {payment.order_id for payment in payments if payment.order.status == Order.Waiting_payment}
+    items = Item.objects.filter(order_id__in=[payment.order_id for payment in payments],
+                                product__stock__isnull=False).values_list('order_id', 'product__stock__id', 'quantity')
+    for order_id, stock_id, quantity in items:
+        (held if order_id in waiting_orders else sold)[stock_id] += quantity
+    Stock.release_holds(held)
+    Stock.restore_sold(sold)
+
+
+def cancel_orders(payments, histories):
+    order_ids = [payment.order_id for payment in payments]
+    Order.objects.filter(id__in=order_ids).update(status=Order.Cancelled, is_paid=False, modified=timezone.now())
+    Order.objects.update_search_tokens(Order.objects.filter(id__in=order_ids).select_related('customer'))
+    Order.objects.delete_cached_orders_for(payment.customer_id for payment in payments)
+
+
+def restore_coupons(payments, histories):
+    """
+    Gives back the global and per-user usage of the coupons applied to the payments.
+    """
+    usages = Counter(PaymentPromotionCode.objects.filter(
+        payment__in=payments, promotion_code__isnull=False
+    ).values_list('promotion_code_id', 'payment__customer_id'))
+    if not usages:
+        return
+
+    per_code = Counter()
+    for (code_id, _), count in usages.items():
+        per_code[code_id] += count
+    PromotionCode.objects.filter(id__in=per_code.keys()).update(usage_count=Greatest(F('usage_count') - Case(
+        *[When(id=code_id, then=Value(count)) for code_id, count in per_code.items()],
+        default=Value(0), output_field=models.PositiveIntegerField()
+    ), Value(0)))
+
+    per_user = [(code_id, user_id, count) for (code_id, user_id), count in usages.items() if user_id]
+    if per_user:
+        PromotionCodeUsage.objects.filter(
+            reduce(or_, [Q(promotion_code_id=code_id, user_id=user_id) for code_id, user_id, _ in per_user])
+        ).update(user_usage_count=Greatest(F('user_usage_count') - Case(
+            *[When(promotion_code_id=code_id, user_id=user_id, then=Value(count))
+              for code_id, user_id, count in per_user],
+            default=Value(0), output_field=models.PositiveIntegerField()
+        ), Value(0)))
+
+
+def refund_balances(payments, histories):
+    """
+    Credits the amount of the payments to their customers, one ledger insert for all of them.
+    """
+    entries = []
+    for payment in payments:
+        if payment.customer_id:
+            entries.append(BalanceEntry(user_id=payment.customer_id, amount=payment.amount,
+                                        kind=BalanceEntry.refund, payment_id=payment.id))
+            histories.append(UserHistory(
+                user_id=payment.customer_id,
+                info=f'Saldo reembolsado: {payment.amount}, do pagamento #{payment.id}.',
+                type=UserHistory.user_balance_refund,
+                link=reverse('payments:payment_detail', kwargs={"payment_id": payment.id})
+            ))
+    if entries:
+        BalanceEntry.objects.bulk_credit(entries)
+
+
+def return_partial_balances(payments, histories):
+    """
+    Gives back the balance debited for the part of the payments it covered, the rest was charged by the gateway.
+    """
+    debits = BalanceEntry.objects.filter(
+        payment_id__in=[payment.id for payment in payments], kind=BalanceEntry.partial_payment
+    ).values('payment_id', 'user_id').annotate(total=Sum('amount')).order_by('payment_id')
+    entries = []
+    for debit in debits:
+        amount, payment_id = -debit['total'], debit['payment_id']
+        entries.append(BalanceEntry(user_id=debit['user_id'], amount=amount,
+                                    kind=BalanceEntry.refund, payment_id=payment_id))
+        histories.append(UserHistory(
+            user_id=debit['user_id'],
+            info=f'Saldo reembolsado: {amount}, do pagamento #{payment_id}.',
+            type=UserHistory.user_balance_refund,
+            link=reverse('payments:payment_detail', kwargs={"payment_id": payment_id})
+        ))
+    if entries:
+        BalanceEntry.objects.bulk_credit(entries)
+
+
+def record_failures(payments, histories):
+    histories.extend(
+        UserHistory(
+            user_id=payment.customer_id,
+            info=f'Pagamento #{payment.id} falhou.',
+            type=UserHistory.payment_fail,
+            link=reverse('payments:payment_detail', kwargs={"payment_id": payment.id})
+        )
+        for payment in payments if payment.customer_id
+    )
+
+
+class Transition:
+    """
+    One allowed status change of a payment.
+    The effect applies it to a single payment, the bulk_effects to a whole selection, None when it can't run in bulk.
+    """
+
+    def __init__(self, source, target, effect, guards=(), bulk_effects=None):
+        self.source = source
+        self.target = target
+        self.effect = effect
+        self.guards = tuple(guards)
+        self.bulk_effects = bulk_effects
+
+    def allows(self, payment):
+        return all(guard(payment) for guard in self.guards)
+
+    def run(self, payment_service):
+        if not self.allows(payment_service.payment):
+            raise ValidationError(f'O pagamento #{payment_service.payment.id} não pode mudar para "{self.target}".')
+        self.effect(payment_service, self.target)
+
+
+TRANSITIONS = {
+    (transition.source, transition.target): transition for transition in (
+        Transition(PaymentStatus.PENDING, PaymentStatus.COMPLETED, finish_payment, guards=[has_order]),
+        Transition(PaymentStatus.PENDING, PaymentStatus.CANCELLED, revert_payment, guards=[has_order],
+                   bulk_effects=[restore_stock, cancel_orders, restore_coupons, return_partial_balances]),
+        Transition(PaymentStatus.PENDING, PaymentStatus.FAILED, revert_payment, guards=[has_order],
+                   bulk_effects=[restore_stock, cancel_orders, restore_coupons, return_partial_balances,
+                                 record_failures]),
+        Transition(PaymentStatus.COMPLETED, PaymentStatus.REFUNDED, revert_payment, guards=[has_order],
+                   bulk_effects=[restore_stock, cancel_orders, restore_coupons, return_partial_balances,
+                                 refund_balances]),
+    )
+}
+
+BULK_TARGETS = {transition.target for transition in TRANSITIONS.values() if transition.bulk_effects is not None}
+
+# Status a payment goes to when it is reverted without an explicit target
+DEFAULT_TARGETS = {
+    PaymentStatus.PENDING: PaymentStatus.CANCELLED,
+    PaymentStatus.COMPLETED: PaymentStatus.REFUNDED,
+}
+
+
+def get_transition(source, target):
+    """
+    Returns the transition between two status, raising ValidationError when it isn't allowed.
+    """
+    transition = TRANSITIONS.get((source, target))
+    if transition is None:
+        raise ValidationError(f'You cannot change a "{str(source).upper()}" payment to "{str(target).upper()}".')
+    return transition
+
+
+def bulk_transition(payment_ids, target, batch_size=200) -> dict:
+    """
+    Moves many payments to the target status, one locked batch per transaction.
+    Payments whose current status has no bulk transition to the target, or that fail a guard, are skipped.
+
+    :param payment_ids: Ids of the selected payments.
+    :param target: New status of the payments.
+    :param batch_size: Payments locked and transitioned per transaction.
+    :return: Report with the transitioned and skipped payments.
+    """
+    if target not in BULK_TARGETS:
+        raise ValueError(f"There is no bulk transition to {target}.")
+
+    payment_ids = sorted(set(payment_ids))
+    transitioned, skipped = 0, 0
+    for start in range(0, len(payment_ids), batch_size):
+        with transaction.atomic():
+            payments = list(
+                Payment.objects.select_for_update(of=('self',))
+                .filter(id__in=payment_ids[start:start + batch_size])
+                .select_related('customer', 'order', 'payment_method')
+                .order_by('id')
+            )
+            groups = defaultdict(list)
+            for payment in payments:
+                transition = TRANSITIONS.get((payment.status, target))
+                if transition and transition.bulk_effects is not None and transition.allows(payment):
+                    groups[transition].append(payment)
+                else:
+                    skipped += 1
+
+            histories = []
+            for transition, group in groups.items():
+                for effect in transition.bulk_effects:
+                    effect(group, histories)
+
+            moved = [payment for group in groups.values() for payment in group]
+            if not moved:
+                continue
+            Payment.objects.filter(id__in=[payment.id for payment in moved]).update(
+                status=target, modified=timezone.now())
+            for payment in moved:
+                payment.status = target
+            Payment.objects.update_search_tokens(moved)
+            Payment.objects.delete_cached_payments_for(payment.customer_id for payment in moved)
+            UserHistory.objects.bulk_append(histories)
+            transitioned += len(moved)
+
+    logger.info(f"Moved {transitioned} payments to {target} in bulk ({skipped} skipped).")
+    return {'transitioned': transitioned, 'skipped': skipped}
@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import UserPaymentListView, UserPaymentDetailView
+from .views import UserPaymentListView, UserPaymentDetailView, PaymentWebhookView
 
 app_name = "payments"
 
@@ -7,4 +7,5 @@ app_name = "payments"
 urlpatterns = [
     path('', UserPaymentListView.as_view(), name='payment_list'),
     path('<int:payment_id>/', UserPaymentDetailView.as_view(), name='payment_detail'),
+    path('webhooks/<slug:provider>/', PaymentWebhookView.as_view(), name='webhook'),
 ]
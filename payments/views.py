@@ -1,12 +1,16 @@
-from django.db.models import Q
-from django.http import Http404
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.db import transaction
 from django.utils.decorators import method_decorator
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.paginator import Paginator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import TemplateView
 
 from pages.decorators import strict_rate_limit
+from pages.paginators import KeysetPaginator
 from .models import Payment
+from .webhooks import (SIGNATURE_HEADER, TIMESTAMP_HEADER, get_webhook_secret, parse_event, store_event,
+                       verify_signature, webhook_worker)
 
 
 @method_decorator(strict_rate_limit(url_names=['payments:payment_list']), name='dispatch')
@@ -21,40 +25,23 @@ class UserPaymentListView(LoginRequiredMixin, TemplateView):
 
     def get_payments(self, search_query):
         if self.request.user.is_staff:
-            payments = self.get_staff_payments(search_query)
-        else:
-            payments = self.get_user_payments(search_query)
-        return self.paginate_payments(payments)
+            return self.paginate_payments(self.get_staff_payments(search_query))
+        return self.get_user_payments(search_query)
 
     @staticmethod
     def get_staff_payments(search_query):
-        payments = Payment.objects.select_related('payment_method').order_by('-id')
-        if search_query:
-            payments = payments.filter(
-                Q(id__icontains=search_query) |
-                Q(status__icontains=search_query) |
-                Q(customer__first_name__icontains=search_query) |
-                Q(customer__last_name__icontains=search_query) |
-                Q(customer__email__icontains=search_query) |
-                Q(customer__username__icontains=search_query) |
-                Q(payment_method__name__icontains=search_query) |
-                Q(payment_method__payment_type__icontains=search_query)
-            )
-        return payments
+        payments = Payment.objects.search(search_query) if search_query else Payment.objects.all()
+        return payments.select_related('payment_method').order_by('-id')
 
     def get_user_payments(self, search_query):
-        payments_dict = Payment.objects.get_cached_payments(customer=self.request.user)
-        payments = [value for _, value in sorted(payments_dict.items(), reverse=True)]
-        if search_query:
-            payments = [payment for payment in payments
-                        if search_query.lower() in str(payment['id']) or search_query.lower() in payment['status']]
-        return payments
+        # Recent pages come from the cached window, older ones from the database
+        return Payment.objects.get_payments_page(customer=self.request.user, token=self.request.GET.get('cursor'),
+                                                 per_page=10, search_query=search_query)
 
     def paginate_payments(self, payments):
-        paginator = Paginator(payments, 10)
-        paginator._count = len(list(payments))
-        page_number = self.request.GET.get('page')
-        return paginator.get_page(page_number)
+        # Keyset pagination on '-id': every page costs one LIMIT query, without counting the table
+        paginator = KeysetPaginator(per_page=10)
+        return paginator.get_page(payments, self.request.GET.get('cursor'))
 
 
 @method_decorator(strict_rate_limit(url_names=['payments:payment_detail']), name='dispatch')
@@ -65,16 +52,44 @@ class UserPaymentDetailView(LoginRequiredMixin, TemplateView):
         context = super().get_context_data(**kwargs)
         user = self.request.user
 
-        # Extract order_id from kwargs
+        # Extract payment_id from kwargs
         payment_id = kwargs.get('payment_id', None)
         if not payment_id:
             raise Http404('Página não encontrada.')
 
-        # Fetch the cached order
+        # Fetch the cached payment, already scoped to the user and falling back to the database
         payment = Payment.objects.get_cached_payment(payment_id=payment_id, customer=user)
-        if (not user.is_staff and payment.customer.pk != user.pk) or not payment:
+        if not payment:
             raise Http404('Página não encontrada')
 
-        # Add order to the context
+        # Add payment to the context
         context['payment'] = payment
         return context
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class PaymentWebhookView(View):
+    """
+    Receives provider callbacks, validates their signature and only saves them,
+    the payments are updated in batches by the webhook worker.
+    """
+    http_method_names = ['post']
+
+    def post(self, request, provider):
+        secret = get_webhook_secret(provider)
+        if not secret:
+            raise Http404('Página não encontrada.')
+
+        if not verify_signature(secret, request.body, request.META.get(TIMESTAMP_HEADER),
+                                request.META.get(SIGNATURE_HEADER)):
+            return HttpResponseForbidden("Invalid signature.")
+
+        try:
+            event = parse_event(provider, request.body)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid payload.")
+
+        # Acknowledged only once saved, an error here makes the provider retry the callback
+        store_event(event)
+        transaction.on_commit(webhook_worker.notify)
+        return HttpResponse(status=202)
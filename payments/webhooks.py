@@ -0,0 +1,256 @@
+import hashlib
+import hmac
+import json
+import logging
+import time
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, F, When, Value
+
+from .gateways import get_provider_payment_types
+from .models import ExternalApiResponse, Payment, PaymentMethod, PaymentStatus, WebhookEvent
+from .workers import BatchWorker
+
+logger = logging.getLogger('celery')
+
+SIGNATURE_HEADER = 'HTTP_X_WEBHOOK_SIGNATURE'
+TIMESTAMP_HEADER = 'HTTP_X_WEBHOOK_TIMESTAMP'
+
+# Provider status -> payment status, unknown status are only stored
+WEBHOOK_STATUSES = {
+    'approved': PaymentStatus.COMPLETED,
+    'paid': PaymentStatus.COMPLETED,
+    'failed': PaymentStatus.FAILED,
+    'declined': PaymentStatus.FAILED,
+    'cancelled': PaymentStatus.CANCELLED,
+    'refunded': PaymentStatus.REFUNDED,
+}
+
+
+def get_webhook_secret(provider):
+    return getattr(settings, 'PAYMENT_WEBHOOK_SECRETS', {}).get(provider) or None
+
+
+def sign_payload(secret, timestamp, body):
+    message = f"{timestamp}.".encode() + body
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret, body, timestamp, signature):
+    """
+    Checks the HMAC-SHA256 of '<timestamp>.<body>', refusing timestamps outside the tolerance to block replays.
+    """
+    if not (secret and timestamp and signature):
+        return False
+    try:
+        age = abs(time.time() - int(timestamp))
+    except (TypeError, ValueError):
+        return False
+    if age > getattr(settings, 'PAYMENT_WEBHOOK_TOLERANCE', 60 * 5):
+        return False
+    return hmac.compare_digest(sign_payload(secret, timestamp, body), signature)
+
+
+def parse_event(provider, body):
+    """
+    Builds the event from a webhook body, raising ValueError for malformed payloads.
+    """
+    try:
+        data = json.loads(body)
+        event = {
+            'provider': provider,
+            'transaction_id': str(data['transaction_id'])[:100],
+            'payment_id': int(data['payment_id']),
+            'status': str(data['status']).lower(),
+            'data': data,
+        }
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError(f"Invalid webhook payload: {e}")
+    if not event['transaction_id']:
+        raise ValueError("Invalid webhook payload: empty transaction_id")
+    return event
+
+
+def store_event(event):
+    """
+    Saves the event before the callback is acknowledged, with an upsert by transaction_id,
+    so replays of the provider only refresh the row and mark it to be applied again.
+    """
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(provider=event['provider'], transaction_id=event['transaction_id'],
+                      payment_id=event['payment_id'], status=event['status'], data=event['data'])],
+        update_conflicts=True,
+        unique_fields=['transaction_id'],
+        update_fields=['provider', 'payment_id', 'status', 'data', 'processed', 'failed', 'attempts', 'modified'],
+    )
+
+
+# Wakes up every full batch of callbacks, or at the flush interval
+webhook_worker = BatchWorker('payment-webhooks', lambda: flush_webhook_events(), 'PAYMENT_WEBHOOK_WORKER',
+                             wake_after=lambda: getattr(settings, 'PAYMENT_WEBHOOK_BATCH_SIZE', 200))
+
+
+def flush_webhook_events(batch_size=None) -> dict:
+    """
+    Applies the saved events batch by batch until none is left.
+    The rows of a batch stay locked until they are marked, concurrent workers skip them.
+    An event that fails alone is retried by the next flushes, up to PAYMENT_WEBHOOK_MAX_ATTEMPTS,
+    then it is left as failed for an operator.
+
+    :return: Report with the processed and the failed events, and the batches.
+    """
+    batch_size = batch_size or getattr(settings, 'PAYMENT_WEBHOOK_BATCH_SIZE', 200)
+    max_attempts = getattr(settings, 'PAYMENT_WEBHOOK_MAX_ATTEMPTS', 5)
+    processed, failed, batches = 0, [], 0
+    while True:
+        with transaction.atomic():
+            rows = list(WebhookEvent.objects.select_for_update(skip_locked=True)
+                        .filter(processed=False, failed=False).exclude(id__in=failed)
+                        .order_by('id')[:batch_size])
+            if not rows:
+                break
+            failed_ids = apply_saved_events(rows)
+            WebhookEvent.objects.filter(id__in=[row.id for row in rows if row.id not in failed_ids]).update(
+                processed=True)
+            if failed_ids:
+                WebhookEvent.objects.filter(id__in=failed_ids).update(
+                    attempts=F('attempts') + 1,
+                    failed=Case(When(attempts__gte=max_attempts - 1, then=Value(True)), default=Value(False)))
+        processed += len(rows) - len(failed_ids)
+        failed.extend(failed_ids)
+        batches += 1
+    return {'processed': processed, 'failed': len(failed), 'batches': batches}
+
+
+def apply_saved_events(rows):
+    """
+    Applies a batch at once, and one by one when it fails, so a broken event never blocks the others.
+
+    :return: Ids of the rows that failed alone.
+    """
+    try:
+        with transaction.atomic():
+            process_webhook_events([row.as_event() for row in rows])
+        return []
+    except Exception as e:
+        if len(rows) == 1:
+            logger.error(f"Failed to apply the webhook of transaction {rows[0].transaction_id}: {e}")
+            return [rows[0].id]
+    return [row_id for row in rows for row_id in apply_saved_events([row])]
+
+
+def accepted_events(events):
+    """
+    Keeps the events of payments charged through their provider, and of the charged amount when they carry one.
+    The signature only proves who sent the callback, not that the payment is theirs.
+    """
+    payments = Payment.objects.select_related('payment_method').in_bulk({event['payment_id'] for event in events})
+    payment_types = {}
+    accepted = []
+    for event in events:
+        provider, payment = event['provider'], payments.get(event['payment_id'])
+        if provider not in payment_types:
+            payment_types[provider] = get_provider_payment_types(provider)
+        if payment is None or payment.payment_method.payment_type not in payment_types[provider]:
+            logger.error(f"Webhook of {provider} for payment {event['payment_id']} dropped: "
+                         f"not a payment of this provider.")
+            continue
+        if 'amount' in event['data']:
+            try:
+                amount_matches = Decimal(str(event['data']['amount'])) == payment.amount
+            except InvalidOperation:
+                amount_matches = False
+            if not amount_matches:
+                logger.error(f"Webhook of {provider} for payment {payment.id} dropped: "
+                             f"amount {event['data']['amount']} instead of {payment.amount}.")
+                continue
+        accepted.append(event)
+    return accepted
+
+
+def process_webhook_events(events):
+    """
+    Stores a batch of events with one upsert by transaction_id, links the responses to their payments
+    and applies the status transitions of the whole batch.
+    """
+    from .services import batched_role_grants
+    from .transitions import bulk_transition
+
+    # The last callback of a transaction wins inside the batch
+    latest = {}
+    for event in accepted_events(events):
+        latest[event['transaction_id']] = event
+    if not latest:
+        return
+
+    with transaction.atomic():
+        ExternalApiResponse.objects.bulk_create(
+            [ExternalApiResponse(transaction_id=transaction_id, response_data=event['data'])
+             for transaction_id, event in latest.items()],
+            update_conflicts=True,
+            unique_fields=['transaction_id'],
+            update_fields=['response_data', 'modified'],
+        )
+        response_ids = dict(ExternalApiResponse.objects.filter(
+            transaction_id__in=latest.keys()).values_list('transaction_id', 'id'))
+        link_responses(latest.values(), response_ids)
+
+    targets = defaultdict(list)
+    for event in latest.values():
+        target = WEBHOOK_STATUSES.get(event['status'])
+        if target:
+            targets[target].append(event['payment_id'])
+
+    # Completions run the order effects of each payment, their roles are granted once for the batch.
+    # The other targets are set-wise
+    with transaction.atomic(), batched_role_grants():
+        for payment in Payment.objects.filter(id__in=targets.pop(PaymentStatus.COMPLETED, []),
+                                              status=PaymentStatus.PENDING):
+            payment.status = PaymentStatus.COMPLETED
+            payment.save()
+    for target, payment_ids in targets.items():
+        bulk_transition(payment_ids, target)
+
+
+def link_responses(events, response_ids):
+    """
+    Gives each payment without a response its own PaymentMethod row pointing to the provider response.
+    """
+    payment_responses = {event['payment_id']: response_ids[event['transaction_id']] for event in events}
+    payments = list(Payment.objects.filter(id__in=payment_responses.keys(), payment_method__response__isnull=True)
+                    .select_related('payment_method'))
+    if not payments:
+        return
+    payment_methods = PaymentMethod.objects.bulk_create([
+        PaymentMethod(name='', payment_type=payment.payment_method.payment_type,
+                      response_id=payment_responses[payment.id])
+        for payment in payments
+    ])
+    Payment.objects.filter(id__in=[payment.id for payment in payments]).update(payment_method=Case(
+        *[When(id=payment.id, then=Value(payment_method.id))
+          for payment, payment_method in zip(payments, payment_methods)],
+        output_field=models.BigIntegerField()
+    ))
+
+
+class StubProvider:
+    """
+    Local provider for tests and development, builds signed callbacks accepted by the webhook endpoint.
+    """
+    name = 'stub'
+
+    def __init__(self, secret=None):
+        self.secret = secret or get_webhook_secret(self.name)
+
+    def build_callback(self, payment_id, status, transaction_id, timestamp=None, **extra):
+        """
+        :return: The body and the headers of a callback, ready for the test client.
+        """
+        timestamp = str(int(timestamp if timestamp is not None else time.time()))
+        body = json.dumps({'transaction_id': transaction_id, 'payment_id': payment_id, 'status': status,
+                           **extra}).encode()
+        headers = {SIGNATURE_HEADER: sign_payload(self.secret, timestamp, body), TIMESTAMP_HEADER: timestamp}
+        return body, headers
@@ -0,0 +1,57 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger('celery')
+
+
+class BatchWorker:
+    """
+    Daemon thread running flush every flush interval, or sooner once wake_after rows were saved.
+    The rows it applies are saved before notify, those left by a stopped process are applied by the next worker.
+    """
+
+    def __init__(self, name, flush, enabled_setting, wake_after=lambda: 1):
+        self.name = name
+        self.flush = flush
+        self.enabled_setting = enabled_setting
+        self.wake_after = wake_after
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = 0
+        self._worker = None
+
+    def notify(self):
+        """
+        Tells the worker a row was saved.
+        """
+        if not getattr(settings, self.enabled_setting, True):
+            return
+        with self._lock:
+            self._pending += 1
+            wake = self._pending >= self.wake_after()
+        self.start_worker()
+        if wake:
+            self._wakeup.set()
+
+    def start_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(getattr(settings, 'PAYMENT_WORKER_FLUSH_INTERVAL', 2))
+            self._wakeup.clear()
+            with self._lock:
+                self._pending = 0
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Worker {self.name} failed to apply the saved rows: {e}")
+            finally:
+                close_old_connections()
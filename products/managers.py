@@ -69,6 +69,11 @@ class ProductManager(models.Manager):
         except Exception as e:
             logger.error(f"Failed to update product cache for slug {product.slug}: {e}")
 
+    @staticmethod
+    def clear_products_cache():
+        # Used after set-based updates that skip the post_save signals, rebuilt on the next read
+        cache.delete(PRODUCTS_DICT_KEY)
+
     def delete_product_cache(self, slug):
         products_dict = self.get_products_dict_from_cache() or {}
         products_dict.pop(slug, None)
@@ -1,6 +1,7 @@
 from django.contrib.auth import get_user_model
 from django.db import models, transaction
-from django.db.models import F
+from django.db.models import F, Case, When, Value
+from django.db.models.functions import Greatest
 from django.core.exceptions import ValidationError
 from django.urls import reverse
 from django.utils import timezone
@@ -257,6 +258,88 @@ class Stock(TimeStampedModel):
 
         self.update_product_availability(stock, stock.product)
 
+    @classmethod
+    def _quantity_delta(cls, quantities):
+        """
+        Per row quantity of a set-wise UPDATE, 0 for the stocks not in the mapping.
+        """
+        return Case(
+            *[When(id=stock_id, then=Value(quantity)) for stock_id, quantity in quantities.items()],
+            default=Value(0),
+            output_field=models.PositiveIntegerField(),
+        )
+
+    @classmethod
+    def hold_units(cls, quantities):
+        """
+        Moves units of many products to units_hold with a fixed number of queries, all or nothing.
+
+        :param quantities: Mapping of stock id to the quantity being reserved.
+        :raise ValidationError: Naming the products without enough units, nothing is reserved.
+        """
+        if not quantities:
+            return 0
+        delta = cls._quantity_delta(quantities)
+        with transaction.atomic():
+            stocks = cls.objects.select_for_update().filter(id__in=quantities.keys()).values_list(
+                'id', 'units', 'product__name')
+            missing = [name for stock_id, units, name in stocks if units < quantities[stock_id]]
+            if missing:
+                raise ValidationError(f"O produto {', '.join(missing)}, não está disponível no momento.")
+
+            updated = cls.objects.filter(id__in=quantities.keys()).update(
+                units=F('units') - delta,
+                units_hold=F('units_hold') + delta,
+            )
+            # Products sold out by this reservation stop being listed
+            Product._base_manager.filter(stock__id__in=quantities.keys(), stock__units=0,
+                                         is_available=True).update(is_available=False)
+        Product.objects.clear_products_cache()
+        return updated
+
+    @classmethod
+    def release_holds(cls, quantities):
+        """
+        Moves held units back to the stock of many products with a single UPDATE.
+
+        :param quantities: Mapping of stock id to the quantity being released.
+        :return: Number of updated stocks.
+        """
+        if not quantities:
+            return 0
+        delta = cls._quantity_delta(quantities)
+        with transaction.atomic():
+            updated = cls.objects.filter(id__in=quantities.keys()).update(
+                units=F('units') + delta,
+                units_hold=Greatest(F('units_hold') - delta, Value(0)),
+            )
+            # Products sold out by the held units become available again
+            Product._base_manager.filter(stock__id__in=quantities.keys(), stock__units__gt=0,
+                                         is_available=False).update(is_available=True)
+        Product.objects.clear_products_cache()
+        return updated
+
+    @classmethod
+    def restore_sold(cls, quantities):
+        """
+        Moves sold units of many products back to the stock with a single UPDATE, used by bulk refunds.
+
+        :param quantities: Mapping of stock id to the quantity being restored.
+        :return: Number of updated stocks.
+        """
+        if not quantities:
+            return 0
+        delta = cls._quantity_delta(quantities)
+        with transaction.atomic():
+            updated = cls.objects.filter(id__in=quantities.keys()).update(
+                units=F('units') + delta,
+                units_sold=Greatest(F('units_sold') - delta, Value(0)),
+            )
+            Product._base_manager.filter(stock__id__in=quantities.keys(), stock__units__gt=0,
+                                         is_available=False).update(is_available=True)
+        Product.objects.clear_products_cache()
+        return updated
+
 
 class Promotion(StatusModel, TimeStampedModel):
     EXPIRADO = "Expirado"
@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.core.exceptions import ObjectDoesNotExist
@@ -37,17 +38,22 @@ def safe_delete_product_cache(product):
 @receiver(post_save, sender=Product)
 def product_post_save(sender, instance, **kwargs):
     safe_update_product_cache(instance)
-    # Fetch all related items where the order is still pending
-    pending_items = Item.objects.select_for_update().filter(
+    # Fetch all related items where the order is still pending and the price differs
+    pending_items = Item.objects.filter(
         product=instance,
         order__status=Order.Waiting_payment  # Adjust to your status choice
-    )
-
-    # Update the product_price in each related Item
-    for item in pending_items:
-        if item.price != instance.price:  # Update only if the price differs
-            item.price = Decimal(instance.price)  # Sync with new price
-            item.save(update_fields=['price'])
+    ).exclude(price=instance.price)
+    order_ids = list(pending_items.values_list('order_id', flat=True).distinct())
+    if not order_ids:
+        return
+
+    with transaction.atomic():
+        # Sync the price of every pending item and the persisted order totals in set-based updates
+        pending_items.update(price=Decimal(instance.price))
+        Order.objects.refresh_totals(order_ids)
+
+    customer_ids = Order.objects.filter(id__in=order_ids).values_list('customer_id', flat=True)
+    Order.objects.delete_cached_orders_for(customer_ids)
 
 
 @receiver(post_delete, sender=Product)
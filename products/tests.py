@@ -1,3 +1,19 @@
 from django.test import TestCase
 
-# Create your tests here.
+from pages.query_plans import QueryPlanAssertionsMixin
+from users.models import User
+from .models import Product, PromotionCode, PromotionCodeUsage, Stock
+
+
+class ProductQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    def test_checkout_lookups_use_indexes(self):
+        self.assertNoFullScan(Product.objects.filter(slug__in=['produto-1', 'produto-2']))
+        self.assertNoFullScan(Stock.objects.filter(product_id__in=[1, 2]))
+        self.assertNoFullScan(PromotionCode.objects.filter(code__in=['CUPOM10']).select_related('product'))
+
+    def test_coupon_usage_is_read_through_indexes(self):
+        user = User.objects.create_user(username='buyer', password='testpass')
+        self.assertNoFullScan(PromotionCodeUsage.objects.filter(promotion_code_id=1, user=user))
+
+    def test_category_listing_uses_the_category_index(self):
+        self.assertNoFullScan(Product.objects.filter(category_id=1))
@@ -1,8 +1,10 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
 from django.contrib.auth.models import Permission
 from django.db.models import Prefetch
+from django.http import HttpResponseRedirect
 
-from .models import RoleType, Role, User
+from .models import RoleType, Role, User, BalanceEntry
 
 from users.models import UserHistory
 
@@ -56,21 +58,18 @@ class UserAdmin(admin.ModelAdmin):
     search_fields = ['username', 'email']
     list_filter = ['is_staff', 'is_superuser', 'is_active']
     ordering = ['username']
-    readonly_fields = ['last_login', 'date_joined']
+    # The balance is a projection of the ledger, changes are made with balance entries
+    readonly_fields = ['last_login', 'date_joined', 'balance', 'active_roles']
     filter_horizontal = ['user_permissions']
     inlines = [RoleInline]  # Use optimized RoleInline
 
     def get_queryset(self, request):
-        # Prefetch related data for user permissions and roles
+        # Prefetch related data for user permissions, the roles are read from the active_roles snapshot
         return super().get_queryset(request).prefetch_related(
             Prefetch(
                 'user_permissions',
                 queryset=Permission.objects.select_related('content_type')
             ),
-            Prefetch(
-                'roles',
-                queryset=Role.objects.select_related('role_type'),
-            )
         )
 
     fieldsets = (
@@ -78,7 +77,7 @@ class UserAdmin(admin.ModelAdmin):
         ('Personal info', {'fields': ('first_name', 'last_name', 'email', 'birth_date', 'tos_accept')}),
         ('Permissions', {'fields': ('is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions')}),
         ('Important dates', {'fields': ('last_login', 'date_joined')}),
-        ('Other Info', {'fields': ('balance',)}),
+        ('Other Info', {'fields': ('balance', 'active_roles')}),
     )
 
     def formfield_for_manytomany(self, db_field, request, **kwargs):
@@ -95,3 +94,59 @@ class UserHistoryAdmin(admin.ModelAdmin):
 
     def get_queryset(self, *args, **kwargs):
         return super().get_queryset(*args, **kwargs).select_related('user')
+
+
+class BalanceEntryForm(forms.ModelForm):
+    class Meta:
+        model = BalanceEntry
+        fields = ['user', 'kind', 'amount', 'payment_id']
+
+    def clean(self):
+        cleaned_data = super().clean()
+        user, amount = cleaned_data.get('user'), cleaned_data.get('amount')
+        if user and amount is not None and amount < 0 and user.get_balance() + amount < 0:
+            raise forms.ValidationError("Saldo insuficiente para este débito.")
+        return cleaned_data
+
+
+@admin.register(BalanceEntry)
+class BalanceEntryAdmin(admin.ModelAdmin):
+    form = BalanceEntryForm
+    list_display = ['id', 'user', 'kind', 'amount', 'payment_id', 'created']
+    list_filter = ['kind']
+    search_fields = ['user__username', 'payment_id']
+    autocomplete_fields = ['user']
+    readonly_fields = ['created']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user')
+
+    def has_change_permission(self, request, obj=None):
+        # Append-only, corrections are new entries
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def save_model(self, request, obj, form, change):
+        if obj.amount >= 0:
+            entry = BalanceEntry.objects.credit(obj.user_id, obj.amount, obj.kind, payment_id=obj.payment_id)
+            obj.pk = entry.pk
+            return
+        # Debits go through the conditional insert, the form check may be outdated by a concurrent payment
+        entry_id = BalanceEntry.objects.debit(obj.user_id, -obj.amount, obj.kind, payment_id=obj.payment_id)
+        if entry_id is None:
+            messages.error(request, "Saldo insuficiente para este débito, a movimentação não foi registrada.")
+            return
+        obj.pk = entry_id
+
+    def log_addition(self, request, obj, message):
+        if obj.pk is None:
+            return None
+        return super().log_addition(request, obj, message)
+
+    def response_add(self, request, obj, post_url_continue=None):
+        if obj.pk is None:
+            # Debit refused by save_model, back to the add form
+            return HttpResponseRedirect(request.get_full_path())
+        return super().response_add(request, obj, post_url_continue)
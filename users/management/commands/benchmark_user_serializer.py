@@ -0,0 +1,95 @@
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch
+from django.utils import timezone
+from rest_framework import serializers
+
+from users.models import Role, User
+from users.serializers import UserSerializer, can_view_user
+
+
+class LegacyUserSerializer(serializers.ModelSerializer):
+    """
+    Field by field serialization, one permission check per method field, as before the fast path.
+    """
+    full_name = serializers.SerializerMethodField()
+    role_info = serializers.SerializerMethodField()
+    role_icon = serializers.SerializerMethodField()
+    date_joined = serializers.SerializerMethodField()
+    last_login = serializers.SerializerMethodField()
+    is_staff = serializers.SerializerMethodField()
+    is_active = serializers.SerializerMethodField()
+    is_authenticated = serializers.SerializerMethodField()
+
+    class Meta(UserSerializer.Meta):
+        pass
+
+    def check_permission(self, obj):
+        return can_view_user(self.context.get('request'), obj)
+
+    def get_full_name(self, obj):
+        if self.check_permission(obj):
+            return obj.get_full_name() if obj.is_active else None
+
+    def get_role_info(self, obj):
+        if self.check_permission(obj):
+            return obj.get_role_info()
+
+    def get_role_icon(self, obj):
+        if self.check_permission(obj):
+            return obj.get_role_icon()
+
+    def get_date_joined(self, obj):
+        if self.check_permission(obj):
+            date_joined = timezone.localtime(obj.date_joined) if obj.date_joined else None
+            return date_joined.strftime("%d/%m/%Y") if date_joined else None
+
+    def get_last_login(self, obj):
+        if self.check_permission(obj):
+            last_login = timezone.localtime(obj.last_login) if obj.last_login else None
+            return last_login.strftime("%d/%m/%Y - %H:%M:%S") if last_login else None
+
+    def get_is_staff(self, obj):
+        if self.check_permission(obj):
+            return obj.is_staff
+
+    def get_is_active(self, obj):
+        if self.check_permission(obj):
+            return obj.is_active
+
+    def get_is_authenticated(self, obj):
+        if self.check_permission(obj):
+            return obj.is_authenticated
+
+
+class Command(BaseCommand):
+    help = "Compara o tempo do caminho rápido do UserSerializer com a serialização campo a campo."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, help="Usuário serializado, o primeiro por padrão.")
+        parser.add_argument('--iterations', type=int, default=2000,
+                            help="Quantidade de serializações medidas em cada caminho.")
+
+    def handle(self, *args, **options):
+        users = User._base_manager.prefetch_related(
+            Prefetch('roles', queryset=Role.objects.select_related('role_type'))).order_by('id')
+        if options['user_id']:
+            users = users.filter(id=options['user_id'])
+        user = users.first()
+        if user is None:
+            raise CommandError("Nenhum usuário encontrado.")
+
+        iterations = options['iterations']
+        context = {'request': user}
+        legacy_data = LegacyUserSerializer(user, context=context).data
+        fast_data = UserSerializer(user, context=context).data
+        if dict(legacy_data) != dict(fast_data):
+            raise CommandError(f"Os caminhos divergem: {dict(legacy_data)} != {dict(fast_data)}")
+
+        legacy = timeit.timeit(lambda: LegacyUserSerializer(user, context=context).data, number=iterations)
+        fast = timeit.timeit(lambda: UserSerializer(user, context=context).data, number=iterations)
+        self.stdout.write(self.style.SUCCESS(
+            f"Campo a campo: {legacy / iterations * 1e6:.1f}µs, caminho rápido: {fast / iterations * 1e6:.1f}µs "
+            f"por serialização ({legacy / fast:.1f}x mais rápido, {iterations} iterações)."
+        ))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.services import expire_roles, rebuild_role_snapshots, seconds_until
+
+
+class Command(BaseCommand):
+    help = ("Marca como expirados os cargos com a data de expiração vencida. "
+            "Com --loop continua rodando, dormindo até a próxima expiração.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Quantidade de cargos expirados por UPDATE.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Continua rodando, acordando na próxima expiração.")
+        parser.add_argument('--max-sleep', type=float, default=60 * 60,
+                            help="Tempo máximo, em segundos, entre duas varreduras no modo --loop.")
+        parser.add_argument('--rebuild-snapshots', action='store_true',
+                            help="Reconstrói antes o resumo de cargos ativos de todos os usuários.")
+
+    def handle(self, *args, **options):
+        if options['rebuild_snapshots']:
+            report = rebuild_role_snapshots(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Resumo de cargos ativos reconstruído para {report['users']} usuários ({report['duration']}s)."
+            ))
+        while True:
+            report = expire_roles(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"{report['expired']} cargos expirados de {report['users']} usuários "
+                f"({report['duration']}s), próxima expiração: {report['next_expiry'] or 'nenhuma'}."
+            ))
+            if not options['loop']:
+                return
+            time.sleep(seconds_until(report['next_expiry'], options['max_sleep']))
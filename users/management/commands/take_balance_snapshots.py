@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from users.models import BalanceEntry
+
+
+class Command(BaseCommand):
+    help = "Consolida as movimentações de saldo nas fotografias de saldo dos usuários e atualiza o saldo exibido."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Quantidade de usuários consolidados por transação.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        user_ids = list(BalanceEntry.objects.pending_snapshot_user_ids())
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            BalanceEntry.objects.take_snapshot(batch)
+            BalanceEntry.objects.refresh_projections(batch)
+        self.stdout.write(self.style.SUCCESS(f"{len(user_ids)} saldos consolidados."))
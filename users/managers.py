@@ -1,79 +1,470 @@
+import hashlib
+
 from django.contrib.auth.models import UserManager
 from django.core.cache import cache
-from django.core.exceptions import PermissionDenied
-from django.db import models
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import connection, models, transaction
+from django.db.models import Case, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.utils import timezone
+
+from datetime import timedelta
 
+from pages.invalidation import is_dirty, mark_dirty
+from pages.paginators import KeysetPaginator, window_covers
 
 
 class CachedUserManager(UserManager):
+    """
+    Identity map of users: one compact snapshot per user under its pk, plus username/email indexes pointing
+    to that pk, so every lookup of the same user reads and invalidates the same entry.
+    """
     CACHE_TIMEOUT = 60 * 60 * 2  # 2 hours
+    # Unique fields answered through an index, any other lookup goes straight to the database
+    INDEXED_FIELDS = ('username', 'email')
 
     @staticmethod
     def get_cache_key(user_id):
         return f"user_{user_id}_auth"
 
-    def get(self, *args, **kwargs):
-        user_id = kwargs.get('pk')
+    @staticmethod
+    def get_index_key(field, value):
+        # Hashed so any username or email is a valid cache key
+        return f"user_{field}_{hashlib.md5(str(value).encode()).hexdigest()}"
+
+    def _cacheable_lookup(self, args, kwargs):
+        """
+        Returns (field, value) when the lookup is a single exact match the identity map can answer, else None.
+        """
+        if args or len(kwargs) != 1:
+            return None
+        (field, value), = kwargs.items()
+        field = field.removesuffix('__exact')
+        if field in ('pk', 'id'):
+            try:
+                return 'pk', self.model._meta.pk.to_python(value)
+            except ValidationError:
+                return None
+        if field in self.INDEXED_FIELDS and isinstance(value, str):
+            return field, value
+        return None
+
+    def to_snapshot(self, user):
+        return {field.attname: getattr(user, field.attname) for field in self.model._meta.concrete_fields}
+
+    def from_snapshot(self, snapshot):
+        return self.model.from_db(self.db, list(snapshot), list(snapshot.values()))
+
+    def get_cached_snapshot(self, user_id):
         cache_key = self.get_cache_key(user_id)
-        user = cache.get(cache_key)
-        if not user:
+        # A snapshot with a pending invalidation is outdated by the current transaction
+        return None if is_dirty(cache_key) else cache.get(cache_key)
+
+    def get_cached_user(self, user_id):
+        """
+        Rebuilds the user from its cached snapshot, None when it isn't cached.
+        """
+        snapshot = self.get_cached_snapshot(user_id)
+        return self.from_snapshot(snapshot) if snapshot is not None else None
+
+    def cache_user(self, user, *index_fields):
+        """
+        Stores the snapshot under the pk and points the username index, plus the given ones, to it.
+        Email isn't unique, so its index is only written by lookups that proved it matches a single user.
+        """
+        if is_dirty(self.get_cache_key(user.pk)):
+            return
+        entries = {self.get_cache_key(user.pk): self.to_snapshot(user)}
+        for field in {'username', *index_fields}:
+            if getattr(user, field):
+                entries[self.get_index_key(field, getattr(user, field))] = user.pk
+        cache.set_many(entries, self.CACHE_TIMEOUT)
+
+    def invalidate_cached_user(self, user):
+        from .middlewares.cached_user import get_version_key, local_user_cache
+        local_user_cache.delete(user.pk)
+        # Deleted once the transaction commits, meanwhile cache_user doesn't store the uncommitted row.
+        # The version token makes the other processes drop their local copy too
+        mark_dirty(self.get_cache_key(user.pk), get_version_key(user.pk), *[
+            self.get_index_key(field, getattr(user, field)) for field in self.INDEXED_FIELDS if getattr(user, field)
+        ])
+
+    def get(self, *args, **kwargs):
+        lookup = self._cacheable_lookup(args, kwargs)
+        if lookup is None:
             user = super().get(*args, **kwargs)
-            if not user.is_active:
-                raise PermissionDenied("User account is disabled")
-            cache.set(cache_key, user, self.CACHE_TIMEOUT)
+        else:
+            field, value = lookup
+            user_id = value if field == 'pk' else cache.get(self.get_index_key(field, value))
+            user = self.get_cached_user(user_id) if user_id is not None else None
+            if user is not None and field != 'pk' and getattr(user, field) != value:
+                user = None  # Index left behind by a rename
+            if user is None:
+                user = super().get(**{field: value})
+                self.cache_user(user, *([field] if field != 'pk' else []))
+        if not user.is_active:
+            raise PermissionDenied("User account is disabled")
         return user
 
     def update(self, user, *args, **kwargs):
         super().update(user, *args, **kwargs)
-        cache_key = self.get_cache_key(user.id)
-        cache.set(cache_key, user, self.CACHE_TIMEOUT)
+        self.invalidate_cached_user(user)
         return user
 
     def delete(self, *args, **kwargs):
         user = self.get(*args, **kwargs)
-        cache_key = self.get_cache_key(user.id)
         super().delete(*args, **kwargs)
-        cache.delete(cache_key)
+        self.invalidate_cached_user(user)
 
 
 class UserHistoryManager(models.Manager):
+    """
+    Append-only cache of the histories: per user, a window of the most recent entries plus the id of the oldest
+    cached one, the cursor from which older entries are read from the database.
+    """
+    CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+    CACHE_WINDOW = getattr(settings, 'USER_HISTORIES_CACHE_WINDOW', 50)
+
     @staticmethod
     def get_history_cache_key(user_id):
         return f"user_{user_id}_histories"
 
     @staticmethod
-    def _serialize_history(historic):
+    def _serialize_histories(histories):
         from .serializers import UserHistorySerializer
-        return UserHistorySerializer(historic).data
+        return UserHistorySerializer(histories, many=True).data
+
+    def _build_window(self, user_id):
+        rows = list(self.filter(user=user_id).order_by('-id')[:self.CACHE_WINDOW + 1])
+        items = self._serialize_histories(rows[:self.CACHE_WINDOW])
+        # Without a cursor the window holds every history of the user
+        return {'items': items, 'cursor': items[-1]['id'] if len(rows) > self.CACHE_WINDOW else None}
 
     def get_cached_histories(self, user_id):
+        """
+        Retrieves the cached window of the user's most recent histories, newest first, or queries and caches it.
+        """
         cache_key = self.get_history_cache_key(user_id)
-        return cache.get_or_set(cache_key, lambda: self._get_all_histories(user_id))
+        dirty = is_dirty(cache_key)
+        window = None if dirty else cache.get(cache_key)
+        if window is None:
+            window = self._build_window(user_id)
+            if not dirty:
+                cache.set(cache_key, window, self.CACHE_TIMEOUT)
+        return window
+
+    def bulk_append(self, histories):
+        """
+        Inserts the histories with one bulk_create, which fires no post_save, and appends them to the cached
+        windows of their users once the transaction commits.
+
+        :return: The created histories.
+        """
+        created = self.bulk_create(histories)
+        if any(history.pk is None for history in created):
+            # Backends that don't return the inserted ids, the windows are rebuilt instead
+            mark_dirty(*[self.get_history_cache_key(user_id) for user_id in {history.user_id for history in created}])
+        elif created:
+            transaction.on_commit(lambda: self.append_histories(created))
+        return created
+
+    def append_histories(self, histories):
+        """
+        Prepends the new histories to the windows already cached, one read and one write for all the users.
+        Users without a cached window are left alone, their window is built on the next read.
+        """
+        by_user = {}
+        for history in sorted(histories, key=lambda history: history.id, reverse=True):
+            by_user.setdefault(history.user_id, []).append(history)
+        keys = {self.get_history_cache_key(user_id): user_id for user_id in by_user}
+        windows = {key: window for key, window in cache.get_many(keys).items() if not is_dirty(key)}
+        if not windows:
+            return
+
+        for key, window in windows.items():
+            cached_ids = {item['id'] for item in window['items']}
+            new_items = [item for item in self._serialize_histories(by_user[keys[key]])
+                         if item['id'] not in cached_ids]
+            items = new_items + window['items']
+            if len(items) > self.CACHE_WINDOW:
+                items = items[:self.CACHE_WINDOW]
+                window['cursor'] = items[-1]['id']
+            window['items'] = items
+        cache.set_many(windows, self.CACHE_TIMEOUT)
 
-    def update_historic(self, user_id, historic):
-        histories = self.get_cached_histories(user_id)
-        histories[historic.id] = self._serialize_history(historic)
-        self._set_cache(user_id, histories)
+    def invalidate_histories(self, user_id):
+        """
+        Drops the cached window of the user once the change commits, for edits and deletions.
+        """
+        mark_dirty(self.get_history_cache_key(user_id))
 
-    def delete_historic(self, user_id, historic):
-        histories = self.get_cached_histories(user_id)
-        histories.pop(historic.id, None)
-        self._set_cache(user_id, histories)
+    def search(self, query):
+        """
+        Matches the id, the type label or the info of the histories.
+        """
+        query = (query or '').strip().lower()
+        types = [value for value, label in self.model.type_choices if query in label.lower()]
+        return self.filter(Q(id__icontains=query) | Q(type__in=types) | Q(info__icontains=query))
 
-    def _get_all_histories(self, user_id):
-        histories = {
-            history.id: self._serialize_history(history)
-            for history in self.filter(user=user_id)
-        }
-        self._set_cache(user_id, histories)
-        return histories
+    def get_histories_page(self, user_id, token=None, per_page=10, search_query=''):
+        """
+        Keyset page of the user's histories, sliced from the cached window while it holds the whole page
+        and read from the database past the cursor. Searches always go through the database.
+        """
+        paginator = KeysetPaginator(per_page=per_page)
+        if search_query:
+            # Searches always run in the database, so a query matches the same histories whatever the window holds
+            queryset = self.search(search_query).filter(user=user_id)
+        else:
+            window = self.get_cached_histories(user_id)
+            histories = window['items']
+            if window['cursor'] is None or window_covers([history['id'] for history in histories], token, per_page):
+                return paginator.get_page(histories, token)
+            queryset = self.filter(user=user_id)
 
-    def _set_cache(self, user_id, histories):
-        cache.set(self.get_history_cache_key(user_id), histories, getattr(settings, 'CACHE_TIMEOUT', 60 * 60 * 24 * 7))
+        page = paginator.get_page(queryset, token)
+        page.object_list = self._serialize_histories(page.object_list)
+        return page
 
 
 class RoleManager(models.Manager):
 
     def get_queryset(self, *args, **kwargs):
         return super().get_queryset(*args, **kwargs).select_related('role_type', 'user')
+
+    def grant(self, grants):
+        """
+        Grants or extends many roles set-wise: one locked read of the existing roles, one bulk UPDATE of their
+        expiry dates, one INSERT of the new roles, one rebuild of the users active roles snapshots and one
+        invalidation of each user once the transaction commits.
+        Expired roles restart from now, active ones are extended from their current expiry date.
+
+        :param grants: Iterable of (user_id, role_type), a repeated pair extends the role once per occurrence.
+        :return: The created and the extended roles.
+        """
+        from .models import Role
+
+        durations, role_types = {}, {}
+        for user_id, role_type in grants:
+            pair = (user_id, role_type.pk)
+            durations[pair] = durations.get(pair, timedelta()) + role_type.effective_days
+            role_types[role_type.pk] = role_type
+        if not durations:
+            return [], []
+
+        now = timezone.now()
+        with transaction.atomic():
+            existing = {}
+            for role in (self.model._base_manager.select_for_update()
+                         .filter(user_id__in={user_id for user_id, _ in durations},
+                                 role_type_id__in=role_types.keys()).order_by('-modified', '-id')):
+                # The last modified role of a pair is the one extended, like the previous filter().first()
+                # ordered by Role.Meta.ordering
+                existing.setdefault((role.user_id, role.role_type_id), role)
+
+            extended, created = [], []
+            for (user_id, role_type_id), duration in durations.items():
+                role = existing.get((user_id, role_type_id))
+                if role is None:
+                    created.append(self.model(user_id=user_id, role_type=role_types[role_type_id],
+                                              expires_at=now + duration, status=Role.active))
+                    continue
+                start = role.expires_at if role.expires_at and role.expires_at > now else now
+                role.expires_at = start + duration
+                role.status = Role.active
+                role.modified = now
+                extended.append(role)
+
+            self.bulk_update(extended, ['expires_at', 'status', 'modified'])
+            self.bulk_create(created)
+            self.refresh_snapshots({user_id for user_id, _ in durations})
+        return created, extended
+
+    @staticmethod
+    def to_snapshot_entry(role):
+        return {'id': role.id, 'role_type': role.role_type_id, 'icon': role.role_type.icon,
+                'name': role.role_type.name, 'description': role.role_type.description,
+                'expires_at': role.expires_at.isoformat() if role.expires_at else None}
+
+    def refresh_snapshots(self, user_ids):
+        """
+        Rebuilds User.active_roles of the users with one read of their active roles and one UPDATE,
+        then drops their cached data once the current transaction commits.
+
+        :return: The new snapshots by user id.
+        """
+        from .middlewares.cached_user import get_user_cache_keys, local_user_cache
+        from .models import Role, User
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return {}
+        snapshots = {user_id: [] for user_id in user_ids}
+        for role in (self.filter(user_id__in=user_ids).exclude(status=Role.expired)
+                     .select_related(None).select_related('role_type')):
+            snapshots[role.user_id].append(self.to_snapshot_entry(role))
+        User._base_manager.filter(pk__in=user_ids).update(active_roles=Case(
+            *[When(pk=user_id, then=Value(snapshot, output_field=models.JSONField()))
+              for user_id, snapshot in snapshots.items()],
+            output_field=models.JSONField()
+        ))
+        for user_id in user_ids:
+            local_user_cache.delete(user_id)
+        mark_dirty(*[key for user_id in user_ids for key in get_user_cache_keys(user_id)])
+        return snapshots
+
+    def due_for_expiry(self, now=None):
+        """
+        Roles past their expiry date still stored as not expired, walked through the expires_at index.
+        """
+        from .models import Role
+        return self.filter(expires_at__lte=now or timezone.now()).exclude(status=Role.expired)
+
+    def next_expiry(self):
+        """
+        Earliest expiry date among the roles not expired yet, None when no role will expire.
+        """
+        from .models import Role
+        return (self.filter(expires_at__isnull=False).exclude(status=Role.expired)
+                .order_by('expires_at').values_list('expires_at', flat=True).first())
+
+
+class BalanceEntryManager(models.Manager):
+    """
+    Append-only balance ledger: balance = snapshot + sum of the entries not folded into it yet.
+    """
+
+    @staticmethod
+    def _snapshot_model():
+        from .models import BalanceSnapshot
+        return BalanceSnapshot
+
+    def ensure_snapshot(self, user_id):
+        """
+        Creates the first snapshot of a user from the User.balance column, the balance before the ledger existed.
+        """
+        from .models import User
+        snapshot_model = self._snapshot_model()
+        if not snapshot_model.objects.filter(user_id=user_id).exists():
+            balance = User._base_manager.filter(pk=user_id).values_list('balance', flat=True).first() or 0
+            snapshot_model.objects.get_or_create(user_id=user_id, defaults={'balance': balance})
+
+    def _unfolded_total(self):
+        return self.filter(user_id=OuterRef('user_id'), folded=False).values('user_id').annotate(
+            total=Sum('amount')).values('total')
+
+    def _balances_queryset(self, user_ids):
+        return self._snapshot_model().objects.filter(user_id__in=user_ids).annotate(
+            spendable=models.F('balance') + Coalesce(Subquery(self._unfolded_total()), Value(0),
+                                                     output_field=models.DecimalField(max_digits=10, decimal_places=2))
+        )
+
+    def get_balances(self, user_ids):
+        return dict(self._balances_queryset(user_ids).values_list('user_id', 'spendable'))
+
+    def get_balance(self, user_id):
+        self.ensure_snapshot(user_id)
+        return self.get_balances([user_id]).get(user_id, 0)
+
+    def _lock_snapshots(self, user_ids):
+        """
+        Locks the snapshot rows in user order, the per-user lock taken by every ledger write.
+        Must run inside a transaction.
+        """
+        for user_id in user_ids:
+            self.ensure_snapshot(user_id)
+        return list(self._snapshot_model().objects.select_for_update().filter(
+            user_id__in=user_ids).order_by('user_id').values_list('user_id', flat=True))
+
+    def credit(self, user_id, amount, kind, payment_id=None):
+        with transaction.atomic():
+            self._lock_snapshots([user_id])
+            entry = self.create(user_id=user_id, amount=amount, kind=kind, payment_id=payment_id)
+        self.schedule_projection([user_id])
+        return entry
+
+    def bulk_credit(self, entries):
+        """
+        :param entries: BalanceEntry instances with positive amounts.
+        """
+        user_ids = sorted({entry.user_id for entry in entries})
+        with transaction.atomic():
+            self._lock_snapshots(user_ids)
+            created = self.bulk_create(entries)
+        self.schedule_projection(user_ids)
+        return created
+
+    def debit(self, user_id, amount, kind, payment_id=None):
+        """
+        Appends a debit only if the balance stays non-negative, with a single conditional INSERT.
+        Writes of a user are serialized on the row of its snapshot.
+
+        :return: Id of the recorded entry, None when the balance is insufficient.
+        """
+        entries_table = self.model._meta.db_table
+        snapshots_table = self._snapshot_model()._meta.db_table
+        with transaction.atomic():
+            self._lock_snapshots([user_id])
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {entries_table} (user_id, kind, amount, payment_id, folded, created) "
+                    f"SELECT %s, %s, %s, %s, %s, %s "
+                    f"WHERE ROUND((SELECT s.balance + COALESCE((SELECT SUM(e.amount) FROM {entries_table} e "
+                    f"WHERE e.user_id = s.user_id AND e.folded = %s), 0) "
+                    f"FROM {snapshots_table} s WHERE s.user_id = %s) - %s, 2) >= 0 "
+                    f"RETURNING id",
+                    [user_id, kind, -amount, payment_id, False, timezone.now(), False, user_id, amount]
+                )
+                row = cursor.fetchone()
+        if row is None:
+            return None
+        self.schedule_projection([user_id])
+        return row[0]
+
+    def take_snapshot(self, user_ids):
+        """
+        Folds the entries of the users into their snapshots, keeping the balance reads short.
+        No entry of a locked user can be written meanwhile, so the entries summed by the UPDATE
+        are exactly the ones flagged as folded after it.
+        """
+        with transaction.atomic():
+            locked = self._lock_snapshots(user_ids)
+            self._snapshot_model().objects.filter(user_id__in=locked).update(
+                balance=models.F('balance') + Coalesce(
+                    Subquery(self._unfolded_total()), Value(0),
+                    output_field=models.DecimalField(max_digits=10, decimal_places=2)),
+                modified=timezone.now(),
+            )
+            self.filter(user_id__in=locked, folded=False).update(folded=True)
+        return len(locked)
+
+    def pending_snapshot_user_ids(self):
+        """
+        Users with entries not folded into their snapshot yet.
+        """
+        return self.filter(folded=False).values_list('user_id', flat=True).distinct().order_by('user_id')
+
+    def schedule_projection(self, user_ids):
+        user_ids = list(user_ids)
+        transaction.on_commit(lambda: self.refresh_projections(user_ids))
+
+    def refresh_projections(self, user_ids):
+        """
+        Copies the ledger balance into User.balance, the cached projection shown in profiles and admin.
+        The balance is read under the snapshot locks, so of two close commits the later balance is written last.
+        """
+        from .models import User
+        from .middlewares.cached_user import get_user_cache_keys, local_user_cache
+        with transaction.atomic():
+            self._lock_snapshots(sorted(user_ids))
+            balances = self.get_balances(user_ids)
+            if not balances:
+                return
+            User._base_manager.filter(pk__in=balances.keys()).update(balance=Case(
+                *[When(pk=user_id, then=Value(balance)) for user_id, balance in balances.items()],
+                output_field=models.DecimalField(max_digits=10, decimal_places=2)
+            ))
+            for user_id in balances:
+                local_user_cache.delete(user_id)
+            mark_dirty(*[key for user_id in balances for key in get_user_cache_keys(user_id)])
@@ -1,59 +1,173 @@
+import threading
+import time
+import uuid
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
 from django.contrib.auth.middleware import AuthenticationMiddleware
-from django.utils.functional import SimpleLazyObject
+from django.contrib.auth.models import AnonymousUser
 from django.core.cache import cache
-from django.contrib.auth import get_user_model
-
-from users.serializers import UserSerializer
+from django.core.exceptions import PermissionDenied
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
 
 User = get_user_model()
 
+L1, SHARED, DATABASE = 'l1', 'cache', 'db'
+
+
+def get_version_key(user_id):
+    return f"user_{user_id}_version"
+
 
 def get_user_cache_keys(user_id):
-    return [f"user_{user_id}_auth", f"user_{user_id}_profile"]
+    return [f"user_{user_id}_auth", f"user_{user_id}_profile", get_version_key(user_id)]
+
+
+class LocalUserCache:
+    """
+    Per-process TTL cache of user snapshots, in front of the shared cache.
+    Each entry keeps the version token of the user in the shared cache, every invalidation deletes that token,
+    so the other processes drop their copy on the next request instead of when it expires.
+    """
+
+    def __init__(self, timeout=None, max_entries=None):
+        self._timeout = timeout
+        self._max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return self._timeout if self._timeout is not None else getattr(settings, 'AUTH_LOCAL_CACHE_TIMEOUT', 30)
+
+    @property
+    def max_entries(self):
+        return self._max_entries or getattr(settings, 'AUTH_LOCAL_CACHE_MAX_ENTRIES', 5000)
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, snapshot = entry
+        if expires_at < time.monotonic():
+            self.delete(user_id)
+            return None
+        return snapshot
+
+    def set(self, user_id, snapshot):
+        if self.timeout <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # Drops the oldest inserted entry, dicts keep the insertion order
+                self._entries.pop(next(iter(self._entries)), None)
+            self._entries[user_id] = (time.monotonic() + self.timeout, snapshot)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_user_cache = LocalUserCache()
 
 
 class CachedAuthenticationMiddleware(AuthenticationMiddleware):
-    CACHE_TIMEOUT = 60 * 15  # 15 minutes for caching
+    """
+    Replaces Django's AuthenticationMiddleware: resolves request.user lazily, reading the session once,
+    from the per-process cache, then the shared cache, then the database.
+    The time spent and the layer that answered are published in request.auth_timing and the Server-Timing header.
+    """
+
+    def process_request(self, request):
+        request.user = SimpleLazyObject(partial(self.get_user, request))
+        request.auser = partial(self.aget_user, request)
 
-    def get_user_from_cache(self, request):
-        """Retrieve the full user object from cache or database."""
+    def process_response(self, request, response):
+        timing = getattr(request, 'auth_timing', None)
+        if timing:
+            entry = f'auth;dur={timing["duration"] * 1000:.2f};desc="{timing["source"]}"'
+            response['Server-Timing'] = (f'{response["Server-Timing"]}, {entry}' if response.has_header('Server-Timing')
+                                         else entry)
+        return response
+
+    def get_user(self, request):
         if not hasattr(request, '_cached_user'):
-            user_id = request.session.get('_auth_user_id')
-            if user_id:
-                cache_keys = get_user_cache_keys(user_id)
-                # Try to fetch the full User instance from cache
-                user = cache.get(cache_keys[0])
-
-                if not user:
-                    # If not in cache, fetch from the database
-                    try:
-                        user = User.objects.get(pk=user_id)
-                    except User.DoesNotExist:
-                        user = None
-
-                    # Cache the full User instance for future requests
-                    if user:
-                        cache.set(cache_keys[0], user, self.CACHE_TIMEOUT)
-                        cache.set(cache_keys[1], UserSerializer(user).data, self.CACHE_TIMEOUT)
-
-                # Store the cached or freshly fetched User instance in request
-                request._cached_user = user
-            else:
-                request._cached_user = None
+            started_at = time.perf_counter()
+            user, source = self.resolve_user(request)
+            request.auth_timing = {'duration': time.perf_counter() - started_at, 'source': source}
+            request._cached_user = user
         return request._cached_user
 
-    def __call__(self, request):
-        request.user = SimpleLazyObject(lambda: self.get_user_from_cache(request))
-        response = self.get_response(request)
+    async def aget_user(self, request):
+        return await sync_to_async(self.get_user)(request)
 
-        # Clear the user cache on logout
-        if not request.user.is_authenticated and '_auth_user_id' in request.session:
-            self.clear_user_cache(request.session.get('_auth_user_id'))
+    def resolve_user(self, request):
+        """
+        :return: The authenticated user, or AnonymousUser, and the layer that answered.
+        """
+        session = request.session
+        user_id, backend_path = session.get(SESSION_KEY), session.get(BACKEND_SESSION_KEY)
+        if user_id is None or backend_path not in settings.AUTHENTICATION_BACKENDS:
+            return AnonymousUser(), None
 
-        return response
+        user, source = self.load_user(User._meta.pk.to_python(user_id))
+        if user is None or not user.is_active:
+            return AnonymousUser(), source
+
+        # Same session verification as django.contrib.auth.get_user
+        session_hash = session.get(HASH_SESSION_KEY)
+        session_auth_hash = user.get_session_auth_hash()
+        if session_hash and constant_time_compare(session_hash, session_auth_hash):
+            return user, source
+        if session_hash and any(constant_time_compare(session_hash, fallback_hash)
+                                for fallback_hash in user.get_session_auth_fallback_hash()):
+            session.cycle_key()
+            session[HASH_SESSION_KEY] = session_auth_hash
+            return user, source
+        session.flush()
+        return AnonymousUser(), source
+
+    @staticmethod
+    def get_version(user_id):
+        """
+        Version token of the user in the shared cache, created when missing.
+        It is read before the snapshot, an invalidation in between leaves the stored copy with an old token.
+        """
+        version_key = get_version_key(user_id)
+        version = cache.get(version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(version_key, version, User.objects.CACHE_TIMEOUT):
+                version = cache.get(version_key, version)
+        return version
+
+    def load_user(self, user_id):
+        """
+        Every request pays one shared-cache read of the version token, local hits included.
+        That round trip is what lets an invalidation from any process reach this one at once,
+        it stays cheaper than fetching and rebuilding the snapshot.
+        """
+        version = self.get_version(user_id)
+        entry = local_user_cache.get(user_id)
+        if entry is not None and entry[0] == version:
+            return User.objects.from_snapshot(entry[1]), L1
 
-    def clear_user_cache(self, user_id):
-        """Helper to clear the cached user instance."""
-        cache_keys = get_user_cache_keys(user_id)
-        cache.delete(cache_keys[0])
-        cache.delete(cache_keys[1])
+        snapshot = User.objects.get_cached_snapshot(user_id)
+        source = SHARED
+        if snapshot is None:
+            try:
+                # The manager also stores the snapshot in the shared cache
+                user = User.objects.get(pk=user_id)
+            except (User.DoesNotExist, PermissionDenied):
+                return None, DATABASE
+            snapshot = User.objects.to_snapshot(user)
+            source = DATABASE
+        local_user_cache.set(user_id, (version, snapshot))
+        return User.objects.from_snapshot(snapshot), source
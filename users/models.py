@@ -2,6 +2,7 @@ from django.contrib.auth.models import AbstractUser, Permission
 from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
@@ -12,7 +13,7 @@ from model_utils.models import TimeStampedModel, StatusModel
 
 from datetime import timedelta, date
 
-from users.managers import CachedUserManager, RoleManager, UserHistoryManager
+from users.managers import CachedUserManager, RoleManager, UserHistoryManager, BalanceEntryManager
 
 
 class RoleType(TimeStampedModel):
@@ -106,6 +107,8 @@ class User(AbstractUser):
     )
     tos_accept = models.BooleanField("Aceita os Termos de Serviço", default=False)
     birth_date = models.DateField("Date de Nascimento", blank=True, null=True)
+    # Snapshot of the active roles kept by RoleManager.refresh_snapshots, read without joining users_role
+    active_roles = models.JSONField("Cargos ativos", default=list, blank=True, editable=False)
 
     objects = CachedUserManager()
 
@@ -128,69 +131,72 @@ class User(AbstractUser):
         # Helper to get only active, non-expired roles
         return [role for role in self.get_roles() if role.role_type and not role.is_expired()]
 
-    def get_role_icon(self):
-        active_roles = self.get_active_roles()
-        return {role.role_type.id: role.role_type.icon for role in active_roles} if active_roles else ''
-
-    def get_role_info(self):
-        active_roles = self.get_active_roles()
-        return {role.role_type.id: (f"Cargo: {role.role_type.name}"
-                                    f"{', descrição: ' + role.role_type.description if
-                                    role.role_type.description else ''}")
+    def get_active_role_snapshot(self):
+        """
+        Active roles from the denormalized snapshot, the ones past their expiry date are left out
+        even before the sweeper marks them as expired.
+        """
+        now = timezone.now()
+        return [role for role in self.active_roles or []
+                if not role['expires_at'] or parse_datetime(role['expires_at']) > now]
+
+    def get_role_icon(self, active_roles=None):
+        active_roles = self.get_active_role_snapshot() if active_roles is None else active_roles
+        return {role['role_type']: role['icon'] for role in active_roles} if active_roles else ''
+
+    def get_role_info(self, active_roles=None):
+        active_roles = self.get_active_role_snapshot() if active_roles is None else active_roles
+        return {role['role_type']: (f"Cargo: {role['name']}"
+                                    f"{', descrição: ' + role['description'] if role['description'] else ''}")
                 for role in active_roles} if active_roles else ''
 
-    def verify_pay_action(self, amount):
+    def get_balance(self):
         """
-        Check if the user has sufficient balance for the full amount.
+        Spendable balance from the ledger, User.balance is only its cached projection.
         """
-        if amount <= 0:
-            raise ValueError("Amount must be positive.")
-        return self.balance >= amount
+        return BalanceEntry.objects.get_balance(self.pk)
 
     def pay_with_balance(self, payment):
         """
         Deduct the amount from the user's balance if possible, and return a tuple indicating success and amount used.
         If balance is insufficient, use the entire balance.
         """
-        # Lock the user's balance row for update
         amount, payment_id = Decimal(payment.amount), payment.id
-        try:
-            with transaction.atomic():
-                user = User.objects.select_for_update().get(pk=self.pk)
-
-                if user.verify_pay_action(amount):
-                    # User can pay the entire amount
-                    user.balance = Decimal(user.balance) - amount
-                    user.save(update_fields=['balance'])
-                    history = UserHistory(user_id=user.id,
-                                          info=f'Saldo utilizado: {Decimal(amount)}, no pagamento #{payment_id}.',
-                                          type=UserHistory.user_balance,
-                                          link=reverse('payments:payment_detail',
-                                                       kwargs={"payment_id": payment_id}))
-                    return True, history
-                else:
-                    # User can pay only part of the amount
-                    paid = Decimal(user.balance)
-                    return False, paid
-        except Exception:
-            raise
+        if amount <= 0:
+            raise ValueError("Amount must be positive.")
+
+        # Conditional insert in the ledger, the users row is never locked
+        if BalanceEntry.objects.debit(self.pk, amount, BalanceEntry.payment, payment_id=payment_id):
+            history = UserHistory(user_id=self.pk,
+                                  info=f'Saldo utilizado: {amount}, no pagamento #{payment_id}.',
+                                  type=UserHistory.user_balance,
+                                  link=reverse('payments:payment_detail', kwargs={"payment_id": payment_id}))
+            return True, history
+        # User can pay only part of the amount
+        return False, self.get_balance()
+
+    def pay_part_with_balance(self, payment, amount):
+        """
+        Debits the part of the payment covered by the balance, the rest is charged by the gateway.
+        It is given back if the payment doesn't complete.
+
+        :return: The UserHistory of the debit, None when the balance no longer covers the amount.
+        """
+        payment_id = payment.id
+        if not BalanceEntry.objects.debit(self.pk, amount, BalanceEntry.partial_payment, payment_id=payment_id):
+            return None
+        return UserHistory(user_id=self.pk,
+                           info=f'Saldo utilizado: {amount}, no pagamento #{payment_id}.',
+                           type=UserHistory.user_balance,
+                           link=reverse('payments:payment_detail', kwargs={"payment_id": payment_id}))
 
     def refund_to_balance(self, payment):
-        try:
-            with transaction.atomic():
-                payment_id, payment_amount = payment.id, payment.amount
-                user = User.objects.select_for_update().get(pk=self.pk)
-                user.balance += Decimal(payment_amount)
-                user.save(update_fields=['balance'])
-                history = UserHistory(user_id=user.id,
-                                      info=f'Saldo reembolsado: {Decimal(payment_amount)}, do pagamento #{payment_id}.',
-                                      type=UserHistory.user_balance_refund,
-                                      link=reverse('payments:payment_detail',
-                                                   kwargs={"payment_id": payment_id})
-                                      )
-                return history
-        except Exception:
-            raise
+        payment_id, payment_amount = payment.id, Decimal(payment.amount)
+        BalanceEntry.objects.credit(self.pk, payment_amount, BalanceEntry.refund, payment_id=payment_id)
+        return UserHistory(user_id=self.pk,
+                           info=f'Saldo reembolsado: {payment_amount}, do pagamento #{payment_id}.',
+                           type=UserHistory.user_balance_refund,
+                           link=reverse('payments:payment_detail', kwargs={"payment_id": payment_id}))
 
     class Meta:
         ordering = ['username']
@@ -221,7 +227,9 @@ class UserHistory(TimeStampedModel):
         (payment_fail, 'Pagamento falhou'),
     ]
 
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Usuário', on_delete=models.CASCADE)
+    # Indexed by the (user, -id) composite below
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Usuário', on_delete=models.CASCADE,
+                             db_index=False)
     type = models.CharField(verbose_name='Tipo', max_length=50, choices=type_choices, default=user_balance)
     info = models.TextField(verbose_name='Informação', max_length=500, blank=True, null=True)
     link = models.TextField(verbose_name='Link', max_length=500, blank=True, null=True)
@@ -229,9 +237,66 @@ class UserHistory(TimeStampedModel):
     objects = UserHistoryManager()
 
     class Meta:
-        ordering = ['user']
+        # Ordering by 'user' joined users_user to sort by username, every listing reads the newest first
+        ordering = ['-id']
         verbose_name = "histórico"
         verbose_name_plural = "históricos"
+        indexes = [
+            models.Index(fields=['user', '-id']),
+        ]
 
     def __str__(self):
         return f'Histórico do usuário {self.user}'
+
+
+class BalanceEntry(models.Model):
+    """
+    Append-only balance movement, credits are positive and debits negative.
+    """
+    payment, partial_payment, refund, adjustment = 'payment', 'partial_payment', 'refund', 'adjustment'
+    KIND_CHOICES = [
+        (payment, 'Pagamento'),
+        (partial_payment, 'Pagamento parcial'),
+        (refund, 'Reembolso'),
+        (adjustment, 'Ajuste'),
+    ]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Usuário', related_name='balance_entries',
+                             on_delete=models.CASCADE)
+    kind = models.CharField(verbose_name='Tipo', max_length=20, choices=KIND_CHOICES, default=adjustment)
+    amount = models.DecimalField(verbose_name='Valor', max_digits=10, decimal_places=2)
+    payment_id = models.BigIntegerField(verbose_name='Pagamento', null=True, blank=True)
+    folded = models.BooleanField(verbose_name='Consolidada', default=False, editable=False)
+    created = models.DateTimeField(verbose_name='Criado em', auto_now_add=True)
+
+    objects = BalanceEntryManager()
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = "movimentação de saldo"
+        verbose_name_plural = "movimentações de saldo"
+        indexes = [
+            models.Index(fields=['user', 'id']),
+            models.Index(fields=['user'], condition=models.Q(folded=False), name='balance_entry_unfolded'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} de {self.amount} para o usuário {self.user_id}'
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Balance of a user with its folded entries, the unfolded ones are summed on read.
+    Its row is also the lock of the user ledger writes, so they never lock users_user.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, verbose_name='Usuário', related_name='balance_snapshot',
+                                on_delete=models.CASCADE, primary_key=True)
+    balance = models.DecimalField(verbose_name='Saldo', max_digits=10, decimal_places=2, default=0)
+    modified = models.DateTimeField(verbose_name='Modificado em', auto_now=True)
+
+    class Meta:
+        verbose_name = "fotografia de saldo"
+        verbose_name_plural = "fotografias de saldo"
+
+    def __str__(self):
+        return f'Saldo do usuário {self.user_id}: {self.balance}'
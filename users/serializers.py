@@ -6,15 +6,58 @@ from rest_framework import serializers
 from .models import UserHistory, User
 
 
+# Built once, the fast path doesn't bind a field set per serialization
+BALANCE_FIELD = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+
+def can_view_user(viewer, user):
+    """
+    None without a viewer, True for staff or the user itself, raises PermissionDenied otherwise.
+    """
+    if not viewer:
+        return None
+    if viewer.is_staff or viewer.id == user.id:
+        return True
+    raise PermissionDenied('You cannot access this resource')
+
+
+def serialize_user(user, viewer=None):
+    """
+    Fast path of UserSerializer: checks the permission once, reads the active roles snapshot once and returns
+    a plain dict, with the same keys and values as the field by field serialization.
+    """
+    data = {'username': user.username, 'email': user.email}
+    if can_view_user(viewer, user):
+        active_roles = user.get_active_role_snapshot()
+        date_joined = timezone.localtime(user.date_joined) if user.date_joined else None
+        last_login = timezone.localtime(user.last_login) if user.last_login else None
+        data.update({
+            'is_staff': user.is_staff,
+            'date_joined': date_joined.strftime("%d/%m/%Y") if date_joined else None,
+            'last_login': last_login.strftime("%d/%m/%Y - %H:%M:%S") if last_login else None,
+            'is_active': user.is_active,
+            'is_authenticated': user.is_authenticated,
+            'full_name': user.get_full_name() if user.is_active else None,
+            'role_info': user.get_role_info(active_roles),
+            'role_icon': user.get_role_icon(active_roles),
+        })
+    else:
+        data.update(dict.fromkeys(('is_staff', 'date_joined', 'last_login', 'is_active', 'is_authenticated',
+                                   'full_name', 'role_info', 'role_icon')))
+    data['balance'] = BALANCE_FIELD.to_representation(user.balance) if user.balance is not None else None
+    return data
+
+
 class UserSerializer(serializers.ModelSerializer):
-    full_name = serializers.SerializerMethodField()
-    role_info = serializers.SerializerMethodField()
-    role_icon = serializers.SerializerMethodField()
-    date_joined = serializers.SerializerMethodField()
-    last_login = serializers.SerializerMethodField()
-    is_staff = serializers.SerializerMethodField()
-    is_active = serializers.SerializerMethodField()
-    is_authenticated = serializers.SerializerMethodField()
+    # Declared for the schema and the browsable API, the output is built by serialize_user
+    full_name = serializers.ReadOnlyField()
+    role_info = serializers.ReadOnlyField()
+    role_icon = serializers.ReadOnlyField()
+    date_joined = serializers.ReadOnlyField()
+    last_login = serializers.ReadOnlyField()
+    is_staff = serializers.ReadOnlyField()
+    is_active = serializers.ReadOnlyField()
+    is_authenticated = serializers.ReadOnlyField()
 
     class Meta:
         model = User
@@ -32,52 +75,8 @@ class UserSerializer(serializers.ModelSerializer):
             'balance'
         ]
 
-    def get_request(self):
-        return self.context.get('request')
-
-    def check_permission(self, obj):
-        request = self.get_request()
-        if not request:
-            return None
-        if request.is_staff:
-            return True
-        if request.id == obj.id:
-            return True
-        raise PermissionDenied('You cannot access this resource')
-
-    def get_full_name(self, obj):
-        if self.check_permission(obj):
-            return obj.get_full_name() if obj.is_active else None
-
-    def get_role_info(self, obj):
-        if self.check_permission(obj):
-            return obj.get_role_info()
-
-    def get_role_icon(self, obj):
-        if self.check_permission(obj):
-            return obj.get_role_icon()
-
-    def get_date_joined(self, obj):
-        if self.check_permission(obj):
-            date_joined = timezone.localtime(obj.date_joined) if obj.date_joined else None
-            return date_joined.strftime("%d/%m/%Y") if date_joined else None
-
-    def get_last_login(self, obj):
-        if self.check_permission(obj):
-            last_login = timezone.localtime(obj.last_login) if obj.last_login else None
-            return last_login.strftime("%d/%m/%Y - %H:%M:%S") if last_login else None
-
-    def get_is_staff(self, obj):
-        if self.check_permission(obj):
-            return obj.is_staff
-
-    def get_is_active(self, obj):
-        if self.check_permission(obj):
-            return obj.is_active
-
-    def get_is_authenticated(self, obj):
-        if self.check_permission(obj):
-            return obj.is_authenticated
+    def to_representation(self, instance):
+        return serialize_user(instance, self.context.get('request'))
 
 
 class UserHistorySerializer(serializers.ModelSerializer):
@@ -0,0 +1,62 @@
+import logging
+import time
+
+from django.utils import timezone
+
+from .models import Role, User
+
+logger = logging.getLogger('celery')
+
+
+def expire_roles(batch_size: int = 500) -> dict:
+    """
+    Marks the roles past their expiry date as expired, one UPDATE per batch walked through the expires_at index,
+    and drops the cached user data of the affected users once per batch.
+
+    :param batch_size: Roles expired per UPDATE.
+    :return: Report with the expired roles, affected users, the next expiry date and the duration in seconds.
+    """
+    started_at = time.monotonic()
+    now = timezone.now()
+    expired, user_ids = 0, set()
+
+    while True:
+        rows = list(Role.objects.due_for_expiry(now).order_by('expires_at').values_list('id', 'user_id')[:batch_size])
+        if not rows:
+            break
+        role_ids = [role_id for role_id, _ in rows]
+        batch_users = {user_id for _, user_id in rows}
+        expired += Role.objects.filter(id__in=role_ids).update(status=Role.expired, modified=now)
+        Role.objects.refresh_snapshots(batch_users)
+        user_ids |= batch_users
+
+    report = {
+        'expired': expired,
+        'users': len(user_ids),
+        'next_expiry': Role.objects.next_expiry(),
+        'duration': round(time.monotonic() - started_at, 3),
+    }
+    logger.info(f"Expired {expired} roles of {len(user_ids)} users, next expiry at {report['next_expiry']}.")
+    return report
+
+
+def rebuild_role_snapshots(batch_size: int = 500) -> dict:
+    """
+    Rebuilds the active roles snapshot of every user, batch by batch, for users created before the snapshot existed.
+
+    :return: Report with the rebuilt users and the duration in seconds.
+    """
+    started_at = time.monotonic()
+    user_ids = list(User._base_manager.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(user_ids), batch_size):
+        Role.objects.refresh_snapshots(user_ids[start:start + batch_size])
+    return {'users': len(user_ids), 'duration': round(time.monotonic() - started_at, 3)}
+
+
+def seconds_until(moment, max_sleep: float) -> float:
+    """
+    Seconds to sleep until the moment, capped so roles created meanwhile are not missed.
+    """
+    if moment is None:
+        return max_sleep
+    return min(max(0.0, (moment - timezone.now()).total_seconds()), max_sleep)
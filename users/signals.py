@@ -3,6 +3,7 @@ from django.dispatch import receiver
 from django.db.models.signals import post_save, post_delete
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.db import transaction
 
 from allauth.account.signals import (
     user_logged_in, user_logged_out, user_signed_up,
@@ -10,27 +11,42 @@ from allauth.account.signals import (
     email_confirmed, email_removed, email_changed, email_added
 )
 
-from users.serializers import UserSerializer
-from users.models import Role, UserHistory
+from users.serializers import serialize_user
+from users.models import Role, RoleType, UserHistory
 
 User = get_user_model()
 
 CACHE_TIMEOUT = settings.CACHE_TIMEOUT or 60 * 15  # Define your cache timeout centrally
 
 
+def refresh_role_snapshot(role):
+    snapshots = Role.objects.refresh_snapshots([role.user_id])
+    # Keeps the instance loaded with the role in sync, the profile signals serialize it right after
+    if Role.user.is_cached(role):
+        role.user.active_roles = snapshots[role.user_id]
+
+
 @receiver(post_save, sender=Role)
 def add_role(sender, instance, **kwargs):
     """
     Adds VIP or staff role when a new role is assigned.
     """
-    from .middlewares.cached_user import get_user_cache_keys
-    [cache.delete(cache_key) for cache_key in get_user_cache_keys(instance.user)]
+    refresh_role_snapshot(instance)
 
 
 @receiver(post_delete, sender=Role)
 def remove_role(sender, instance, **kwargs):
-    from .middlewares.cached_user import get_user_cache_keys
-    [cache.delete(cache_key) for cache_key in get_user_cache_keys(instance.user)]
+    refresh_role_snapshot(instance)
+
+
+@receiver(post_save, sender=RoleType)
+def update_role_type_snapshots(sender, instance, created, **kwargs):
+    """
+    The snapshots copy the icon, name and description of the role type.
+    """
+    if not created:
+        Role.objects.refresh_snapshots(
+            Role.objects.filter(role_type=instance).exclude(status=Role.expired).values_list('user_id', flat=True))
 
 
 def get_cache_key(user_id):
@@ -41,14 +57,16 @@ def get_cache_key(user_id):
 @receiver(post_save, sender=User)
 def update_cached_user(sender, instance, **kwargs):
     """Update the cached user data when a user instance is saved."""
+    # The identity map snapshot is rebuilt from the database on the next lookup
+    sender.objects.invalidate_cached_user(instance)
     cache_key = get_cache_key(instance.pk)
-    serializer = UserSerializer(instance, context={'request': instance})  # Serialize the user data
-    cache.set(cache_key, serializer.data, timeout=CACHE_TIMEOUT)  # Cache the serialized data
+    cache.set(cache_key, serialize_user(instance, instance), timeout=CACHE_TIMEOUT)  # Cache the serialized data
 
 
 @receiver(post_delete, sender=User)
 def remove_cached_user(sender, instance, **kwargs):
     """Remove the user from cache when the user is deleted."""
+    sender.objects.invalidate_cached_user(instance)
     cache_key = get_cache_key(instance.pk)
     cache.delete(cache_key)
 
@@ -66,8 +84,7 @@ def remove_cached_user(sender, instance, **kwargs):
 def cache_user_on_sign_in(sender, request, user, **kwargs):
     """Cache the user data when logged in, signed up, or user information is changed."""
     cache_key = get_cache_key(user.id)
-    serializer = UserSerializer(user, context={'request': user})  # Serialize the user data
-    cache.set(cache_key, serializer.data, timeout=CACHE_TIMEOUT)  # Cache the serialized data
+    cache.set(cache_key, serialize_user(user, user), timeout=CACHE_TIMEOUT)  # Cache the serialized data
 
 
 @receiver(user_logged_out)
@@ -78,10 +95,13 @@ def clear_user_cache_on_logout(sender, request, user, **kwargs):
 
 
 @receiver(post_save, sender=UserHistory)
-def update_user_histories(sender, instance, **kwargs):
-    sender.objects.update_historic(instance.user.id, instance)
+def update_user_histories(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: sender.objects.append_histories([instance]))
+    else:
+        sender.objects.invalidate_histories(instance.user_id)
 
 
 @receiver(post_delete, sender=UserHistory)
 def delete_user_histories(sender, instance, **kwargs):
-    sender.objects.delete_historic(instance.user.id, instance)
+    sender.objects.invalidate_histories(instance.user_id)
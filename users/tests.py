@@ -1,8 +1,25 @@
-from django.urls import reverse
-from django.test import TestCase, Client
-from users.models import User
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
 from unittest.mock import patch
+
 from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from pages.query_plans import QueryPlanAssertionsMixin, get_index_name
+from pages.testing import BuyerTestCase, CacheClearingTestCase
+from users.management.commands.benchmark_user_serializer import LegacyUserSerializer
+from users.managers import UserHistoryManager
+from users.middlewares.cached_user import CachedAuthenticationMiddleware, get_user_cache_keys, local_user_cache
+from users.models import BalanceEntry, BalanceSnapshot, Role, RoleType, User, UserHistory
+from users.serializers import UserSerializer, serialize_user
+from users.services import expire_roles, seconds_until
 
 
 class PerfilPageViewTest(TestCase):
@@ -12,7 +29,6 @@ class PerfilPageViewTest(TestCase):
         self.user2 = User.objects.create_user(username='user2', password='password2')
         self.profile_url_1 = reverse('pages:profile', kwargs={'user_id': self.user1.id})
         self.profile_url_2 = reverse('pages:profile', kwargs={'user_id': self.user2.id})
-        self.user_manager = User.objects
 
     def test_user_can_see_own_profile(self):
         # Log in the user
@@ -22,8 +38,8 @@ class PerfilPageViewTest(TestCase):
         # Access profile page
         response = self.client.get(self.profile_url_1)
 
-        # Assert 302 OK status
-        self.assertEqual(response.status_code, 302)
+        # Assert 200 OK status
+        self.assertEqual(response.status_code, 200)
         self.assertContains(response, self.user1.username)
 
     def test_user_cannot_see_other_users_profile(self):
@@ -34,7 +50,7 @@ class PerfilPageViewTest(TestCase):
         response = self.client.get(self.profile_url_2)
 
         # Assert 403 Forbidden status
-        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.status_code, 403)
 
     def test_unauthenticated_user_redirect(self):
         # Access the profile page without logging in
@@ -50,51 +66,48 @@ class PerfilPageViewTest(TestCase):
         # Log in as user1
         self.client.login(username='user1', password='password1')
 
-        # Try accessing a non-existent user's profile (user_id=0)
-        response = self.client.get(reverse('pages:profile', kwargs={'user_id': 0}))
+        # Try accessing a non-existent user's profile
+        response = self.client.get(reverse('pages:profile', kwargs={'user_id': self.user2.id + 1}))
 
-        # Assert 403 Forbidden
+        # Assert 403 Forbidden, like any profile of another user
         self.assertEqual(response.status_code, 403)
 
     def test_profile_data_cached(self):
         # Log in as user1
         self.client.login(username='user1', password='password1')
 
-        # Cache key for user1's profile
-        cache_key = f"user_{self.user1.id}_profile"
-        cache.delete(cache_key)  # Clear the cache
+        # Drop every cached copy of user1, the shared one and the one kept by this process
+        cache.delete_many(get_user_cache_keys(self.user1.id))
+        local_user_cache.clear()
 
         # First request (should hit the database)
         with patch('users.models.User.objects.get') as mock_get:
             mock_get.return_value = self.user1
             response = self.client.get(self.profile_url_1)
-            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.status_code, 200)
             mock_get.assert_called_once()  # Database is queried
-
-        # Simulate that the profile data is now cached
-        cache.set(cache_key, self.user1)
+            self.assertIn('auth;dur=', response['Server-Timing'])
+            self.assertIn('desc="db"', response['Server-Timing'])
 
         # Second request (should NOT hit the database)
         with patch('users.models.User.objects.get') as mock_get:
             response = self.client.get(self.profile_url_1)
-            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.status_code, 200)
             mock_get.assert_not_called()  # Cache is used
+            self.assertIn('desc="l1"', response['Server-Timing'])
 
     def test_inactive_user_profile_access(self):
         # Create an inactive user
         self.user1.is_active = False
         self.user1.save()
 
-        # Attempt to log in with the inactive user
+        # Inactive users can't log in
         login_successful = self.client.login(username='user1', password='password1')
-        self.assertTrue(login_successful, "Login should be attempted.")
+        self.assertFalse(login_successful, "Login should be refused.")
 
-        # Try accessing the profile page
+        # Try accessing the profile page, the user is sent to the login page
         response = self.client.get(self.profile_url_1)
-
-        # Assert that the response is a redirect to the account inactive page
-        self.assertEqual(response.status_code, 403)
-        self.assertRedirects(response, reverse('account_inactive'))  # Adjust this to your actual inactive account URL
+        self.assertRedirects(response, f"{reverse('account_login')}?next={self.profile_url_1}")
 
     def test_cache_expires_and_fetches_new_data(self):
         self.client.login(username='user1', password='password1')
@@ -103,21 +116,384 @@ class PerfilPageViewTest(TestCase):
         response = self.client.get(self.profile_url_1)
         self.assertEqual(response.status_code, 200)
 
-        # Expire the cache manually using the correct cache key logic
-        cache_key = self.user_manager.get_cache_key(self.user1.id)
-        cache.delete(cache_key)
+        # Expire every cached copy of user1, the shared one and the one kept by this process
+        cache.delete_many(get_user_cache_keys(self.user1.id))
+        local_user_cache.clear()
 
         # Fetch the profile again, should hit the database now
         with patch('users.models.User.objects.get') as mock_get:
             mock_get.return_value = self.user1
             response = self.client.get(self.profile_url_1)
-            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.status_code, 200)
             mock_get.assert_called()
 
     def test_sensitive_information_not_exposed(self):
         self.client.login(username='user1', password='password1')
         response = self.client.get(self.profile_url_1)
-        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.status_code, 200)
 
         # Check that password field is not in the response content
         self.assertNotContains(response, self.user1.password)
+
+
+class CachedAuthenticationMiddlewareTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='member', password='testpass')
+        self.client.login(username='member', password='testpass')
+        self.profile_url = reverse('pages:profile', kwargs={'user_id': self.user.id})
+
+    def tearDown(self):
+        cache.clear()
+        local_user_cache.clear()
+
+    def resolve(self):
+        request = RequestFactory().get('/')
+        request.session = self.client.session
+        middleware = CachedAuthenticationMiddleware(lambda request: HttpResponse())
+        middleware.process_request(request)
+        return request, middleware
+
+    def test_user_is_resolved_once_per_request_and_then_from_memory(self):
+        local_user_cache.clear()
+        request, _ = self.resolve()
+        self.assertEqual(request.user.pk, self.user.pk)
+        self.assertEqual(request.auth_timing['source'], 'db')  # The login saved last_login, dropping the snapshot
+        with self.assertNumQueries(0):
+            self.assertTrue(request.user.is_authenticated)
+            request, _ = self.resolve()
+            self.assertEqual(request.user.pk, self.user.pk)
+        self.assertEqual(request.auth_timing['source'], 'l1')
+
+    def test_password_change_ends_the_other_sessions(self):
+        self.assertEqual(self.client.get(self.profile_url).status_code, 200)
+        self.user.set_password('newpass')
+        self.user.save()
+        self.assertEqual(self.client.get(self.profile_url).status_code, 302)
+
+    def test_inactive_users_are_anonymous(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        cache.delete_many(get_user_cache_keys(self.user.pk))
+        local_user_cache.clear()
+        request, _ = self.resolve()
+        self.assertFalse(request.user.is_authenticated)
+
+    def test_invalidations_from_other_processes_reach_the_local_cache(self):
+        request, _ = self.resolve()
+        self.assertTrue(request.user.is_authenticated)
+        # Another process deactivates the user, only the shared cache is shared between them
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        cache.delete_many(get_user_cache_keys(self.user.pk))
+        self.assertIsNotNone(local_user_cache.get(self.user.pk))
+
+        request, _ = self.resolve()
+        self.assertFalse(request.user.is_authenticated)
+        self.assertEqual(request.auth_timing['source'], 'db')
+
+
+class UserSerializerFastPathTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='vip', email='vip@example.com', password='testpass',
+                                             first_name='Vera', last_name='Lima')
+        self.staff = User.objects.create_user(username='staff', password='testpass', is_staff=True)
+        self.other = User.objects.create_user(username='other', password='testpass')
+        role_type = RoleType.objects.create(name='VIP', description='Membro', price=Decimal('10.00'), icon='star')
+        Role.objects.create(user=self.user, role_type=role_type)
+
+    def test_fast_path_matches_the_field_by_field_serialization(self):
+        for viewer in (self.user, self.staff, None):
+            with self.subTest(viewer=viewer):
+                context = {'request': viewer}
+                self.assertEqual(UserSerializer(self.user, context=context).data,
+                                 LegacyUserSerializer(self.user, context=context).data)
+
+    def test_roles_are_read_from_the_snapshot(self):
+        with self.assertNumQueries(0):
+            data = serialize_user(self.user, self.user)
+        self.assertEqual(list(data['role_icon'].values()), ['star'])
+        self.assertIsInstance(data, dict)
+
+    def test_other_users_are_refused(self):
+        with self.assertRaises(PermissionDenied):
+            serialize_user(self.user, self.other)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_user_serializer', user_id=self.user.id, iterations=5, stdout=out)
+        self.assertIn('caminho rápido', out.getvalue())
+
+
+class ActiveRolesSnapshotTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='vip', password='testpass')
+        self.role_type = RoleType.objects.create(name='VIP', price=Decimal('10.00'), icon='star')
+
+    def test_snapshot_follows_the_role_signals(self):
+        role = Role.objects.create(user=self.user, role_type=self.role_type)
+        snapshot = User.objects.get(pk=self.user.pk).active_roles
+        self.assertEqual([(entry['id'], entry['icon']) for entry in snapshot], [(role.id, 'star')])
+
+        role.delete()
+        self.assertEqual(User.objects.get(pk=self.user.pk).active_roles, [])
+
+    def test_grant_and_sweeper_refresh_the_snapshot(self):
+        Role.objects.grant([(self.user.pk, self.role_type)])
+        self.assertEqual(User.objects.get(pk=self.user.pk).get_role_icon(), {self.role_type.pk: 'star'})
+
+        Role.objects.filter(user=self.user).update(expires_at=timezone.now() - timedelta(minutes=1))
+        expire_roles()
+        self.assertEqual(User.objects.get(pk=self.user.pk).active_roles, [])
+
+    def test_expired_entries_are_hidden_before_the_sweep(self):
+        Role.objects.create(user=self.user, role_type=self.role_type,
+                            expires_at=timezone.now() + timedelta(minutes=1))
+        user = User.objects.get(pk=self.user.pk)
+        with patch('users.models.timezone.now', return_value=timezone.now() + timedelta(minutes=2)):
+            self.assertEqual(user.get_role_icon(), '')
+
+    def test_role_type_changes_reach_the_snapshot(self):
+        Role.objects.create(user=self.user, role_type=self.role_type)
+        self.role_type.icon = 'crown'
+        self.role_type.save()
+        self.assertEqual(User.objects.get(pk=self.user.pk).get_role_icon(), {self.role_type.pk: 'crown'})
+
+    def test_command_rebuilds_the_snapshots(self):
+        Role.objects.create(user=self.user, role_type=self.role_type)
+        User.objects.filter(pk=self.user.pk).update(active_roles=[])
+        out = StringIO()
+        call_command('expire_roles', rebuild_snapshots=True, stdout=out)
+        self.assertEqual(len(User.objects.get(pk=self.user.pk).active_roles), 1)
+        self.assertIn('Resumo de cargos ativos reconstruído', out.getvalue())
+
+
+class UserHistoryCacheTests(BuyerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='buyer', password='testpass')
+
+    def add_histories(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            return UserHistory.objects.bulk_append([UserHistory(user=self.user, info=f'Histórico {index}')
+                                                    for index in range(count)])
+
+    def test_window_is_bounded_and_older_pages_come_from_the_database(self):
+        with patch.object(UserHistoryManager, 'CACHE_WINDOW', 5):
+            self.add_histories(3)
+            self.assertIsNone(UserHistory.objects.get_cached_histories(self.user.id)['cursor'])
+            created = self.add_histories(4)
+
+            window = cache.get(UserHistory.objects.get_history_cache_key(self.user.id))
+            self.assertEqual([item['id'] for item in window['items']], [history.id for history in created[::-1]] +
+                             list(UserHistory.objects.order_by('-id').values_list('id', flat=True)[4:5]))
+            self.assertEqual(window['cursor'], window['items'][-1]['id'])
+
+            first = UserHistory.objects.get_histories_page(self.user.id, per_page=3)
+            second = UserHistory.objects.get_histories_page(self.user.id, token=first.next_cursor, per_page=3)
+            with self.assertNumQueries(1):
+                third = UserHistory.objects.get_histories_page(self.user.id, token=second.next_cursor, per_page=3)
+        ids = [history['id'] for page in (first, second, third) for history in page]
+        self.assertEqual(ids, list(UserHistory.objects.order_by('-id').values_list('id', flat=True)))
+
+    def test_rolled_back_histories_are_never_cached(self):
+        UserHistory.objects.get_cached_histories(self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    UserHistory.objects.create(user=self.user, info='Cancelado')
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(cache.get(UserHistory.objects.get_history_cache_key(self.user.id))['items'], [])
+
+    def test_history_view_searches_the_database(self):
+        self.add_histories(2)
+        UserHistory.objects.get_cached_histories(self.user.id)
+        response = self.client.get(reverse('users:historic_list'), {'search': 'histórico 1'})
+        self.assertEqual([history['info'] for history in response.context['histories']], ['Histórico 1'])
+
+
+class CachedUserManagerTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice = User.objects.create_user(username='alice', email='alice@example.com', password='testpass')
+            self.bob = User.objects.create_user(username='bob', email='bob@example.com', password='testpass')
+        cache.clear()
+
+    def test_lookup_by_every_supported_field(self):
+        lookups = [{'pk': self.alice.pk}, {'id': self.alice.pk}, {'pk': str(self.alice.pk)},
+                   {'username': 'alice'}, {'username__exact': 'alice'}, {'email': 'alice@example.com'}]
+        for lookup in lookups:
+            with self.subTest(lookup=lookup):
+                self.assertEqual(User.objects.get(**lookup).pk, self.alice.pk)
+                with self.assertNumQueries(0):
+                    user = User.objects.get(**lookup)
+                self.assertEqual((user.pk, user.username, user.email), (self.alice.pk, 'alice', 'alice@example.com'))
+                self.assertTrue(user.check_password('testpass'))
+
+    def test_different_users_never_share_an_entry(self):
+        self.assertEqual(User.objects.get(username='alice').pk, self.alice.pk)
+        self.assertEqual(User.objects.get(username='bob').pk, self.bob.pk)
+        self.assertEqual(User.objects.get(email='bob@example.com').pk, self.bob.pk)
+        self.assertIsNone(cache.get(User.objects.get_cache_key(None)))
+
+    def test_snapshot_is_stored_instead_of_the_model(self):
+        User.objects.get(pk=self.alice.pk)
+        snapshot = cache.get(User.objects.get_cache_key(self.alice.pk))
+        self.assertIsInstance(snapshot, dict)
+        self.assertEqual(snapshot['username'], 'alice')
+
+    def test_rolled_back_changes_are_never_cached(self):
+        User.objects.get(pk=self.alice.pk)
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.alice.first_name = 'ROLLEDBACK'
+                self.alice.save()
+                self.assertEqual(User.objects.get(pk=self.alice.pk).first_name, 'ROLLEDBACK')
+                raise ValueError
+
+        self.assertEqual(User.objects.get(pk=self.alice.pk).first_name, '')
+        self.assertEqual(User.objects.get(username='alice').first_name, '')
+
+    def test_saving_invalidates_every_index(self):
+        User.objects.get(email='alice@example.com')
+        self.alice.username = 'alicia'
+        self.alice.save()
+
+        with self.assertRaises(User.DoesNotExist):
+            User.objects.get(username='alice')
+        self.assertEqual(User.objects.get(username='alicia').pk, self.alice.pk)
+        self.assertEqual(User.objects.get(email='alice@example.com').username, 'alicia')
+
+    def test_other_lookups_go_to_the_database(self):
+        User.objects.get(pk=self.alice.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(User.objects.get(email__iexact='ALICE@example.com').pk, self.alice.pk)
+
+
+class FakePayment:
+    def __init__(self, payment_id, amount):
+        self.id = payment_id
+        self.amount = Decimal(amount)
+
+
+class BalanceLedgerTests(BuyerTestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.filter(pk=self.user.pk).update(balance=Decimal('15.00'))
+
+    def test_first_read_starts_from_the_balance_column(self):
+        self.assertEqual(self.user.get_balance(), Decimal('15.00'))
+
+    def test_debit_never_makes_the_balance_negative(self):
+        paid, history = self.user.pay_with_balance(FakePayment(1, '10.00'))
+        self.assertTrue(paid)
+        self.assertEqual(history.type, 'user_balance')
+
+        paid, available = self.user.pay_with_balance(FakePayment(2, '10.00'))
+        self.assertFalse(paid)
+        self.assertEqual(available, Decimal('5.00'))
+        self.assertEqual(BalanceEntry.objects.filter(user=self.user).count(), 1)
+
+    def test_refund_and_projection_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.refund_to_balance(FakePayment(3, '2.50'))
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.balance, Decimal('17.50'))
+
+    def test_snapshot_command_folds_the_entries(self):
+        self.user.pay_with_balance(FakePayment(4, '5.00'))
+        self.user.refund_to_balance(FakePayment(5, '1.00'))
+
+        call_command('take_balance_snapshots', stdout=StringIO())
+
+        snapshot = BalanceSnapshot.objects.get(user=self.user)
+        self.assertEqual(snapshot.balance, Decimal('11.00'))
+        self.assertFalse(BalanceEntry.objects.filter(user=self.user, folded=False).exists())
+        self.assertEqual(self.user.get_balance(), Decimal('11.00'))
+
+    def test_entries_after_the_snapshot_are_summed_on_read(self):
+        self.user.pay_with_balance(FakePayment(6, '5.00'))
+        BalanceEntry.objects.take_snapshot([self.user.pk])
+
+        self.user.refund_to_balance(FakePayment(7, '2.00'))
+
+        self.assertEqual(list(BalanceEntry.objects.pending_snapshot_user_ids()), [self.user.pk])
+        self.assertEqual(self.user.get_balance(), Decimal('12.00'))
+        paid, available = self.user.pay_with_balance(FakePayment(8, '13.00'))
+        self.assertFalse(paid)
+        self.assertEqual(available, Decimal('12.00'))
+
+    def test_admin_reports_a_refused_debit(self):
+        admin_user = User.objects.create_superuser(username='admin', password='testpass', email='admin@example.com')
+        self.client.force_login(admin_user)
+        url = reverse('admin:users_balanceentry_add')
+        data = {'user': self.user.pk, 'kind': BalanceEntry.adjustment, 'amount': '-10.00', 'payment_id': ''}
+
+        # Balance spent by a payment between the form check and the conditional insert
+        with patch.object(BalanceEntry.objects, 'debit', return_value=None):
+            response = self.client.post(url, data, follow=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Saldo insuficiente')
+        self.assertFalse(BalanceEntry.objects.filter(user=self.user).exists())
+
+
+class ExpireRolesTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='vip', password='testpass')
+        self.role_type = RoleType.objects.create(name='VIP', price=Decimal('10.00'), icon='star')
+        self.role = Role.objects.create(user=self.user, role_type=self.role_type)
+
+    def test_expired_roles_are_swept_in_bulk(self):
+        now = timezone.now()
+        Role.objects.filter(pk=self.role.pk).update(expires_at=now - timedelta(minutes=1))
+        other = User.objects.create_user(username='other', password='testpass')
+        with self.captureOnCommitCallbacks(execute=True):
+            later = Role.objects.create(user=other, role_type=self.role_type)
+        cache.set_many({key: 'stale' for key in get_user_cache_keys(self.user.pk) + get_user_cache_keys(other.pk)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            report = expire_roles()
+
+        self.assertEqual((report['expired'], report['users']), (1, 1))
+        self.assertEqual(Role.objects.get(pk=self.role.pk).status, Role.expired)
+        self.assertEqual(report['next_expiry'], later.expires_at)
+        self.assertFalse(cache.get_many(get_user_cache_keys(self.user.pk)))
+        self.assertEqual(len(cache.get_many(get_user_cache_keys(other.pk))), 3)
+
+    def test_sweeper_sleeps_until_the_next_expiry(self):
+        self.assertAlmostEqual(seconds_until(self.role.expires_at, max_sleep=10 ** 8),
+                               self.role_type.effective_days.total_seconds(), delta=5)
+        self.assertEqual(seconds_until(None, max_sleep=60), 60)
+        self.assertEqual(seconds_until(timezone.now() - timedelta(days=1), max_sleep=60), 0)
+
+    def test_command_reports_the_sweep(self):
+        Role.objects.filter(pk=self.role.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        out = StringIO()
+        call_command('expire_roles', stdout=out)
+        self.assertIn('1 cargos expirados de 1 usuários', out.getvalue())
+
+
+class UserQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='testpass')
+
+    def test_histories_are_listed_through_the_composite_index(self):
+        histories = UserHistory.objects.filter(user=self.user.id)
+        index_name = get_index_name(UserHistory, ['user', '-id'])
+        for queryset in (histories.order_by('-id')[:UserHistoryManager.CACHE_WINDOW + 1], histories,
+                         histories.filter(id__lt=100).order_by('-id')[:11]):
+            self.assertUsesIndex(queryset, index_name)
+            self.assertNoSort(queryset)
+
+    def test_role_queries_use_indexes(self):
+        self.assertNoFullScan(Role.objects.due_for_expiry().order_by('expires_at').values_list('id', 'user_id')[:500])
+        self.assertNoFullScan(Role.objects.filter(user_id__in=[self.user.id]).exclude(status=Role.expired))
+
+    def test_balance_is_summed_through_the_ledger_index(self):
+        self.assertUsesIndex(BalanceEntry.objects.filter(user_id=self.user.id, id__gt=10),
+                             get_index_name(BalanceEntry, ['user', 'id']))
@@ -1,8 +1,9 @@
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.paginator import Paginator
 from django.db.models import Q
 from django.views.generic import TemplateView
 
+from pages.paginators import KeysetPaginator
+
 from .models import UserHistory
 
 
@@ -17,10 +18,10 @@ class UserHistoryListView(LoginRequiredMixin, TemplateView):
 
     def get_histories(self, search_query):
         if self.request.user.is_staff:
-            histories = self.get_staff_histories(search_query)
-        else:
-            histories = self.get_user_histories(search_query)
-        return self.paginate_histories(histories)
+            return self.paginate_histories(self.get_staff_histories(search_query))
+        # Served from the cached window of the user, older pages come from the database
+        return UserHistory.objects.get_histories_page(self.request.user.id, token=self.request.GET.get('cursor'),
+                                                      per_page=10, search_query=search_query)
 
     @staticmethod
     def get_staff_histories(search_query):
@@ -28,25 +29,12 @@ class UserHistoryListView(LoginRequiredMixin, TemplateView):
         if search_query:
             histories = histories.filter(
                 Q(id__icontains=search_query) |
-                Q(status__icontains=search_query) |
+                Q(type__icontains=search_query) |
                 Q(user__username__icontains=search_query)
             )
         return histories
 
-    def get_user_histories(self, search_query):
-        histories_dict = UserHistory.objects.get_cached_histories(user_id=self.request.user.id)
-        histories = [value for _, value in sorted(histories_dict.items(), reverse=True)]
-        if search_query:
-            histories = [
-                history for history in histories
-                if search_query in str(history['id']) or
-                   search_query in history['type_display'].lower() or
-                   search_query in history['info'].lower()
-            ]
-        return histories
-
     def paginate_histories(self, histories):
-        paginator = Paginator(histories, 10)
-        paginator._count = len(list(histories))
-        page_number = self.request.GET.get('page')
-        return paginator.get_page(page_number)
+        # Keyset pagination on '-id': every page costs one LIMIT query, without counting the table
+        paginator = KeysetPaginator(per_page=10)
+        return paginator.get_page(histories, self.request.GET.get('cursor'))